@@ -0,0 +1,37 @@
+from __future__ import print_function
+
+import re
+import timeit
+
+from motifapi import MotifApi
+
+# compares the cost of resolving an endpoint to its HTTP method using the previous
+# linear regex scan over MotifApi.API, and the compiled+cached MotifApi router.
+# no connection to motif is required
+
+ENDPOINTS = ['io/led/set',
+             'camera/FAKE0',
+             'camera/FAKE0/io/led/set',
+             'schedule/camera/FAKE0/configure/ExposureTime',
+             'multicam/disconnect_all']
+
+
+def linear_scan(endpoint):
+    for _ep, _meth in MotifApi.API.items():
+        if re.match(_ep, endpoint):
+            return _meth
+
+
+def routed(endpoint, _resolve=MotifApi.get_router().resolve):
+    return _resolve(endpoint).method
+
+
+if __name__ == "__main__":
+    N = 20000
+
+    for ep in ENDPOINTS:
+        assert linear_scan(ep) == routed(ep)
+
+        old = min(timeit.repeat(lambda: linear_scan(ep), number=N, repeat=3)) / N
+        new = min(timeit.repeat(lambda: routed(ep), number=N, repeat=3)) / N
+        print('%-45s linear: %6.2f us  routed: %5.2f us  (%.0fx)' % (ep, old * 1e6, new * 1e6, old / new))
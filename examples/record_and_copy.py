@@ -4,6 +4,7 @@ import logging
 logging.basicConfig(level=logging.INFO)
 
 from motifapi import MotifApi
+from motifapi.watch import StateWatcher, COPY_FINISHED
 
 # You need to fill these out
 IP_ADDRESS = None
@@ -35,19 +36,19 @@ camera_serials = [cinfo['serial'] for cinfo in api.call('cameras')['cameras']]
 print(api.call('recording/start', codec='h264', filename='test_store', duration=10, record_to_store=True,
                metadata={'title': 'test store', 'description': 'a multicamera recording'}))
 
-# wait for all cameras to finish recording
-while any(api.is_recording(_sn) for _sn in camera_serials):
-    print('still recording %r' % (camera_serials,))
-    time.sleep(1)
+# wait for all cameras to finish recording (the status of all cameras is polled concurrently)
+print(api.wait_until(lambda status: not status.is_recording, camera_serials, timeout=60))
 
 # list all recordings
 print(api.call('recordings'))
 
-# Copy all recordings to the configured storage location
-print(api.call('recordings/copy_all', delete_after=True))  # if true, delete files after successful copy
-while any(api.is_copying(_sn) for _sn in camera_serials):
-    print('still copying')
-    time.sleep(1)
+# Copy all recordings to the configured storage location, and wait (without polling in a loop)
+# until every camera has finished copying
+with StateWatcher(api, camera_serials) as watcher:
+    finished = [watcher.wait_for(COPY_FINISHED, sn, timeout=600) for sn in camera_serials]
+    print(api.call('recordings/copy_all', delete_after=True))  # if true, delete files after successful copy
+    for f in finished:
+        print(f.result())
 
 print('finished')
 
@@ -1,5 +1,5 @@
 __version__ = '0.2.0'
 
-from .api import MotifError, MotifApiError, MotifApi
-from .schedule import datetime_to_cron
+from .api import MotifError, MotifApiError, MotifApi, CameraStatus
+from .schedule import datetime_to_cron, ScheduleManager, ScheduledTask
 from .util import get_experiment_metadata
@@ -0,0 +1,137 @@
+"""
+Runs commands on one or many motif hosts at once, e.g.
+
+    python -m motifapi -H rig1 -H rig2 --api-key KEY status
+    python -m motifapi --hosts-file rigs.txt recordings/copy_all
+    python -m motifapi --hosts-file rigs.txt call camera/SERIAL/recording/start duration=60
+
+Hosts are also taken from MOTIF_HOSTS (comma separated) or MOTIF_HOST, API keys from --api-key,
+MOTIF_API_KEY or the hosts file (see MotifFleet.from_file). Exits with status 1 if any host failed.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+
+from .api import DEFAULT_HTTP_TIMEOUT
+from .fleet import MotifFleet
+
+# command -> endpoint
+ENDPOINTS = {'start': 'recording/start',
+             'stop': 'recording/stop',
+             'copy': 'recordings/copy_all',
+             'export': 'recordings/export_all'}
+
+
+def _value(s):
+    try:
+        return json.loads(s)
+    except ValueError:
+        return s
+
+
+def _parse_kwargs(args):
+    kwargs = {}
+    for a in args:
+        if '=' not in a:
+            raise ValueError('arguments are name=value, not %s' % a)
+        k, v = a.split('=', 1)
+        kwargs[k] = _value(v)
+    return kwargs
+
+
+def _print_table(rows, header):
+    widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+    for r in [header] + rows:
+        print('  '.join(str(v).ljust(w) for v, w in zip(r, widths)).rstrip())
+
+
+def _print_failed(result):
+    for host, e in result.failed.items():
+        print('%s: FAILED %s' % (host, e), file=sys.stderr)
+
+
+def _status_rows(result):
+    rows = []
+    for host, snap in result.succeeded.items():
+        for sn, cs in snap.items():
+            rows.append((host, sn, 'yes' if cs.is_recording else '', 'yes' if cs.is_copying else '',
+                         'yes' if cs.is_exporting else '', cs.status['camera_info'].get('filename') or ''))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m motifapi',
+                                     description='run commands on many motif hosts concurrently')
+    parser.add_argument('-H', '--host', action='append', dest='hosts', metavar='HOST[:PORT]',
+                        help='host (may be repeated)')
+    parser.add_argument('--hosts-file', help="file of 'host[:port] [api_key]' lines")
+    parser.add_argument('--api-key')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--ca-cert')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_HTTP_TIMEOUT,
+                        help='seconds to wait for each host (default %(default)s)')
+    parser.add_argument('--json', action='store_true', help='print the responses as JSON')
+    parser.add_argument('command', help='cameras, recordings, status, %s, or call ENDPOINT' %
+                        ', '.join(sorted(ENDPOINTS)))
+    parser.add_argument('args', nargs='*', help='ENDPOINT, then name=value arguments')
+    args = parser.parse_args(argv)
+
+    kwargs = dict(api_key=args.api_key, port=args.port, ca_cert=args.ca_cert, timeout=args.timeout)
+    if args.hosts_file:
+        fleet = MotifFleet.from_file(args.hosts_file, **kwargs)
+    else:
+        hosts = args.hosts
+        if not hosts:
+            hosts = [h.strip() for h in os.environ.get('MOTIF_HOSTS', os.environ.get('MOTIF_HOST', '')).split(',')
+                     if h.strip()]
+        if not hosts:
+            parser.error('no hosts given (use -H, --hosts-file or MOTIF_HOSTS)')
+        fleet = MotifFleet(hosts, **kwargs)
+
+    cmd = args.command
+    cmd_args = list(args.args)
+    with fleet:
+        if cmd == 'status':
+            result = fleet.snapshot()
+            if args.json:
+                print(json.dumps({h: {sn: cs.status for sn, cs in snap.items()}
+                                  for h, snap in result.succeeded.items()}, indent=1))
+            else:
+                _print_table(_status_rows(result), ('HOST', 'CAMERA', 'RECORDING', 'COPYING', 'EXPORTING', 'FILENAME'))
+        elif cmd in ('cameras', 'recordings'):
+            result = fleet.call(cmd)
+            items = result.merged(cmd)
+            if args.json:
+                print(json.dumps(items, indent=1))
+            elif cmd == 'cameras':
+                _print_table([(c['host'], c.get('serial', ''), c.get('status', '')) for c in items],
+                             ('HOST', 'CAMERA', 'STATUS'))
+            else:
+                _print_table([(r['host'], r.get('path', r.get('uuid', ''))) for r in items], ('HOST', 'RECORDING'))
+        else:
+            if cmd == 'call':
+                if not cmd_args:
+                    parser.error('call requires an ENDPOINT')
+                endpoint = cmd_args.pop(0)
+            else:
+                endpoint = ENDPOINTS.get(cmd, cmd)
+            try:
+                result = fleet.call(endpoint, _parse_kwargs(cmd_args))
+            except ValueError as e:
+                parser.error(str(e))
+            if args.json:
+                print(json.dumps(result.succeeded, indent=1))
+            else:
+                for host, r in result.items():
+                    if r.ok:
+                        print('%s: %s (%.0fms)' % (host, json.dumps(r.value), r.duration * 1000.))
+
+        _print_failed(result)
+    return 0 if result.ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
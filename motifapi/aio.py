@@ -0,0 +1,251 @@
+import time
+import asyncio
+import logging
+
+from .api import MotifApi, MotifError, DEFAULT_HTTP_TIMEOUT, DEFAULT_POOL_SIZE, DEFAULT_POOL_IDLE_TIMEOUT, \
+    _make_ssl_context, _resolve_connection_args, _endpoint_path, _encode_body, _raise_api_error, \
+    _decode_response, _status_is_recording, _status_is_copying, _status_is_exporting, _stream_address
+
+DEFAULT_MAX_CONCURRENCY = 8  # in-flight requests per AsyncMotifApi
+
+
+class _StaleConnection(Exception):
+    # the request could not be sent, the server has not run it
+    pass
+
+
+class _NoResponse(Exception):
+    # the connection closed after the request was sent, the server may have run it
+    pass
+
+
+class _AsyncConnection(object):
+    """
+    A minimal HTTP/1.1 keep-alive client connection over asyncio streams
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    @classmethod
+    async def open(cls, host, port, ctx):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ctx, server_hostname=host)
+        return cls(reader, writer)
+
+    async def _read_body(self, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';', 1)[0], 16)
+                if size == 0:
+                    # trailers
+                    while (await self.reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+        elif 'content-length' in headers:
+            return await self.reader.readexactly(int(headers['content-length']))
+        else:
+            return await self.reader.read()
+
+    async def request(self, method, path, host_header, headers, body):
+        """
+        Returns (status, data, keep_alive)
+        """
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host_header]
+        lines.extend('%s: %s' % kv for kv in headers.items())
+        lines.append('Content-Length: %d' % (0 if body is None else len(body)))
+        try:
+            self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            if body:
+                self.writer.write(body)
+            await self.writer.drain()
+        except ConnectionError:
+            raise _StaleConnection()
+
+        try:
+            status_line = await self.reader.readline()
+        except ConnectionError:
+            raise _NoResponse()
+        if not status_line:
+            raise _NoResponse()
+        version, status = status_line.split(None, 2)[:2]
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, v = line.decode('latin-1').split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+
+        data = await self._read_body(headers)
+        self.last_used = time.monotonic()
+
+        conn = headers.get('connection', '').lower()
+        keep_alive = (conn != 'close') if version == b'HTTP/1.1' else (conn == 'keep-alive')
+        return int(status), data, keep_alive
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncMotifApi(object):
+    """
+    asyncio client for the Motif API, with the same endpoints, arguments and errors as MotifApi.
+
+    Requests are made over a pool of keep-alive TLS connections, and at most max_concurrency
+    requests are in flight at once so many calls can be safely gathered, e.g.
+
+        await asyncio.gather(*(api.is_recording(sn) for sn in serials))
+    """
+
+    API = MotifApi.API
+
+    def __init__(self, host=None, api_key=None, port=None, ca_cert=None, api_version=1,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, pool_size=DEFAULT_POOL_SIZE,
+                 pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, timeout=DEFAULT_HTTP_TIMEOUT):
+        self._log = logging.getLogger('motifapi')
+
+        host, api_key, port, ca_cert = _resolve_connection_args(self._log, host, api_key, port, ca_cert)
+
+        self._prefix = 'api/%d/' % api_version
+        self._ctx = _make_ssl_context(ca_certs=ca_cert)
+        self._router = MotifApi.get_router()
+
+        self._host = host
+        self._api_key = api_key
+        self._port = port
+
+        self._timeout = timeout
+        self._max_concurrency = max_concurrency
+        self._pool_size = pool_size
+        self._pool_idle_timeout = pool_idle_timeout
+
+        self._sem = None  # created lazily, inside the running loop
+        self._idle = []
+
+    def _get_idle(self):
+        now = time.monotonic()
+        while self._idle:
+            conn = self._idle.pop()
+            if ((now - conn.last_used) > self._pool_idle_timeout) or conn.reader.at_eof():
+                conn.close()
+            else:
+                return conn
+        return None
+
+    async def _request(self, method, path, body):
+        headers = {'X-Api-Key': self._api_key,
+                   'Content-Type': 'application/json'}
+        host_header = '%s:%d' % (self._host, self._port)
+
+        while True:
+            conn = self._get_idle()
+            reused = conn is not None
+            if conn is None:
+                conn = await _AsyncConnection.open(self._host, self._port, self._ctx)
+
+            try:
+                status, data, keep_alive = await conn.request(method, path, host_header, headers, body)
+            except _StaleConnection:
+                conn.close()
+                if reused:
+                    # stale keep-alive connection, try again on a new one
+                    continue
+                raise MotifError('motif not running or reachable')
+            except (_NoResponse, ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if reused and (method == 'GET'):
+                    # (a GET can safely be run twice)
+                    continue
+                if reused:
+                    raise MotifError('connection closed by motif, the request may have been run')
+                raise MotifError('motif not running or reachable')
+            except BaseException:
+                # includes cancellation, the connection state is unknown
+                conn.close()
+                raise
+
+            if keep_alive and (len(self._idle) < self._pool_size):
+                self._idle.append(conn)
+            else:
+                conn.close()
+
+            return status, data
+
+    async def call(self, endpoint, method=None, data=None, **kwargs):
+        route = self._router.resolve(endpoint)
+        if route is None:
+            raise ValueError("unknown endpoint '%s' (are you missing/adding '/')" % endpoint)
+
+        path = '/' + _endpoint_path(self._prefix, endpoint)
+        body = _encode_body(kwargs or None)
+
+        self._log.debug('%s https://%s:%s%s (%d bytes)' % (route.method, self._host, self._port, path,
+                                                           0 if body is None else len(body)))
+
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self._max_concurrency)
+
+        async with self._sem:
+            try:
+                status, out = await asyncio.wait_for(self._request(route.method, path, body), self._timeout)
+            except (OSError, asyncio.TimeoutError):
+                raise MotifError('motif not running or reachable')
+
+        if not (200 <= status < 300):
+            _raise_api_error(out)
+
+        return _decode_response(out)
+
+    async def is_recording(self, serial):
+        return _status_is_recording(await self.call('camera/%s' % serial))
+
+    async def is_copying(self, serial):
+        return _status_is_copying(await self.call('camera/%s' % serial))
+
+    async def is_exporting(self, serial):
+        return _status_is_exporting(await self.call('camera/%s' % serial))
+
+    async def send_message(self, message, serial=None):
+        if serial:
+            return await self.call('camera/%s/experiment/message' % serial, message=message)
+        return await self.call('experiment/message', message=message)
+
+    async def get_stream(self, serial=None, stream_type=MotifApi.STREAM_TYPE_IMAGE, force_host=None,
+                         **stream_kwargs):
+        """
+        Returns an AsyncImageStreamer or AsyncStateStreamer for the camera (default the first
+        camera). Additional keyword arguments are passed to the streamer.
+        """
+        from .aiostream import AsyncImageStreamer, AsyncStateStreamer
+
+        if stream_type not in (MotifApi.STREAM_TYPE_IMAGE, MotifApi.STREAM_TYPE_STATE):
+            raise ValueError('unknown stream type')
+
+        if serial is None:
+            for c in (await self.call('cameras')).get('cameras', []):
+                serial = c['serial']
+                break
+        if serial is None:
+            raise MotifError('no cameras connected or running')
+
+        host, port = _stream_address(await self.call('camera/%s' % serial), stream_type, self._host, force_host)
+        if stream_type == MotifApi.STREAM_TYPE_IMAGE:
+            return AsyncImageStreamer(host, port, **stream_kwargs)
+        return AsyncStateStreamer(host, port, **stream_kwargs)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
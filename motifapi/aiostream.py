@@ -0,0 +1,235 @@
+import asyncio
+import logging
+
+import zmq
+import zmq.asyncio
+import numpy as np
+
+from .stream import _json_loads
+
+LOG = logging.getLogger('motifapi.aiostream')
+
+
+def _context():
+    # an asyncio shadow of the process wide context, so async streams share the IO thread
+    # of the blocking streams
+    return zmq.asyncio.Context.shadow(zmq.Context.instance())
+
+
+class _StreamClosed(ValueError):
+    pass
+
+
+def _decode_array(parts, copy):
+    md = _json_loads(parts[0].bytes)
+    A = np.frombuffer(parts[1].bytes if copy else parts[1].buffer, dtype=md.pop('dtype'))
+    return A.reshape(md.pop('shape')), md
+
+
+class _AsyncStreamer(object):
+    """
+    Messages are received whole (recv_multipart), so cancelling a receive, e.g. by a timeout,
+    never leaves the socket in the middle of a message.
+
+    If queue_size is given, a task receives messages into a queue of that many items, so
+    receiving continues while the consumer is busy. When the queue is full the task waits, and
+    messages queue in zmq up to its high water mark.
+    """
+
+    stream = None
+
+    def __init__(self, sock, queue_size):
+        self.stream = sock
+        self._queue_size = queue_size
+        self._queue = None
+        self._task = None
+        self._closing = False
+
+    async def _recv(self):
+        raise NotImplementedError
+
+    async def _fill(self):
+        try:
+            while True:
+                await self._queue.put(await self._recv())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # raised to the consumer
+            await self._queue.put(e)
+
+    async def _next(self):
+        if self._closing:
+            raise _StreamClosed('stream is closed')
+
+        if not self._queue_size:
+            try:
+                return await self._recv()
+            except asyncio.CancelledError:
+                # pending receives are cancelled when the socket is closed
+                if self._closing:
+                    raise _StreamClosed('stream is closed')
+                raise
+
+        if self._task is None:
+            # created lazily, inside the running loop
+            self._queue = asyncio.Queue(maxsize=self._queue_size)
+            self._task = asyncio.ensure_future(self._fill())
+
+        item = await self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def _pending(self):
+        # whether a message can be returned without waiting. with a queue, messages still
+        # waiting in zmq (while the queue is full) are received by the task once it has room
+        if (self._queue is not None) and (not self._queue.empty()):
+            return True
+        return bool(self.stream.getsockopt(zmq.EVENTS) & zmq.POLLIN)
+
+    async def _get(self, timeout):
+        if timeout is None:
+            return await self._next()
+        try:
+            return await asyncio.wait_for(self._next(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    @property
+    def closed(self):
+        return (self.stream is None) or self.stream.closed
+
+    async def close(self):
+        """
+        Stops receiving and closes the socket, messages not yet received are discarded. Pending
+        receives raise ValueError, iteration stops
+        """
+        self._closing = True
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            if not self._queue.full():
+                # wakes a consumer waiting for the queue
+                self._queue.put_nowait(_StreamClosed('stream is closed'))
+        if not self.closed:
+            self.stream.close(linger=0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._get(None)
+        except _StreamClosed:
+            raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class AsyncImageStreamer(_AsyncStreamer):
+    """
+    Receives images from the motif realtime image stream, in an asyncio event loop. Any number
+    of streams can be used from one loop, no threads are started.
+
+        async with api.get_async_stream(serial) as stream:
+            async for I, md in stream:
+                ...
+
+    As ImageStreamer, copy=False returns images which are zero-copy views of the received
+    message, rcvhwm limits the number of frames queued in zmq, and dropped_frames counts the
+    frames missing between consecutively returned frames. Iterating uses the copy given here.
+    """
+
+    def __init__(self, host, port, queue_size=0, rcvhwm=None, copy=True):
+        address = "tcp://%s:%d" % (host, port)
+        LOG.debug('async image stream connecting to: %s' % address)
+        sock = _context().socket(zmq.PULL)
+        if rcvhwm is not None:
+            sock.setsockopt(zmq.RCVHWM, rcvhwm)
+        sock.connect(address)
+        _AsyncStreamer.__init__(self, sock, queue_size)
+
+        self.copy = copy
+        self.dropped_frames = 0
+        self.conflated_frames = 0
+        self._last_frame_number = None
+
+    def _track(self, md):
+        fn = md.get('frame_number')
+        if fn is not None:
+            last = self._last_frame_number
+            if (last is not None) and (fn > (last + 1)):
+                self.dropped_frames += fn - last - 1
+            self._last_frame_number = fn
+
+    async def _recv(self):
+        # decoded by the consumer, so queued frames are never copied
+        return await self.stream.recv_multipart(copy=False)
+
+    def _decode(self, parts, copy):
+        A, md = _decode_array(parts, self.copy if copy is None else copy)
+        self._track(md)
+        return A, md
+
+    async def get_next_image(self, copy=None, timeout=None):
+        """
+        Returns the next (image, metadata), or (None, None) if no image arrives within timeout seconds
+        """
+        parts = await self._get(timeout)
+        if parts is None:
+            return None, None
+        return self._decode(parts, copy)
+
+    async def get_latest_image(self, copy=None, timeout=None):
+        """
+        As get_next_image, but discards all queued frames except the newest
+        """
+        parts = await self._get(timeout)
+        if parts is None:
+            return None, None
+        while self._pending():
+            parts = await self._next()
+            self.conflated_frames += 1
+        return self._decode(parts, copy)
+
+    async def __anext__(self):
+        try:
+            parts = await self._get(None)
+        except _StreamClosed:
+            raise StopAsyncIteration
+        return self._decode(parts, None)
+
+
+class AsyncStateStreamer(_AsyncStreamer):
+    """
+    Receives state messages from the motif realtime state stream, in an asyncio event loop
+    (see AsyncImageStreamer)
+    """
+
+    def __init__(self, host, port, channel='j', queue_size=0):
+        address = "tcp://%s:%d" % (host, port)
+        LOG.debug('async state stream connecting to: %s' % address)
+        sock = _context().socket(zmq.SUB)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt_string(zmq.SUBSCRIBE, channel)
+        sock.connect(address)
+        _AsyncStreamer.__init__(self, sock, queue_size)
+
+    async def _recv(self):
+        _, msg = await self.stream.recv_multipart()
+        return _json_loads(msg)
+
+    async def get_next_state(self, timeout=None):
+        """
+        Returns the next state, or None if no state arrives within timeout seconds
+        """
+        return await self._get(timeout)
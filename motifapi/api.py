@@ -1,8 +1,13 @@
 import re
 import json
 import ssl
+import time
+import collections
+import concurrent.futures
 import socket
+import select
 import os.path
+import threading
 import subprocess
 import logging
 import urllib.request
@@ -10,6 +15,23 @@ import urllib.error
 import http.client
 
 DEFAULT_HTTP_TIMEOUT = 10  # seconds
+DEFAULT_POOL_SIZE = 4  # idle connections kept per (host, port)
+DEFAULT_POOL_IDLE_TIMEOUT = 30  # seconds
+DEFAULT_STATUS_TTL = 0.25  # seconds a camera status is reused by is_recording/etc
+DEFAULT_MAX_WORKERS = 8  # threads used to fetch camera status concurrently
+
+
+def _make_ssl_context(key=None, cert=None, ca_certs=None):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    if ca_certs:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(ca_certs)
+    else:
+        ctx.verify_mode = ssl.CERT_NONE
+    if cert:
+        ctx.load_cert_chain(cert, key)
+    return ctx
 
 
 # http://code.activestate.com/recipes/577548-https-httplib-client-connection-with-certificate-v/
@@ -22,15 +44,7 @@ class HTTPSClientAuthHandler(urllib.request.HTTPSHandler):
     """
 
     def __init__(self, key=None, cert=None, ca_certs=None):
-        self.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        self.ctx.check_hostname = False
-        if ca_certs:
-            self.ctx.verify_mode = ssl.CERT_REQUIRED
-            self.ctx.load_verify_locations(ca_certs)
-        else:
-            self.ctx.verify_mode = ssl.CERT_NONE
-        if cert:
-            self.ctx.load_cert_chain(cert, key)
+        self.ctx = _make_ssl_context(key=key, cert=cert, ca_certs=ca_certs)
         urllib.request.HTTPSHandler.__init__(self, context=self.ctx)
 
     def https_open(self, req):
@@ -42,25 +56,180 @@ class HTTPSClientAuthHandler(urllib.request.HTTPSHandler):
 
 class HTTPSConnection(http.client.HTTPSConnection):
     """
-    Overridden to allow peer certificate validation using an SSLContext.
+    Overridden to allow peer certificate validation using an SSLContext, and
+    to resume a previously negotiated TLS session.
     """
 
+    # seconds taken by the last connect() to resolve and connect, and for the TLS handshake
+    connect_time = 0.
+    tls_time = 0.
+
     def __init__(self, host, **kwargs):
         self.ctx = kwargs.pop('context', None)
+        self.tls_session = kwargs.pop('session', None)
         http.client.HTTPSConnection.__init__(self, host, **kwargs)
 
     def connect(self):
+        t0 = time.perf_counter()
         sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
 
+        t1 = time.perf_counter()
         if self.ctx:
-            self.sock = self.ctx.wrap_socket(sock, server_hostname=self.host)
+            self.sock = self.ctx.wrap_socket(sock, server_hostname=self.host,
+                                             session=self.tls_session)
         else:
             self.sock = sock
 
+        self.connect_time = t1 - t0
+        self.tls_time = time.perf_counter() - t1
+
+
+class HTTPSConnectionPool(object):
+    """
+    Thread-safe pool of persistent (HTTP/1.1 keep-alive) connections, keyed by (host, port).
+
+    All connections share one SSLContext and new connections resume the last TLS session
+    negotiated with the same peer. Connections idle for longer than idle_timeout are closed,
+    and a request which fails because the server dropped an idle connection is transparently
+    retried on a fresh one. Only GET requests are retried if the connection fails after the
+    request was sent, as the server may have already run it.
+    """
+
+    def __init__(self, context, maxsize=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 timeout=DEFAULT_HTTP_TIMEOUT):
+        self.ctx = context
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}  # (host, port) -> [(last_used, conn), ...] oldest first
+        self._sessions = {}  # (host, port) -> ssl.SSLSession
+
+    @staticmethod
+    def _is_dropped(conn):
+        # an idle keep-alive socket should never be readable, if it is then the server
+        # either closed it or sent something we don't expect
+        if conn.sock is None:
+            return True
+        try:
+            r, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(r)
+
+    def _expire(self, idle, now):
+        n = 0
+        while (n < len(idle)) and ((now - idle[n][0]) > self.idle_timeout):
+            n += 1
+        expired = [c for _, c in idle[:n]]
+        del idle[:n]
+        return expired
+
+    def _get(self, key):
+        now = time.monotonic()
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            discard = self._expire(idle, now)
+            while idle:
+                _, c = idle.pop()
+                if self._is_dropped(c):
+                    discard.append(c)
+                else:
+                    conn = c
+                    break
+            session = self._sessions.get(key)
+
+        for c in discard:
+            c.close()
+
+        if conn is not None:
+            return conn, True
+        return HTTPSConnection(key[0], port=key[1], timeout=self.timeout,
+                               context=self.ctx, session=session), False
+
+    def _put(self, key, conn):
+        session = getattr(conn.sock, 'session', None)
+        now = time.monotonic()
+        with self._lock:
+            if session is not None:
+                self._sessions[key] = session
+            idle = self._idle.setdefault(key, [])
+            discard = self._expire(idle, now)
+            if len(idle) < self.maxsize:
+                idle.append((now, conn))
+            else:
+                discard.append(conn)
+
+        for c in discard:
+            c.close()
+
+    def request(self, host, port, method, url, body=None, headers=None, trace=None):
+        """
+        Performs the request on a pooled connection and returns a (status, reason, data) tuple.
+        If given, the connect, tls and server times are recorded in the CallInfo trace
+        """
+        key = (host, int(port))
+        while True:
+            conn, reused = self._get(key)
+            if trace is not None:
+                t0 = time.perf_counter()
+            try:
+                conn.request(method, url, body=body, headers=headers or {})
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    # stale keep-alive connection, the request was not sent whole so the
+                    # server can not have run it. try again on a new one
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            try:
+                resp = conn.getresponse()
+                data = resp.read()
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                    http.client.BadStatusLine):
+                conn.close()
+                if reused and (method == 'GET'):
+                    continue
+                if reused:
+                    raise MotifError('connection closed by motif, the request may have been run')
+                raise
+            except Exception:
+                conn.close()
+                raise
+
+            if trace is not None:
+                trace.reused = reused
+                trace.server = time.perf_counter() - t0
+                if not reused:
+                    trace.connect = conn.connect_time
+                    trace.tls = conn.tls_time
+                    trace.server -= conn.connect_time + conn.tls_time
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put(key, conn)
+
+            return resp.status, resp.reason, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, c in conns:
+                c.close()
+
 
 class MethodRequest(urllib.request.Request):
     # See: https://gist.github.com/logic/2715756
@@ -77,6 +246,58 @@ class MethodRequest(urllib.request.Request):
         return self._method if self._method is not None else urllib.request.Request.get_method(self, *args, **kwargs)
 
 
+Route = collections.namedtuple('Route', 'method pattern params')
+
+
+class EndpointRouter(object):
+    """
+    Resolves endpoint strings to their HTTP method, matching with the same semantics as
+    re.match over the endpoint table in order (the first matching pattern wins).
+
+    Patterns are compiled once and bucketed by their leading literal path segment, and
+    resolved endpoints are kept in an LRU cache.
+    """
+
+    def __init__(self, api, cache_size=1024):
+        self._buckets = {}
+        for pattern, method in api.items():
+            first = re.match(r'[\w]+(?=/|\$|$)', pattern)
+            if first is None:
+                raise ValueError("endpoint pattern '%s' must start with a literal path segment" % pattern)
+            self._buckets.setdefault(first.group(0), []).append((re.compile(pattern), method, pattern))
+
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def _match(self, endpoint):
+        for regex, method, pattern in self._buckets.get(endpoint.split('/', 1)[0], ()):
+            m = regex.match(endpoint)
+            if m is not None:
+                return Route(method, pattern, m.groupdict())
+        return None
+
+    def resolve(self, endpoint):
+        """
+        Returns the matching Route(method, pattern, params), or None if the endpoint is unknown
+        """
+        try:
+            with self._lock:
+                route = self._cache[endpoint]
+                self._cache.move_to_end(endpoint)
+            return route
+        except KeyError:
+            pass
+
+        route = self._match(endpoint)
+        if route is not None:
+            with self._lock:
+                self._cache[endpoint] = route
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return route
+
+
 class MotifError(Exception):
     pass
 
@@ -87,6 +308,171 @@ class MotifApiError(MotifError):
         Exception.__init__(self, message)
 
 
+def _resolve_connection_args(log, host, api_key, port, ca_cert):
+    # fills in unspecified arguments from the environment and system defaults
+    if port is None:
+        try:
+            port = int(os.environ.get('MOTIF_PORT', 6083))
+        except:
+            port = 6083
+    else:
+        port = int(port)
+
+    if host is None:
+        try:
+            host = os.environ['MOTIF_HOST']
+            log.debug('took host from environment')
+        except KeyError:
+            pass
+        if not host:
+            host = '127.0.0.1'
+
+    if api_key is None:
+        try:
+            api_key = os.environ['MOTIF_API_KEY']
+            log.debug('took api_key from environment')
+        except KeyError:
+            pass
+        if not api_key:
+            try:
+                api_key = subprocess.check_output(['recnode-apikey']).strip()
+                log.debug('took api-key from recnode-apikey subprocess')
+            except OSError:
+                pass
+
+    if not api_key:
+        raise ValueError('API key must be specified')
+
+    if ca_cert is None:
+        ca_cert = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'server.crt')
+
+    if not os.path.exists(ca_cert):
+        raise ValueError('could not find certificate: %s' % ca_cert)
+
+    if isinstance(api_key, bytes):
+        api_key = api_key.decode('utf-8')
+
+    return host, api_key, port, ca_cert
+
+
+def _endpoint_path(prefix, endpoint):
+    if endpoint[0] == '/':
+        endpoint = endpoint[1:]
+
+    if endpoint != 'version':
+        endpoint = prefix + endpoint
+
+    return endpoint
+
+
+def _encode_body(data):
+    if data is not None:
+        try:
+            data = json.dumps(data).encode("utf-8")
+        except TypeError:
+            raise ValueError('Arguments must be JSON serializable (they were %r)' % (data,))
+    return data
+
+
+def _raise_api_error(data):
+    try:
+        err = json.loads(data.decode('utf-8'))
+        exc = MotifApiError(err['error'], err['status_code'])
+    except Exception:
+        raise ValueError('unknown API error')
+    raise exc
+
+
+def _decode_response(out):
+    if out:
+        try:
+            return json.loads(out.decode('utf-8'))
+        except ValueError as e:
+            raise ValueError('Invalid JSON response: %s' % e)
+    else:
+        return {}
+
+
+def _status_is_recording(r):
+    if r['camera_info'].get('filename'):
+        return True
+    elif r['camera_info'].get('status') == 'pending':
+        return True
+    return False
+
+
+def _status_is_copying(r):
+    return r['playback_info']['status'] == 'copying'
+
+
+def _status_is_exporting(r):
+    status = r['playback_info']['status']
+    return status.startswith('export') and ('finished' not in status)
+
+
+def _stream_address(status, stream_type, api_host, force_host=None):
+    # (host, port) of the realtime stream of stream_type, from the camera/<serial> status
+    try:
+        stream = status['camera_info']['stream']['image' if stream_type == MotifApi.STREAM_TYPE_IMAGE else 'state']
+        host = stream['host']
+        port = int(stream['port'])
+    except KeyError:
+        raise MotifError('realtime stream not enabled on camera')
+
+    if force_host is not None:
+        host = force_host
+    elif (host == '0.0.0.0') and (api_host != '0.0.0.0'):
+        host = api_host
+
+    return host, port
+
+
+class CallInfo(object):
+    """
+    Describes one MotifApi.call() to the hooks of the tracers added with MotifApi.add_tracer().
+
+    route is the matched endpoint pattern. The durations (seconds) are None if that phase was
+    not reached: connect (name resolution and TCP connect) and tls (handshake) are only set when
+    a new connection was made, server is the time from sending the request until the response was
+    read, decode the time to decode the JSON response and total the time of the whole call.
+    """
+
+    __slots__ = ('method', 'endpoint', 'route', 'start', 'status', 'reused',
+                 'connect', 'tls', 'server', 'decode', 'total')
+
+    def __init__(self, method, endpoint, route):
+        self.method = method
+        self.endpoint = endpoint
+        self.route = route
+        self.start = time.time()
+        self.status = None
+        self.reused = None
+        self.connect = self.tls = self.server = self.decode = self.total = None
+
+    def __repr__(self):
+        return '<CallInfo %s %s status=%s total=%s>' % (self.method, self.endpoint, self.status, self.total)
+
+
+class CameraStatus(object):
+    """
+    The status of one camera (the response of camera/<serial>) at a point in time
+    """
+
+    __slots__ = ('serial', 'status', 'time', 'is_recording', 'is_copying', 'is_exporting')
+
+    def __init__(self, serial, status, t):
+        self.serial = serial
+        self.status = status
+        self.time = t
+        self.is_recording = _status_is_recording(status)
+        self.is_copying = _status_is_copying(status)
+        self.is_exporting = _status_is_exporting(status)
+
+    def __repr__(self):
+        return '<CameraStatus %s recording=%s copying=%s exporting=%s>' % (
+            self.serial, self.is_recording, self.is_copying, self.is_exporting)
+
+
 class MotifApi(object):
 
     STREAM_TYPE_IMAGE = 1
@@ -138,74 +524,42 @@ class MotifApi(object):
            r'multicam/disconnect_all': 'POST',
            }
 
-    def __init__(self, host=None, api_key=None, port=None, ca_cert=None, api_version=1):
+    def __init__(self, host=None, api_key=None, port=None, ca_cert=None, api_version=1,
+                 pool=None, pool_size=DEFAULT_POOL_SIZE, pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 status_ttl=DEFAULT_STATUS_TTL, max_workers=DEFAULT_MAX_WORKERS):
         self._log = logging.getLogger('motifapi')
 
-        if port is None:
-            try:
-                port = int(os.environ.get('MOTIF_PORT', 6083))
-            except:
-                port = 6083
-        else:
-            port = int(port)
-
-        if host is None:
-            try:
-                host = os.environ['MOTIF_HOST']
-                self._log.debug('took host from environment')
-            except KeyError:
-                pass
-            if not host:
-                host = '127.0.0.1'
-
-        if api_key is None:
-            try:
-                api_key = os.environ['MOTIF_API_KEY']
-                self._log.debug('took api_key from environment')
-            except KeyError:
-                pass
-            if not api_key:
-                try:
-                    api_key = subprocess.check_output(['recnode-apikey']).strip()
-                    self._log.debug('took api-key from recnode-apikey subprocess')
-                except OSError:
-                    pass
-
-        if not api_key:
-            raise ValueError('API key must be specified')
-
-        if ca_cert is None:
-            ca_cert = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'server.crt')
-
-        if not os.path.exists(ca_cert):
-            raise ValueError('could not find certificate: %s' % ca_cert)
+        host, api_key, port, ca_cert = _resolve_connection_args(self._log, host, api_key, port, ca_cert)
 
         self._prefix = 'api/%d/' % api_version
 
-        client_cert_key = None
-        client_cert_pem = None  # file path
-        handler = HTTPSClientAuthHandler(
-            key=client_cert_key,
-            cert=client_cert_pem,
-            ca_certs=ca_cert)
-        self._http = urllib.request.build_opener(handler)
+        # connections can be shared with other instances by passing the same pool
+        self._own_pool = pool is None
+        if pool is None:
+            client_cert_key = None
+            client_cert_pem = None  # file path
+            ctx = _make_ssl_context(
+                key=client_cert_key,
+                cert=client_cert_pem,
+                ca_certs=ca_cert)
+            pool = HTTPSConnectionPool(ctx, maxsize=pool_size, idle_timeout=pool_idle_timeout)
+        self._pool = pool
 
         self._host = host
         self._api_key = api_key
         self._port = port
 
-    def _build_request(self, endpoint, data=None, method='GET'):
-        if endpoint[0] == '/':
-            endpoint = endpoint[1:]
+        self._status_ttl = status_ttl
+        self._status_cache = {}  # serial -> CameraStatus
+        self._max_workers = max_workers
+        self._executor = None
 
-        if endpoint != 'version':
-            endpoint = self._prefix + endpoint
+        # replaced (not modified) so calls can iterate it without locking
+        self._tracers = ()
 
-        if data is not None:
-            try:
-                data = json.dumps(data).encode("utf-8")
-            except TypeError:
-                raise ValueError('Arguments must be JSON serializable (they were %r)' % (data,))
+    def _build_request(self, endpoint, data=None, method='GET'):
+        endpoint = _endpoint_path(self._prefix, endpoint)
+        data = _encode_body(data)
 
         url = 'https://%s:%s/%s' % (self._host, self._port, endpoint)
 
@@ -220,70 +574,188 @@ class MotifApi(object):
 
         return req
 
-    def _call(self, req):
+    def _call(self, req, trace=None):
         try:
-            resp = self._http.open(req)
-            data = resp.read()
-            resp.close()
-            return data
-        except urllib.error.HTTPError as e:
-            try:
-                raw = e.read()
-                err = json.loads(raw.decode('utf-8'))
-                exc = MotifApiError(err['error'], err['status_code'])
-            except Exception:
-                raise ValueError('unknown API error')
-            raise exc
-        except urllib.error.URLError:
+            status, _, data = self._pool.request(self._host, self._port,
+                                                 req.get_method(), req.selector,
+                                                 body=req.data, headers=req.headers,
+                                                 trace=trace)
+        except MotifError:
+            raise
+        except (OSError, http.client.HTTPException):
             raise MotifError('motif not running or reachable')
 
+        if trace is not None:
+            trace.status = status
+
+        if not (200 <= status < 300):
+            _raise_api_error(data)
+
+        return data
+
+    def _get_executor(self):
+        # for making concurrent requests
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._own_pool:
+            self._pool.close()
+
+    def add_tracer(self, tracer):
+        """
+        Adds a tracer (e.g. motifapi.tracing.CallStats) whose before_request(info),
+        after_response(info) and on_error(info, exc) methods are called for every call()
+        """
+        self._tracers = self._tracers + (tracer,)
+        return tracer
+
+    def remove_tracer(self, tracer):
+        self._tracers = tuple(t for t in self._tracers if t is not tracer)
+
+    def _traced_call(self, req, info, tracers):
+        for t in tracers:
+            t.before_request(info)
+
+        t0 = time.perf_counter()
+        try:
+            data = self._call(req, info)
+            t1 = time.perf_counter()
+            result = _decode_response(data)
+        except Exception as e:
+            info.total = time.perf_counter() - t0
+            for t in tracers:
+                t.on_error(info, e)
+            raise
+
+        t2 = time.perf_counter()
+        info.decode = t2 - t1
+        info.total = t2 - t0
+        for t in tracers:
+            t.after_response(info)
+        return result
+
+    @classmethod
+    def get_router(cls):
+        # built once per class (subclasses may extend API)
+        router = cls.__dict__.get('_router')
+        if router is None:
+            router = EndpointRouter(cls.API)
+            cls._router = router
+        return router
+
     def call(self, endpoint, method=None, data=None, **kwargs):
-        meth = ep = None
-        for _ep, _meth in self.API.items():
-            if re.match(_ep, endpoint):
-                meth = _meth
-                ep = _ep
-                break
-
-        if meth is None:
+        route = self.get_router().resolve(endpoint)
+        if route is None:
             raise ValueError("unknown endpoint '%s' (are you missing/adding '/')" % endpoint)
 
+        if route.method != 'GET':
+            # anything could have changed the camera status
+            self._status_cache.clear()
+
         req = self._build_request(endpoint,
                                   data=kwargs or None,
-                                  method=meth)
-        out = self._call(req)
-        if out:
-            try:
-                return json.loads(out.decode('utf-8'))
-            except ValueError as e:
-                raise ValueError('Invalid JSON response: %s' % e.message)
-        else:
-            return {}
+                                  method=route.method)
+
+        tracers = self._tracers
+        if tracers:
+            return self._traced_call(req, CallInfo(route.method, endpoint, route.pattern), tracers)
+        return _decode_response(self._call(req))
+
+    def get_camera_status(self, serial, max_age=None):
+        """
+        Returns the CameraStatus of the camera, reusing one fetched within the last max_age
+        seconds (default status_ttl)
+        """
+        if max_age is None:
+            max_age = self._status_ttl
+
+        cs = self._status_cache.get(serial)
+        if (cs is not None) and ((time.monotonic() - cs.time) <= max_age):
+            return cs
 
-    def is_recording(self, serial):
         r = self.call('camera/%s' % serial)
-        if r['camera_info'].get('filename'):
-            return True
-        elif r['camera_info'].get('status') == 'pending':
-            return True
-        return False
+        cs = CameraStatus(serial, r, time.monotonic())
+        self._status_cache[serial] = cs
+        return cs
+
+    def snapshot(self, serials=None, max_age=None):
+        """
+        Returns an ordered {serial: CameraStatus} of the given (default all connected) cameras.
+        Statuses are fetched concurrently.
+        """
+        if serials is None:
+            serials = [c['serial'] for c in self.call('cameras').get('cameras', [])]
+
+        if len(serials) == 1:
+            return collections.OrderedDict((sn, self.get_camera_status(sn, max_age)) for sn in serials)
+
+        executor = self._get_executor()
+        futs = [(sn, executor.submit(self.get_camera_status, sn, max_age)) for sn in serials]
+        return collections.OrderedDict((sn, f.result()) for sn, f in futs)
+
+    def wait_until(self, predicate, serials=None, timeout=None, poll_interval=0.1, max_poll_interval=2.0):
+        """
+        Waits until predicate(CameraStatus) is true for all the given (default all connected) cameras,
+        and returns the final snapshot. For example, to wait for recording to finish everywhere
+
+            api.wait_until(lambda s: not s.is_recording)
+
+        The polling interval starts at poll_interval and backs off to max_poll_interval while
+        nothing changes. Raises MotifError if timeout seconds pass first.
+        """
+        if serials is None:
+            serials = [c['serial'] for c in self.call('cameras').get('cameras', [])]
+
+        t0 = time.monotonic()
+        interval = poll_interval
+        last = None
+        while True:
+            snap = self.snapshot(serials, max_age=0)
+            done = tuple(bool(predicate(cs)) for cs in snap.values())
+            if all(done):
+                return snap
+
+            if (timeout is not None) and ((time.monotonic() - t0) >= timeout):
+                raise MotifError('timeout waiting for cameras %s' % ', '.join(sn for sn, d in zip(snap, done)
+                                                                             if not d))
+
+            # poll quickly again if progress is being made
+            interval = poll_interval if done != last else min(interval * 1.5, max_poll_interval)
+            last = done
+
+            if timeout is not None:
+                interval = max(0, min(interval, timeout - (time.monotonic() - t0)))
+            time.sleep(interval)
+
+    def is_recording(self, serial):
+        return self.get_camera_status(serial).is_recording
 
     def is_copying(self, serial):
-        r = self.call('camera/%s' % serial)
-        return r['playback_info']['status'] == 'copying'
+        return self.get_camera_status(serial).is_copying
 
     def is_exporting(self, serial):
-        r = self.call('camera/%s' % serial)
-        status = r['playback_info']['status']
-        return status.startswith('export') and ('finished' not in status)
+        return self.get_camera_status(serial).is_exporting
 
     def send_message(self, message, serial=None):
         if serial:
             return self.call('camera/%s/experiment/message' % serial, message=message)
         return self.call('experiment/message', message=message)
 
-    def get_stream(self, serial=None, stream_type=STREAM_TYPE_IMAGE, force_host=None):
-        from .stream import ImageStreamer, StateStreamer
+    def get_io_channel(self, coalesce=False, max_in_flight=16, **kwargs):
+        """
+        Returns an IOChannel for setting outputs with low latency (see motifapi.iochannel)
+        """
+        from .iochannel import IOChannel
+        return IOChannel(self, coalesce=coalesce, max_in_flight=max_in_flight, **kwargs)
+
+    def _get_stream_address(self, serial, stream_type, force_host):
+        if stream_type not in (MotifApi.STREAM_TYPE_IMAGE, MotifApi.STREAM_TYPE_STATE):
+            raise ValueError('unknown stream type')
 
         if serial is None:
             try:
@@ -297,32 +769,35 @@ class MotifApi(object):
         if serial is None:
             raise MotifError('no cameras connected or running')
 
-        def _get_host_port(_stream_name):
-            _stat = self.call('camera/%s' % serial)
-            _host = _stat['camera_info']['stream'][_stream_name]['host']
-            _port = int(_stat['camera_info']['stream'][_stream_name]['port'])
+        try:
+            status = self.call('camera/%s' % serial)
+        except (urllib.error.URLError, MotifApiError):
+            raise MotifError('camera with serial %s not found or running' % serial)
 
-            if force_host is not None:
-                _host = force_host
-            elif (_host == '0.0.0.0') and (self._host != '0.0.0.0'):
-                _host = self._host
+        return _stream_address(status, stream_type, self._host, force_host)
 
-            return _host, _port
+    def get_stream(self, serial=None, stream_type=STREAM_TYPE_IMAGE, force_host=None, **stream_kwargs):
+        """
+        Returns an ImageStreamer or StateStreamer for the camera (default the first camera).
+        Additional keyword arguments are passed to the streamer.
+        """
+        from .stream import ImageStreamer, StateStreamer
 
-        if stream_type in (MotifApi.STREAM_TYPE_IMAGE, MotifApi.STREAM_TYPE_STATE):
-            try:
-                if stream_type == MotifApi.STREAM_TYPE_IMAGE:
-                    host, port = _get_host_port('image')
-                    return ImageStreamer(host, port)
-                else:
-                    host, port = _get_host_port('state')
-                    return StateStreamer(host, port)
-            except (urllib.error.URLError, MotifApiError):
-                raise MotifError('camera with serial %s not found or running' % serial)
-            except KeyError:
-                raise MotifError('realtime stream not enabled on camera')
-        else:
-            raise ValueError('unknown stream type')
+        host, port = self._get_stream_address(serial, stream_type, force_host)
+        if stream_type == MotifApi.STREAM_TYPE_IMAGE:
+            return ImageStreamer(host, port, **stream_kwargs)
+        return StateStreamer(host, port, **stream_kwargs)
+
+    def get_async_stream(self, serial=None, stream_type=STREAM_TYPE_IMAGE, force_host=None, **stream_kwargs):
+        """
+        As get_stream, but returns an AsyncImageStreamer or AsyncStateStreamer (see motifapi.aiostream)
+        """
+        from .aiostream import AsyncImageStreamer, AsyncStateStreamer
+
+        host, port = self._get_stream_address(serial, stream_type, force_host)
+        if stream_type == MotifApi.STREAM_TYPE_IMAGE:
+            return AsyncImageStreamer(host, port, **stream_kwargs)
+        return AsyncStateStreamer(host, port, **stream_kwargs)
 
 
 
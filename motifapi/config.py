@@ -0,0 +1,211 @@
+import time
+import numbers
+import logging
+import threading
+import collections
+
+from .api import MotifError
+
+LOG = logging.getLogger('motifapi.config')
+
+
+def _read_value(r, name):
+    # camera/<serial>/read/<name> responses
+    if isinstance(r, dict):
+        if 'value' in r:
+            return r['value']
+        if name in r:
+            return r[name]
+    return r
+
+
+def _read_values(r, name, serials):
+    # cameras/read/<name> responses, {serial: value, ...} or {'cameras': [{'serial': .., 'value': ..}, ...]}
+    # returns None if the response could not be understood
+    if not isinstance(r, dict):
+        return None
+    if any(sn in r for sn in serials):
+        return {sn: _read_value(v, name) for sn, v in r.items() if sn in serials}
+    cameras = r.get('cameras')
+    if isinstance(cameras, list):
+        try:
+            return {c['serial']: _read_value(c, name) for c in cameras if c['serial'] in serials}
+        except (KeyError, TypeError):
+            return None
+    return None
+
+
+def _equal(a, b):
+    if isinstance(a, numbers.Number) and isinstance(b, numbers.Number) \
+            and not isinstance(a, bool) and not isinstance(b, bool):
+        return abs(a - b) <= 1e-6 * max(abs(a), abs(b))
+    return a == b
+
+
+class ConfigureReport(object):
+    """
+    The result of configuring one camera. changed is {name: (old, new)} of the parameters which
+    were sent, unchanged the names of those already at the desired value. error is the exception
+    if configuring failed, duration the seconds taken.
+    """
+
+    __slots__ = ('serial', 'changed', 'unchanged', 'error', 'duration')
+
+    def __init__(self, serial, changed, unchanged, error, duration):
+        self.serial = serial
+        self.changed = changed
+        self.unchanged = unchanged
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<ConfigureReport %s changed=%s unchanged=%d%s %.0fms>' % (
+            self.serial, sorted(self.changed), len(self.unchanged),
+            '' if self.error is None else (' error=%r' % (self.error,)), self.duration * 1000.)
+
+
+class CameraConfigurator(object):
+    """
+    Applies camera configuration (profiles of parameter values) to many cameras, sending only the
+    parameters which differ from the current values, in one camera/<serial>/configure request per
+    camera, and to all cameras concurrently.
+
+    Current values are read with cameras/read/<name> (one request for all cameras) where possible,
+    falling back to camera/<serial>/read/<name>, and are cached for ttl seconds. Values of changed
+    parameters are re-read when next needed, as cameras may adjust the values they are given.
+    """
+
+    def __init__(self, api, serials=None, ttl=60.):
+        self._api = api
+        self._serials = serials
+        self._ttl = ttl
+        self._cache = {}  # (serial, name) -> (time, value)
+        self._lock = threading.Lock()
+
+    @property
+    def serials(self):
+        if self._serials is None:
+            self._serials = [c['serial'] for c in self._api.call('cameras').get('cameras', [])]
+        return self._serials
+
+    def invalidate(self, serial=None, name=None):
+        with self._lock:
+            for k in list(self._cache):
+                if ((serial is None) or (k[0] == serial)) and ((name is None) or (k[1] == name)):
+                    del self._cache[k]
+
+    def _cached(self, serial, name, now, max_age):
+        try:
+            t, v = self._cache[(serial, name)]
+        except KeyError:
+            return False, None
+        return (now - t) <= max_age, v
+
+    def _read_bulk(self, name, serials):
+        try:
+            return _read_values(self._api.call('cameras/read/%s' % name), name, serials)
+        except MotifError as e:
+            LOG.debug('bulk read of %s failed: %s' % (name, e))
+            return None
+
+    def _read_one(self, serial, name):
+        return _read_value(self._api.call('camera/%s/read/%s' % (serial, name)), name)
+
+    def read(self, names, serials=None, max_age=None):
+        """
+        Returns {serial: {name: value}} of the given parameters. Parameters which could not be read
+        are missing from the result.
+        """
+        serials = list(self.serials if serials is None else serials)
+        max_age = self._ttl if max_age is None else max_age
+        now = time.monotonic()
+
+        out = collections.OrderedDict((sn, {}) for sn in serials)
+        missing = collections.defaultdict(list)  # name -> [serial, ...]
+        with self._lock:
+            for sn in serials:
+                for name in names:
+                    fresh, v = self._cached(sn, name, now, max_age)
+                    if fresh:
+                        out[sn][name] = v
+                    else:
+                        missing[name].append(sn)
+
+        if not missing:
+            return out
+
+        executor = self._api._get_executor()
+
+        # one request per parameter for all cameras, then fall back to reading individually
+        bulk = {name: executor.submit(self._read_bulk, name, set(sns)) for name, sns in missing.items()
+                if len(sns) > 1}
+        singles = []
+        for name, sns in missing.items():
+            values = bulk[name].result() if name in bulk else None
+            for sn in sns:
+                if (values is not None) and (sn in values):
+                    out[sn][name] = values[sn]
+                else:
+                    singles.append((sn, name, executor.submit(self._read_one, sn, name)))
+
+        for sn, name, f in singles:
+            try:
+                out[sn][name] = f.result()
+            except MotifError as e:
+                LOG.warning('could not read %s of %s: %s' % (name, sn, e))
+
+        now = time.monotonic()
+        with self._lock:
+            for name, sns in missing.items():
+                for sn in sns:
+                    if name in out[sn]:
+                        self._cache[(sn, name)] = (now, out[sn][name])
+
+        return out
+
+    def _configure(self, serial, changed, unchanged, t0):
+        error = None
+        if changed:
+            try:
+                self._api.call('camera/%s/configure' % serial, **{n: new for n, (_, new) in changed.items()})
+            except MotifError as e:
+                error = e
+            for name in changed:
+                self.invalidate(serial, name)
+        return ConfigureReport(serial, changed, unchanged, error, time.monotonic() - t0)
+
+    def apply(self, config, serials=None, per_camera=None):
+        """
+        Configures the given (default all) cameras with the {name: value} parameters in config,
+        updated with any camera specific parameters in per_camera {serial: {name: value}}.
+        Returns an ordered {serial: ConfigureReport}
+        """
+        t0 = time.monotonic()
+        serials = list(self.serials if serials is None else serials)
+        per_camera = per_camera or {}
+
+        desired = collections.OrderedDict()
+        for sn in serials:
+            d = dict(config)
+            d.update(per_camera.get(sn, {}))
+            desired[sn] = d
+
+        current = self.read(sorted(set(n for d in desired.values() for n in d)), serials)
+
+        futs = []
+        executor = self._api._get_executor()
+        for sn, d in desired.items():
+            changed = {}
+            unchanged = []
+            for name, value in d.items():
+                if (name in current[sn]) and _equal(current[sn][name], value):
+                    unchanged.append(name)
+                else:
+                    changed[name] = (current[sn].get(name), value)
+            futs.append((sn, executor.submit(self._configure, sn, changed, unchanged, t0)))
+
+        return collections.OrderedDict((sn, f.result()) for sn, f in futs)
@@ -0,0 +1,214 @@
+import time
+import logging
+import collections
+import concurrent.futures
+
+from .api import MotifApi, MotifError, DEFAULT_HTTP_TIMEOUT, DEFAULT_POOL_SIZE, DEFAULT_POOL_IDLE_TIMEOUT
+
+LOG = logging.getLogger('motifapi.fleet')
+
+
+def _parse_host(host, port):
+    # 'host' or 'host:port'
+    if host.count(':') == 1:
+        host, p = host.split(':')
+        return host, int(p)
+    return host, port
+
+
+class HostResult(object):
+    """
+    The result of an operation on one host. value is the return value, or error the exception if
+    the operation failed or did not finish within the timeout. duration is the seconds taken.
+    """
+
+    __slots__ = ('host', 'value', 'error', 'duration')
+
+    def __init__(self, host, value, error, duration):
+        self.host = host
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<HostResult %s %s %.0fms>' % (self.host, 'ok' if self.ok else ('error=%r' % (self.error,)),
+                                              self.duration * 1000.)
+
+
+class FleetResult(collections.OrderedDict):
+    """
+    An ordered {host: HostResult} of an operation on many hosts
+    """
+
+    @property
+    def ok(self):
+        return all(r.ok for r in self.values())
+
+    @property
+    def succeeded(self):
+        return collections.OrderedDict((h, r.value) for h, r in self.items() if r.ok)
+
+    @property
+    def failed(self):
+        return collections.OrderedDict((h, r.error) for h, r in self.items() if not r.ok)
+
+    def merged(self, key):
+        """
+        Returns the items of the list key (e.g. 'cameras' or 'recordings') of all successful
+        responses, each with an added 'host'
+        """
+        out = []
+        for host, r in self.items():
+            if r.ok and isinstance(r.value, dict):
+                for item in r.value.get(key, []):
+                    item = dict(item)
+                    item['host'] = host
+                    out.append(item)
+        return out
+
+
+class MotifFleet(object):
+    """
+    Runs API calls on many motif hosts concurrently, e.g. to copy the recordings of every rig
+
+        fleet = MotifFleet(['rig1', 'rig2:6084'], api_key=API_KEY)
+        r = fleet.call('recordings/copy_all')
+        for host, e in r.failed.items():
+            print(host, e)
+
+    hosts are 'host' or 'host:port' strings, or a {host: api_key} dict if the hosts have different
+    API keys. There is a MotifApi per host (fleet[host]), all sharing one connection pool.
+
+    Every host is given timeout seconds (default the timeout given here), a host which does not
+    answer in time is reported as failed without delaying the results of the others. Operations
+    never raise for failed hosts, they return a FleetResult.
+    """
+
+    def __init__(self, hosts, api_key=None, port=None, ca_cert=None, api_version=1,
+                 timeout=DEFAULT_HTTP_TIMEOUT, pool_size=DEFAULT_POOL_SIZE,
+                 pool_idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT, max_workers=None):
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        keys = hosts if isinstance(hosts, dict) else dict.fromkeys(hosts, api_key)
+        if not keys:
+            raise ValueError('no hosts given')
+
+        self._timeout = timeout
+        self._pool = None
+
+        self._apis = collections.OrderedDict()
+        for name, key in keys.items():
+            host, p = _parse_host(name, port)
+            api = MotifApi(host, key or api_key, port=p, ca_cert=ca_cert, api_version=api_version,
+                           pool=self._pool, pool_size=pool_size, pool_idle_timeout=pool_idle_timeout)
+            if self._pool is None:
+                # the connections (and TLS context) of the first host are shared by all
+                self._pool = api._pool
+                self._pool.timeout = timeout
+            self._apis[name] = api
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(self._apis))
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """
+        Creates a MotifFleet of the hosts listed in a file, one 'host[:port] [api_key]' per line.
+        Blank lines and lines starting with # are ignored
+        """
+        hosts = collections.OrderedDict()
+        with open(filename, 'r') as f:
+            for line in f:
+                parts = line.split('#', 1)[0].split()
+                if parts:
+                    hosts[parts[0]] = parts[1] if len(parts) > 1 else None
+        return cls(hosts, **kwargs)
+
+    @property
+    def hosts(self):
+        return list(self._apis)
+
+    def __getitem__(self, host):
+        return self._apis[host]
+
+    def __len__(self):
+        return len(self._apis)
+
+    def _run(self, host, fn):
+        t0 = time.monotonic()
+        try:
+            return HostResult(host, fn(self._apis[host]), None, time.monotonic() - t0)
+        except Exception as e:
+            LOG.debug('%s failed: %s' % (host, e))
+            return HostResult(host, None, e, time.monotonic() - t0)
+
+    def map(self, fn, hosts=None, timeout=None):
+        """
+        Calls fn(MotifApi) for the given (default all) hosts concurrently, returns a FleetResult
+        """
+        hosts = self.hosts if hosts is None else list(hosts)
+        for h in hosts:
+            if h not in self._apis:
+                raise ValueError('unknown host: %s' % h)
+        timeout = self._timeout if timeout is None else timeout
+
+        t0 = time.monotonic()
+        futs = collections.OrderedDict((h, self._executor.submit(self._run, h, fn)) for h in hosts)
+        concurrent.futures.wait(futs.values(), timeout=timeout)
+
+        out = FleetResult()
+        for h, f in futs.items():
+            if f.done():
+                out[h] = f.result()
+            else:
+                # left to finish (or time out in its socket) in the background
+                f.cancel()
+                out[h] = HostResult(h, None, MotifError('no response within %.1fs' % timeout),
+                                    time.monotonic() - t0)
+        return out
+
+    def call(self, endpoint, arguments=None, hosts=None, timeout=None):
+        """
+        Calls the endpoint with the arguments dict (see MotifApi.call) on the given (default all)
+        hosts concurrently, returns a FleetResult of the responses. The arguments are a dict so
+        that they can not be confused with hosts and timeout, e.g.
+
+            fleet.call('recording/start', {'duration': 60, 'timeout': 10}, timeout=5)
+        """
+        if MotifApi.get_router().resolve(endpoint) is None:
+            raise ValueError("unknown endpoint '%s' (are you missing/adding '/')" % endpoint)
+        arguments = dict(arguments or {})
+        return self.map(lambda api: api.call(endpoint, **arguments), hosts, timeout)
+
+    def cameras(self, hosts=None, timeout=None):
+        """
+        Returns the FleetResult of 'cameras', use merged('cameras') for a list of all cameras
+        """
+        return self.call('cameras', hosts=hosts, timeout=timeout)
+
+    def recordings(self, hosts=None, timeout=None):
+        """
+        Returns the FleetResult of 'recordings', use merged('recordings') for a list of all recordings
+        """
+        return self.call('recordings', hosts=hosts, timeout=timeout)
+
+    def snapshot(self, hosts=None, timeout=None):
+        """
+        Returns a FleetResult of the snapshot (see MotifApi.snapshot) of all cameras of each host
+        """
+        return self.map(lambda api: api.snapshot(max_age=0), hosts, timeout)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for api in self._apis.values():
+            # (the first closes the shared pool)
+            api.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
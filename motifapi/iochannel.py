@@ -0,0 +1,427 @@
+import ssl
+import json
+import time
+import socket
+import select
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from .api import MotifError, DEFAULT_HTTP_TIMEOUT, _endpoint_path, _raise_api_error, _decode_response
+from .stats import LatencyHistogram
+
+LOG = logging.getLogger('motifapi.iochannel')
+
+
+def _parse_response(buf, eof=False):
+    """
+    Parses one HTTP response from the start of buf. Returns (status, body, nbytes consumed, close),
+    or None if buf does not yet hold a complete response. close is True if the server closes the
+    connection after this response. eof is True if the connection was closed after buf, which
+    ends a response without a length
+    """
+    end = buf.find(b'\r\n\r\n')
+    if end < 0:
+        return None
+
+    lines = bytes(buf[:end]).decode('latin-1').split('\r\n')
+    version, status = lines[0].split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    for line in lines[1:]:
+        k, v = line.split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+
+    conn = headers.get('connection', '').lower()
+    close = (conn == 'close') if version == 'HTTP/1.1' else (conn != 'keep-alive')
+
+    pos = end + 4
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            eol = buf.find(b'\r\n', pos)
+            if eol < 0:
+                return None
+            size = int(bytes(buf[pos:eol]).split(b';', 1)[0], 16)
+            pos = eol + 2
+            if size == 0:
+                # (trailers are not supported)
+                if len(buf) < pos + 2:
+                    return None
+                return status, b''.join(chunks), pos + 2, close
+            if len(buf) < pos + size + 2:
+                return None
+            chunks.append(bytes(buf[pos:pos + size]))
+            pos += size + 2
+
+    if 'content-length' in headers:
+        n = int(headers['content-length'])
+    elif (status < 200) or (status in (204, 304)):
+        n = 0
+    else:
+        # the body is ended by the server closing the connection
+        if not eof:
+            return None
+        return status, bytes(buf[pos:]), len(buf), True
+
+    if len(buf) < pos + n:
+        return None
+    return status, bytes(buf[pos:pos + n]), pos + n, close
+
+
+class _Command(object):
+
+    __slots__ = ('head', 'body', 'futures', 'sent')
+
+    def __init__(self, head, body, future):
+        self.head = head
+        self.body = body
+        self.futures = [future]
+        self.sent = None
+
+
+class IOChannel(object):
+    """
+    A low latency channel for setting outputs, equivalent to calling io/<name>/set or
+    camera/<serial>/io/<name>/set, obtained from MotifApi.get_io_channel().
+
+    Commands are sent on a dedicated persistent connection by a background thread, without
+    waiting for the response of one command before sending the next (HTTP pipelining, at most
+    max_in_flight commands at once). If coalesce is True, a command for an output which is still
+    waiting to be sent is replaced by the newer value, so only the latest value is sent.
+
+    set() returns a Future for the response. At most max_queued commands wait to be sent, when
+    full set() waits for room (raising MotifError after timeout seconds). A command not answered
+    within timeout seconds of being sent fails, and the connection is closed. latency is a
+    LatencyHistogram of the command round trip times.
+    """
+
+    def __init__(self, api, coalesce=False, max_in_flight=16, timeout=DEFAULT_HTTP_TIMEOUT,
+                 max_queued=1024):
+        self._api = api
+        self._coalesce = coalesce
+        self._max_in_flight = max(1, max_in_flight)
+        self._max_queued = max(1, max_queued)
+        self._timeout = timeout
+
+        self._headers = {}  # path -> pre-rendered request head
+        self._queue = collections.deque()
+        self._queued = {}  # path -> _Command, for coalescing
+        self._in_flight = collections.deque()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        self.latency = LatencyHistogram()
+        self.sent = 0
+        self.coalesced = 0
+        self.errors = 0
+
+        self._sock = None
+        self._rbuf = bytearray()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._closing = False
+
+        # keep the connection warm
+        try:
+            self._connect()
+        except OSError:
+            raise MotifError('motif not running or reachable')
+
+        self._thread = threading.Thread(target=self._run, name='IOChannel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        api = self._api
+        sock = socket.create_connection((api._host, api._port), self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = api._pool.ctx.wrap_socket(sock, server_hostname=api._host)
+        # the socket may be readable without application data to read (e.g. TLS session
+        # tickets) so it is read without blocking
+        self._sock.setblocking(False)
+        self._rbuf = bytearray()
+        LOG.debug('connected to %s:%s' % (api._host, api._port))
+
+    def _disconnect(self, exc):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+        with self._lock:
+            failed, self._in_flight = self._in_flight, collections.deque()
+            self.errors += len(failed)
+            self._idle.notify_all()
+        for cmd in failed:
+            for f in cmd.futures:
+                f.set_exception(exc)
+
+    def _head(self, endpoint):
+        head = self._headers.get(endpoint)
+        if head is None:
+            route = self._api.get_router().resolve(endpoint)
+            if (route is None) or (route.method != 'POST'):
+                raise ValueError("unknown endpoint '%s'" % endpoint)
+            api = self._api
+            head = ('POST /%s HTTP/1.1\r\n'
+                    'Host: %s:%s\r\n'
+                    'X-Api-Key: %s\r\n'
+                    'Content-Type: application/json\r\n'
+                    'Content-Length: ' % (_endpoint_path(api._prefix, endpoint),
+                                          api._host, api._port, api._api_key)).encode('latin-1')
+            self._headers[endpoint] = head
+        return head
+
+    def set(self, name, value, serial=None):
+        """
+        Sets the named output (on the given camera's IO device) to value. Returns a Future
+        """
+        if serial is None:
+            endpoint = 'io/%s/set' % name
+        else:
+            endpoint = 'camera/%s/io/%s/set' % (serial, name)
+
+        head = self._head(endpoint)
+        body = json.dumps({'value': value}).encode('utf-8')
+        f = concurrent.futures.Future()
+
+        with self._lock:
+            if self._closing:
+                raise MotifError('channel is closed')
+
+            cmd = self._queued.get(head) if self._coalesce else None
+            if cmd is not None:
+                cmd.body = body
+                cmd.futures.append(f)
+                self.coalesced += 1
+                return f
+
+            while len(self._queue) >= self._max_queued:
+                if not self._not_full.wait(self._timeout):
+                    raise MotifError('timeout waiting to queue io command')
+                if self._closing:
+                    raise MotifError('channel is closed')
+
+            cmd = _Command(head, body, f)
+            self._queue.append(cmd)
+            if self._coalesce:
+                self._queued[head] = cmd
+
+        self._wake()
+        return f
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            # closed
+            pass
+
+    def _send_queued(self):
+        with self._lock:
+            n = min(len(self._queue), self._max_in_flight - len(self._in_flight))
+            cmds = [self._queue.popleft() for _ in range(n)]
+            for cmd in cmds:
+                if self._queued.get(cmd.head) is cmd:
+                    del self._queued[cmd.head]
+            if cmds:
+                self._not_full.notify_all()
+
+        if not cmds:
+            return
+
+        data = b''.join(b'%s%d\r\n\r\n%s' % (cmd.head, len(cmd.body), cmd.body) for cmd in cmds)
+
+        if self._sock is None:
+            try:
+                self._connect()
+            except OSError as e:
+                LOG.warning('error connecting: %s' % e)
+                with self._lock:
+                    self.errors += len(cmds)
+                    self._idle.notify_all()
+                for cmd in cmds:
+                    for f in cmd.futures:
+                        f.set_exception(MotifError('motif not running or reachable'))
+                return
+
+        now = time.perf_counter()
+        with self._lock:
+            for cmd in cmds:
+                cmd.sent = now
+                self._in_flight.append(cmd)
+
+        try:
+            self._sendall(data)
+        except OSError as e:
+            LOG.warning('error sending io commands: %s' % e)
+            self._disconnect(MotifError('motif not running or reachable'))
+            return
+
+        self.sent += len(cmds)
+
+    def _sendall(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[self._sock.send(view):]
+                continue
+            except ssl.SSLWantReadError:
+                r, w = [self._sock], []
+            except (ssl.SSLWantWriteError, BlockingIOError):
+                r, w = [], [self._sock]
+            r, w, _ = select.select(r, w, [], self._timeout)
+            if not (r or w):
+                raise socket.timeout('timeout sending to motif')
+
+    def _recv_responses(self):
+        try:
+            data = self._sock.recv(65536)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+            return
+        except OSError as e:
+            LOG.warning('error receiving io responses: %s' % e)
+            self._disconnect(MotifError('motif not running or reachable'))
+            return
+
+        if not data:
+            # (the last response may be ended by the close)
+            self._dispatch_responses(eof=True)
+            idle = not self._in_flight
+            self._disconnect(MotifError('connection closed by motif'))
+            if idle and not self._closing:
+                # the server closed an idle connection, keep one warm for the next command
+                try:
+                    self._connect()
+                except OSError:
+                    pass
+            return
+
+        self._rbuf.extend(data)
+        self._dispatch_responses()
+
+    def _dispatch_responses(self, eof=False):
+        while self._rbuf:
+            r = _parse_response(self._rbuf, eof)
+            if r is None:
+                return
+            status, body, n, close = r
+            del self._rbuf[:n]
+            now = time.perf_counter()
+
+            with self._lock:
+                if not self._in_flight:
+                    LOG.warning('discarding unexpected response (%s)' % status)
+                    continue
+                cmd = self._in_flight.popleft()
+                if not self._in_flight:
+                    self._idle.notify_all()
+            self.latency.record(now - cmd.sent)
+
+            try:
+                if not (200 <= status < 300):
+                    _raise_api_error(body)
+                result = _decode_response(body)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                for f in cmd.futures:
+                    f.set_exception(e)
+            else:
+                for f in cmd.futures:
+                    f.set_result(result)
+
+            if close:
+                self._closed_by_server()
+                return
+
+    def _closed_by_server(self):
+        # the server answers no more requests on this connection, so the commands sent after
+        # the last response were not run. they are sent again, first, on a new connection
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+        self._sock = None
+        self._rbuf = bytearray()
+        with self._lock:
+            unanswered, self._in_flight = self._in_flight, collections.deque()
+            for cmd in reversed(unanswered):
+                newer = self._queued.get(cmd.head) if self._coalesce else None
+                if newer is not None:
+                    # coalesced into the newer value, as if it had not been sent
+                    newer.futures[:0] = cmd.futures
+                    self.coalesced += 1
+                    continue
+                self._queue.appendleft(cmd)
+                if self._coalesce:
+                    self._queued[cmd.head] = cmd
+        if unanswered:
+            LOG.debug('connection closed by motif, sending %d commands again' % len(unanswered))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closing and not self._queue and not self._in_flight:
+                    break
+                # the oldest unanswered command times out, however often set() wakes the thread
+                deadline = (self._in_flight[0].sent + self._timeout) if self._in_flight else None
+                # e.g. commands to send again after the connection was closed
+                sendable = bool(self._queue) and (len(self._in_flight) < self._max_in_flight)
+
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._disconnect(MotifError('timeout waiting for motif'))
+                    continue
+
+            if self._sock is not None and self._sock.pending():
+                readable = [self._sock]
+            else:
+                rlist = [self._wake_r] if self._sock is None else [self._wake_r, self._sock]
+                readable, _, _ = select.select(rlist, [], [], 0 if sendable else
+                                               (None if deadline is None else remaining))
+
+            if self._wake_r in readable:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            if (self._sock is not None) and (self._sock in readable):
+                self._recv_responses()
+
+            self._send_queued()
+
+        if self._sock is not None:
+            self._sock.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all commands have been sent and answered. Returns False on timeout
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._queue and not self._in_flight, timeout)
+
+    def close(self):
+        """
+        Sends all queued commands, waits for their responses, then closes the connection
+        """
+        with self._lock:
+            self._closing = True
+            self._not_full.notify_all()
+        self._wake()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,163 @@
+import json
+import time
+import logging
+import threading
+import collections
+
+from .api import MotifError, MotifApiError
+
+LOG = logging.getLogger('motifapi.iolog')
+
+
+class IOLogger(object):
+    """
+    Records values in the imgstore extra_data (as io/log or camera/<serial>/io/log) without
+    blocking the caller. Records are queued in memory and sent in batches by a background thread
+    over the keep-alive connections of the api.
+
+    If a StateMirror is given, each record is stamped with the frame_number and frame_time current
+    when log() was called, as client_frame_number and client_frame_time (motif itself adds the
+    frame_number and time at which it received the record).
+
+    At most maxsize records are queued. When full, log() either waits ('block'), discards the
+    oldest queued record ('drop-oldest') or discards the new record ('drop-newest'). Sending is
+    retried up to retries times if motif can not be reached. close() (or flush()) waits until all
+    queued records have been sent, and must be called at the end of the experiment.
+    """
+
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop-oldest'
+    OVERFLOW_DROP_NEWEST = 'drop-newest'
+
+    def __init__(self, api, serial=None, mirror=None, maxsize=10000, overflow=OVERFLOW_BLOCK,
+                 batch_size=64, retries=3):
+        if overflow not in (IOLogger.OVERFLOW_BLOCK, IOLogger.OVERFLOW_DROP_OLDEST, IOLogger.OVERFLOW_DROP_NEWEST):
+            raise ValueError('unknown overflow policy: %s' % overflow)
+
+        self._api = api
+        self._endpoint = 'io/log' if serial is None else ('camera/%s/io/log' % serial)
+        self._mirror = mirror
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._batch_size = batch_size
+        self._retries = retries
+
+        self._queue = collections.deque()
+        self._sending = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(target=self._run, name='IOLogger')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, **values):
+        """
+        Queues the values to be logged. Returns False if they were discarded because the queue is full.
+        Raises MotifError if the logger is closed (also while waiting for room in the queue), and
+        TypeError if the values can not be encoded as JSON
+        """
+        if self._mirror is not None:
+            snap = getattr(self._mirror, 'snapshot', None)
+            if snap is not None:
+                # FastStateMirror, both values from the same state
+                values['client_frame_number'] = snap.frame_number
+                values['client_frame_time'] = snap.frame_time
+            else:
+                values['client_frame_number'] = self._mirror.frame_number
+                values['client_frame_time'] = self._mirror.frame_time
+
+        # raised here, not later in the background thread
+        json.dumps(values)
+
+        with self._lock:
+            if self._closing:
+                raise MotifError('logger is closed')
+
+            while len(self._queue) >= self._maxsize:
+                if self._overflow == IOLogger.OVERFLOW_BLOCK:
+                    self._not_full.wait()
+                    if self._closing:
+                        # closed while waiting, the record would not be sent
+                        raise MotifError('logger is closed')
+                elif self._overflow == IOLogger.OVERFLOW_DROP_OLDEST:
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+
+            self._queue.append(values)
+            self._not_empty.notify()
+        return True
+
+    def _send(self, values):
+        delay = 0.1
+        for attempt in range(self._retries + 1):
+            try:
+                self._api.call(self._endpoint, **values)
+                return True
+            except MotifApiError as e:
+                # rejected, retrying will not help
+                LOG.warning('error logging %r: %s' % (values, e))
+                return False
+            except MotifError as e:
+                if attempt == self._retries:
+                    LOG.warning('error logging %r: %s' % (values, e))
+                    return False
+                time.sleep(delay)
+                delay *= 2
+            except Exception:
+                # e.g. an undecodable response, the thread must keep sending
+                LOG.exception('error logging %r' % (values,))
+                return False
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closing:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+                self._sending = len(batch)
+                self._not_full.notify_all()
+
+            ok = sum(self._send(values) for values in batch)
+
+            with self._lock:
+                self.sent += ok
+                self.failed += len(batch) - ok
+                self._sending = 0
+                if not self._queue:
+                    self._idle.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all queued records have been sent. Returns False on timeout
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._queue and not self._sending, timeout)
+
+    def close(self, timeout=None):
+        """
+        Sends all queued records then stops the background thread
+        """
+        with self._lock:
+            self._closing = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,219 @@
+import time
+import queue
+import logging
+import threading
+import collections
+
+from .stream import ImageStreamer, StreamPoller
+
+LOG = logging.getLogger('motifapi.multistream')
+
+
+class FrameSet(object):
+    """
+    Frames from many cameras which were matched together. frames is an ordered
+    {serial: (image, metadata)} in which cameras missing from a partial set have the value None.
+    skew is the spread of frame_time between the matched frames (seconds).
+    """
+
+    __slots__ = ('key', 'frames', 'skew')
+
+    def __init__(self, key, frames, skew):
+        self.key = key
+        self.frames = frames
+        self.skew = skew
+
+    @property
+    def complete(self):
+        return all(f is not None for f in self.frames.values())
+
+    def __repr__(self):
+        return '<FrameSet %s %d/%d frames skew=%.2fms>' % (self.key,
+                                                          sum(f is not None for f in self.frames.values()),
+                                                          len(self.frames),
+                                                          self.skew * 1000.)
+
+
+class MultiStreamer(object):
+    """
+    Receives the image streams of many cameras in one background thread and emits FrameSets
+    of frames matched across the cameras, either by equal frame_number or by frame_time within
+    tolerance seconds.
+
+    If a camera has not delivered the matching frame within max_wait seconds (or has already
+    delivered a later one) the set is either dropped (missing='drop') or emitted with that
+    camera missing (missing='partial'). At most queue_size unmatched frames are kept per camera,
+    and at most output_size sets are kept for the consumer, after which the oldest are discarded.
+
+    Iterating yields the sets as they are matched, and ends (after the sets already matched) once
+    stopped.
+    """
+
+    MATCH_FRAME_NUMBER = 'frame_number'
+    MATCH_FRAME_TIME = 'frame_time'
+
+    MISSING_DROP = 'drop'
+    MISSING_PARTIAL = 'partial'
+
+    STOP_POLL_INTERVAL = 0.1
+
+    def __init__(self, streamers, match=MATCH_FRAME_NUMBER, tolerance=0.002, missing=MISSING_DROP,
+                 max_wait=0.1, queue_size=8, output_size=16):
+        if match not in (MultiStreamer.MATCH_FRAME_NUMBER, MultiStreamer.MATCH_FRAME_TIME):
+            raise ValueError('unknown match: %s' % match)
+        if missing not in (MultiStreamer.MISSING_DROP, MultiStreamer.MISSING_PARTIAL):
+            raise ValueError('unknown missing frame policy: %s' % missing)
+
+        self._streamers = collections.OrderedDict(streamers)
+        for sn, st in self._streamers.items():
+            if not isinstance(st, ImageStreamer):
+                raise ValueError('%s is not an ImageStreamer' % sn)
+            if st.ring is not None:
+                # frames wait in the queues, they must not be overwritten
+                raise ValueError('ring buffered streams can not be aggregated (%s)' % sn)
+
+        self._match = match
+        self._tolerance = 0 if match == MultiStreamer.MATCH_FRAME_NUMBER else tolerance
+        self._missing = missing
+        self._max_wait = max_wait
+
+        # serial -> [(key, arrival_time, image, metadata), ...]
+        self._queues = collections.OrderedDict((sn, collections.deque(maxlen=queue_size))
+                                               for sn in self._streamers)
+        self._output = queue.Queue(maxsize=output_size)
+
+        self._lock = threading.Lock()
+        self._stats = {'complete_sets': 0,
+                       'partial_sets': 0,
+                       'dropped_sets': 0,
+                       'output_overflows': 0,
+                       'queue_overflows': dict.fromkeys(self._streamers, 0),
+                       'skew_mean': 0.,
+                       'skew_max': 0.}
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_api(cls, api, serials=None, force_host=None, **kwargs):
+        """
+        Creates a MultiStreamer of the image streams of the given (default all connected) cameras
+        """
+        if serials is None:
+            serials = [c['serial'] for c in api.call('cameras').get('cameras', [])]
+        return cls([(sn, api.get_stream(sn, force_host=force_host)) for sn in serials], **kwargs)
+
+    @property
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['queue_overflows'] = dict(s['queue_overflows'])
+        return s
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='MultiStreamer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, close=True):
+        """
+        Stops the receiving thread, then closes the streams (unless close is False)
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if close:
+            for st in self._streamers.values():
+                st.close()
+
+    def get_next_set(self, block=True, timeout=None):
+        """
+        Returns the next FrameSet, or None if block is False or no set is ready within timeout seconds
+        """
+        try:
+            return self._output.get(block, timeout)
+        except queue.Empty:
+            return None
+
+    def __iter__(self):
+        while True:
+            fs = self.get_next_set(timeout=self.STOP_POLL_INTERVAL)
+            if fs is not None:
+                yield fs
+            elif self._stop.is_set():
+                return
+
+    def _run(self):
+        poller = StreamPoller(*self._streamers.values())
+        by_stream = {st: sn for sn, st in self._streamers.items()}
+
+        while not self._stop.is_set():
+            for st in poller.poll(timeout=min(0.05, self._max_wait)):
+                I, md = st.get_next_image(block=False)
+                key = None if md is None else md.get(self._match)
+                if key is None:
+                    continue
+                q = self._queues[by_stream[st]]
+                if len(q) == q.maxlen:
+                    with self._lock:
+                        self._stats['queue_overflows'][by_stream[st]] += 1
+                q.append((key, time.monotonic(), I, md))
+
+            self._emit_matched(time.monotonic())
+
+    def _emit_matched(self, now):
+        n = len(self._queues)
+        while True:
+            heads = [(sn, q[0]) for sn, q in self._queues.items() if q]
+            if not heads:
+                return
+
+            target = min(h[0] for _, h in heads)
+            matched = collections.OrderedDict((sn, h) for sn, h in heads if (h[0] - target) <= self._tolerance)
+
+            if len(matched) < n:
+                # cameras which have not yet delivered anything after the target might still do so
+                pending = any(not q for sn, q in self._queues.items() if sn not in matched)
+                waited = now - min(h[1] for h in matched.values())
+                if pending and (waited < self._max_wait):
+                    return
+
+            for sn in matched:
+                self._queues[sn].popleft()
+
+            if (len(matched) < n) and (self._missing == MultiStreamer.MISSING_DROP):
+                with self._lock:
+                    self._stats['dropped_sets'] += 1
+                continue
+
+            times = [h[3].get('frame_time') for h in matched.values()]
+            times = [t for t in times if t is not None]
+            skew = (max(times) - min(times)) if times else 0.
+
+            frames = collections.OrderedDict((sn, None) for sn in self._queues)
+            for sn, h in matched.items():
+                frames[sn] = (h[2], h[3])
+
+            self._put(FrameSet(target, frames, skew), complete=len(matched) == n)
+
+    def _put(self, fs, complete):
+        with self._lock:
+            s = self._stats
+            s['complete_sets' if complete else 'partial_sets'] += 1
+            nsets = s['complete_sets'] + s['partial_sets']
+            s['skew_mean'] += (fs.skew - s['skew_mean']) / nsets
+            s['skew_max'] = max(s['skew_max'], fs.skew)
+
+        while True:
+            try:
+                self._output.put_nowait(fs)
+                return
+            except queue.Full:
+                try:
+                    self._output.get_nowait()
+                    with self._lock:
+                        self._stats['output_overflows'] += 1
+                except queue.Empty:
+                    pass
@@ -0,0 +1,364 @@
+import mmap
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+import zmq
+import numpy as np
+
+from .stream import ImageStreamer, _recv_into
+from .sharedframes import _shared_memory, _require_shared_memory
+
+LOG = logging.getLogger('motifapi.pipeline')
+
+# the shared memory of the pipeline, in each worker process. it is created when the first
+# frame is received, after the workers were started
+_worker_shm_name = None
+_worker_shm = None
+
+# queued after the last result when the pipeline failed
+_FAILED = object()
+
+
+def _worker_init(name):
+    global _worker_shm_name
+    _worker_shm_name = name
+
+
+def _worker_noop():
+    pass
+
+
+def _worker_run(fn, offset, shape, dtype, md):
+    global _worker_shm
+    if _worker_shm is None:
+        _worker_shm = _shared_memory(_worker_shm_name)
+    A = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf, offset=offset)
+    A.flags.writeable = False
+    try:
+        return fn(A, md)
+    finally:
+        del A
+
+
+class PipelineResult(object):
+    """
+    The result of processing one frame, with the frame's metadata (frame_number, frame_time, ...)
+    """
+
+    __slots__ = ('result', 'md')
+
+    def __init__(self, result, md):
+        self.result = result
+        self.md = md
+
+    @property
+    def frame_number(self):
+        return self.md.get('frame_number')
+
+    @property
+    def frame_time(self):
+        return self.md.get('frame_time')
+
+    def __repr__(self):
+        return '<PipelineResult frame %s: %r>' % (self.frame_number, self.result)
+
+
+class FramePipeline(object):
+    """
+    Processes the frames of an ImageStreamer with fn(image, metadata) in a pool of processes
+    processes (default one per CPU), so that processing is not limited by the GIL.
+
+    Frames are received directly into slots of a shared memory segment, which the workers read
+    without copying (the image is read-only and must not be kept after fn returns), so only the
+    metadata and the return value of fn are pickled. fn must be picklable, i.e. a module level
+    function. Requires Python 3.8 or newer.
+
+    At most max_in_flight frames (default 2 per process) are processed at once. When all are busy
+    new frames are either discarded (overload='drop', counted in stats['dropped']) or wait in the
+    stream's queue (overload='block'). Results are delivered in frame order (ordered=True) or as
+    they complete, either to callback(PipelineResult) called from a background thread, or to
+    get_next_result(), keeping at most output_size results after which the oldest are discarded.
+    Frames for which fn raised are logged and counted in stats['errors'].
+
+    If the worker processes die (e.g. when they can not import the module of fn) the pipeline
+    stops, and get_next_result() and stop() raise the BrokenProcessPool.
+    """
+
+    OVERLOAD_DROP = 'drop'
+    OVERLOAD_BLOCK = 'block'
+
+    STOP_POLL_INTERVAL = 0.1
+
+    def __init__(self, streamer, fn, processes=None, max_in_flight=None, ordered=True,
+                 overload=OVERLOAD_DROP, callback=None, output_size=64, mp_context='spawn'):
+        _require_shared_memory('FramePipeline')
+        if not isinstance(streamer, ImageStreamer):
+            raise ValueError('streamer must be an ImageStreamer')
+        if overload not in (FramePipeline.OVERLOAD_DROP, FramePipeline.OVERLOAD_BLOCK):
+            raise ValueError('unknown overload policy: %s' % overload)
+
+        self._streamer = streamer
+        self._fn = fn
+        self._processes = processes or multiprocessing.cpu_count()
+        self._max_in_flight = max_in_flight or (2 * self._processes)
+        self._ordered = ordered
+        self._overload = overload
+        self._callback = callback
+        self._mp_context = multiprocessing.get_context(mp_context) if isinstance(mp_context, str) else mp_context
+
+        self._output = queue.Queue(maxsize=output_size)
+        self._lock = threading.Lock()
+        self._emit_lock = threading.Lock()
+        self._slot_free = threading.Condition(self._lock)
+        self._free = list(range(self._max_in_flight))
+        self._done = {}  # sequence -> PipelineResult or None (error), waiting for earlier frames
+        self._next_seq = 0
+        self._next_out = 0
+
+        self._shm = None
+        self._shm_name = 'motifapi_pipeline_%d_%x' % (time.time(), id(self))
+        self._slot_bytes = 0
+        self._executor = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+        self._stats = {'submitted': 0,
+                       'completed': 0,
+                       'dropped': 0,
+                       'errors': 0,
+                       'output_overflows': 0,
+                       'latency_mean': 0.}
+
+    @classmethod
+    def from_api(cls, api, fn, serial=None, force_host=None, **kwargs):
+        """
+        Creates a FramePipeline of the image stream of the given (default the first) camera
+        """
+        _require_shared_memory('FramePipeline')  # before opening the stream
+        return cls(api.get_stream(serial, force_host=force_host), fn, **kwargs)
+
+    @property
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['in_flight'] = self._max_in_flight - len(self._free)
+        return s
+
+    def start(self):
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self._processes,
+                                                                mp_context=self._mp_context,
+                                                                initializer=_worker_init,
+                                                                initargs=(self._shm_name,))
+        # start the processes now rather than on the first frames
+        try:
+            for f in [self._executor.submit(_worker_noop) for _ in range(self._processes)]:
+                f.result()
+        except BrokenProcessPool:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise
+
+        self._thread = threading.Thread(target=self._run, name='FramePipeline')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, close=True):
+        """
+        Stops receiving frames, waits for the frames being processed, then closes the stream
+        (unless close is False)
+        """
+        self._stop.set()
+        with self._lock:
+            self._slot_free.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        if close:
+            self._streamer.close()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def get_next_result(self, block=True, timeout=None):
+        """
+        Returns the next PipelineResult, or None if block is False or none is ready within timeout seconds.
+        Raises the error of the pipeline if it failed
+        """
+        try:
+            r = self._output.get(block, timeout)
+        except queue.Empty:
+            return None
+        if r is _FAILED:
+            # (for the next call)
+            self._put(r)
+            raise self._error
+        return r
+
+    def __iter__(self):
+        while True:
+            yield self.get_next_result()
+
+    def _create_slots(self, nbytes):
+        # slots are sized by the first frame
+        self._slot_bytes = ((nbytes + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+        self._shm = _shared_memory(self._shm_name, create=True, size=self._slot_bytes * self._max_in_flight)
+        LOG.info('processing frames in %d processes (%d x %d bytes shared)' % (
+            self._processes, self._max_in_flight, self._slot_bytes))
+
+    def _take_slot(self):
+        with self._lock:
+            while not self._free:
+                if self._overload == FramePipeline.OVERLOAD_DROP or self._stop.is_set():
+                    return None
+                self._slot_free.wait()
+            return self._free.pop()
+
+    def _failed(self, e):
+        with self._lock:
+            if self._error is not None:
+                return
+            self._error = e
+            self._stop.set()
+            self._slot_free.notify_all()
+        LOG.error('frame pipeline failed: %r' % (e,))
+        self._put(_FAILED)
+
+    def _discard(self, sock):
+        sock.recv(copy=False)
+        with self._lock:
+            self._stats['dropped'] += 1
+
+    def _run(self):
+        sock = self._streamer.stream
+        timeout_ms = int(self.STOP_POLL_INTERVAL * 1000)
+        while not self._stop.is_set():
+            if not sock.poll(timeout_ms, zmq.POLLIN):
+                continue
+
+            md = sock.recv_json()
+            shape = tuple(md.pop('shape'))
+            dtype = np.dtype(md.pop('dtype'))
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            self._streamer._track(md)
+
+            if self._shm is None:
+                self._create_slots(nbytes)
+            elif nbytes > self._slot_bytes:
+                LOG.warning('discarding frame of %d bytes, larger than the first' % nbytes)
+                self._discard(sock)
+                continue
+
+            slot = self._take_slot()
+            if slot is None:
+                self._discard(sock)
+                continue
+
+            offset = slot * self._slot_bytes
+            buf = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+            try:
+                _recv_into(sock, buf)
+            except ValueError as e:
+                LOG.warning('discarding frame: %s' % e)
+                del buf
+                self._release(slot)
+                with self._lock:
+                    self._stats['dropped'] += 1
+                continue
+            del buf
+
+            with self._lock:
+                seq = self._next_seq
+                self._next_seq += 1
+                self._stats['submitted'] += 1
+
+            t0 = time.perf_counter()
+            try:
+                f = self._executor.submit(_worker_run, self._fn, offset, shape, dtype, md)
+            except BrokenProcessPool as e:
+                self._release(slot)
+                self._failed(e)
+                break
+            f.add_done_callback(lambda f, seq=seq, slot=slot, md=md, t0=t0: self._completed(f, seq, slot, md, t0))
+
+    def _release(self, slot):
+        with self._lock:
+            self._free.append(slot)
+            self._slot_free.notify()
+
+    def _completed(self, f, seq, slot, md, t0):
+        # (called from the executor's thread)
+        self._release(slot)
+
+        try:
+            r = PipelineResult(f.result(), md)
+        except BrokenProcessPool as e:
+            self._failed(e)
+            r = None
+        except Exception as e:
+            LOG.warning('error processing frame %s: %r' % (md.get('frame_number'), e))
+            r = None
+
+        # results are emitted under _emit_lock, as frames may also complete on the receiving
+        # thread (if already done when submitted)
+        with self._emit_lock:
+            with self._lock:
+                s = self._stats
+                if r is None:
+                    s['errors'] += 1
+                else:
+                    s['completed'] += 1
+                    s['latency_mean'] += ((time.perf_counter() - t0) - s['latency_mean']) / s['completed']
+
+                if not self._ordered:
+                    ready = [r]
+                else:
+                    self._done[seq] = r
+                    ready = []
+                    while self._next_out in self._done:
+                        ready.append(self._done.pop(self._next_out))
+                        self._next_out += 1
+
+            for r in ready:
+                if r is not None:
+                    self._emit(r)
+
+    def _emit(self, r):
+        if self._callback is not None:
+            try:
+                self._callback(r)
+            except Exception:
+                LOG.exception('error in pipeline callback')
+            return
+        self._put(r)
+
+    def _put(self, r):
+        while True:
+            try:
+                self._output.put_nowait(r)
+                return
+            except queue.Full:
+                try:
+                    self._output.get_nowait()
+                    with self._lock:
+                        self._stats['output_overflows'] += 1
+                except queue.Empty:
+                    pass
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+import numpy as np
+
+LOG = logging.getLogger('motifapi.recorder')
+
+INDEX_DTYPE = np.dtype([('frame_number', '<i8'), ('frame_time', '<f8'), ('offset', '<i8')])
+
+LAYOUT_FILENAME = 'layout.json'
+METADATA_FILENAME = 'metadata.jsonl'
+
+
+def _chunk_filenames(path, n):
+    return os.path.join(path, 'chunk_%06d.raw' % n), os.path.join(path, 'chunk_%06d.idx' % n)
+
+
+def _preallocate(filename, nbytes):
+    with open(filename, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, nbytes)
+        except (AttributeError, OSError):
+            # not supported by the platform or filesystem, a sparse file will do
+            f.truncate(nbytes)
+
+
+class StreamRecorder(object):
+    """
+    Records frames from the realtime image stream (e.g. for offline algorithm tuning) to a
+    directory of preallocated, memory mapped, chunk files of chunk_frames frames each, plus an
+    index of the frame_number, frame_time and byte offset of every frame. The remaining frame
+    metadata is saved as JSON lines if save_metadata is True.
+
+    Frames are written by a background thread. record() only queues the frame, so images must not
+    be modified after being passed. Read-only images, such as the views of a FrameRing (an
+    ImageStreamer with ring_size) which are reused as frames arrive, are copied before queueing.
+    If queue_size frames are waiting to be written, further frames are discarded and counted in
+    dropped. missing counts the frames lost before reaching the recorder
+    (gaps in frame_number).
+    """
+
+    def __init__(self, path, chunk_frames=500, queue_size=256, save_metadata=True):
+        if os.path.exists(os.path.join(path, LAYOUT_FILENAME)):
+            raise ValueError('%s already contains a recording' % path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.chunk_frames = chunk_frames
+
+        self.frames = 0
+        self.dropped = 0
+        self.missing = 0
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._last_frame_number = None
+        self._layout = None
+        self._chunk = self._index = None
+        self._nchunks = 0
+        self._slot = 0
+        self._md = open(os.path.join(path, METADATA_FILENAME), 'w') if save_metadata else None
+
+        self._thread = threading.Thread(target=self._run, name='StreamRecorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, image, md):
+        """
+        Queues the frame to be written. Returns False if it was discarded because the writer has fallen behind
+        """
+        fn = md.get('frame_number')
+        if fn is not None:
+            last = self._last_frame_number
+            if (last is not None) and (fn > (last + 1)):
+                self.missing += fn - last - 1
+            self._last_frame_number = fn
+
+        if self._queue.full():
+            self._drop()
+            return False
+        if not image.flags.writeable:
+            # a view of a buffer the streamer reuses, it would change before being written
+            image = image.copy()
+        try:
+            self._queue.put_nowait((image, md))
+            return True
+        except queue.Full:
+            self._drop()
+            return False
+
+    def _drop(self):
+        # counted by both record() and the writer thread
+        with self._lock:
+            self.dropped += 1
+
+    def capture(self, streamer, n_frames=None, duration=None):
+        """
+        Receives frames from the ImageStreamer and records them until n_frames frames were received
+        or duration seconds have passed (or forever)
+        """
+        n = 0
+        t0 = time.monotonic()
+        while True:
+            timeout = None
+            if duration is not None:
+                timeout = duration - (time.monotonic() - t0)
+                if timeout <= 0:
+                    break
+            I, md = streamer.get_next_image(timeout=timeout)
+            if I is not None:
+                self.record(I, md)
+                n += 1
+                if (n_frames is not None) and (n >= n_frames):
+                    break
+        return n
+
+    def _write_layout(self):
+        layout = dict(self._layout)
+        layout['chunks'] = self._nchunks
+        layout['frames'] = self.frames
+        with open(os.path.join(self.path, LAYOUT_FILENAME), 'w') as f:
+            json.dump(layout, f)
+
+    def _flush_chunk(self):
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._index.flush()
+            self._chunk = self._index = None
+
+    def _next_chunk(self):
+        self._flush_chunk()
+
+        shape = tuple(self._layout['shape'])
+        dtype = np.dtype(self._layout['dtype'])
+        chunk_fn, index_fn = _chunk_filenames(self.path, self._nchunks)
+
+        _preallocate(chunk_fn, self.chunk_frames * self._layout['frame_nbytes'])
+        self._chunk = np.memmap(chunk_fn, dtype=dtype, mode='r+', shape=(self.chunk_frames,) + shape)
+
+        _preallocate(index_fn, self.chunk_frames * INDEX_DTYPE.itemsize)
+        self._index = np.memmap(index_fn, dtype=INDEX_DTYPE, mode='r+', shape=(self.chunk_frames,))
+        self._index['frame_number'] = -1
+
+        self._nchunks += 1
+        self._slot = 0
+
+    def _write(self, image, md):
+        if self._layout is None:
+            self._layout = {'shape': list(image.shape),
+                            'dtype': image.dtype.str,
+                            'frame_nbytes': image.nbytes,
+                            'chunk_frames': self.chunk_frames}
+            self._write_layout()
+        elif (list(image.shape) != self._layout['shape']) or (image.dtype.str != self._layout['dtype']):
+            LOG.warning('discarding frame of different shape %r or type %s' % (image.shape, image.dtype))
+            self._drop()
+            return
+
+        if (self._chunk is None) or (self._slot == self.chunk_frames):
+            self._next_chunk()
+
+        i = self._slot
+        self._chunk[i] = image
+        self._index[i] = (md.get('frame_number', self.frames), md.get('frame_time', np.nan),
+                          i * self._layout['frame_nbytes'])
+        self._slot += 1
+        self.frames += 1
+
+        if self._md is not None:
+            self._md.write(json.dumps(md))
+            self._md.write('\n')
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception:
+                LOG.exception('error writing frame')
+                self._drop()
+
+    def close(self):
+        """
+        Writes all queued frames and closes the recording
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._flush_chunk()
+        if self._layout is not None:
+            self._write_layout()
+        if self._md is not None:
+            self._md.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamReader(object):
+    """
+    Reads a recording made by StreamRecorder. Frames are returned as read-only views of the
+    memory mapped chunk files, without copying.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, LAYOUT_FILENAME), 'r') as f:
+            self._layout = json.load(f)
+
+        self.shape = tuple(self._layout['shape'])
+        self.dtype = np.dtype(self._layout['dtype'])
+        self.chunk_frames = self._layout['chunk_frames']
+
+        indexes = []
+        for n in range(self._layout['chunks']):
+            _, index_fn = _chunk_filenames(path, n)
+            indexes.append(np.fromfile(index_fn, dtype=INDEX_DTYPE))
+        index = np.concatenate(indexes) if indexes else np.empty(0, dtype=INDEX_DTYPE)
+
+        # position in the recording -> position in the chunks
+        self._positions = np.flatnonzero(index['frame_number'] >= 0)
+        self.frame_numbers = index['frame_number'][self._positions]
+        self.frame_times = index['frame_time'][self._positions]
+        self._order = np.argsort(self.frame_numbers, kind='stable')
+
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _chunk(self, n):
+        c = self._chunks.get(n)
+        if c is None:
+            chunk_fn, _ = _chunk_filenames(self.path, n)
+            c = np.memmap(chunk_fn, dtype=self.dtype, mode='r', shape=(self.chunk_frames,) + self.shape)
+            self._chunks[n] = c
+        return c
+
+    def __getitem__(self, i):
+        """
+        Returns (image, metadata) of the i'th recorded frame
+        """
+        pos = int(self._positions[i])
+        image = self._chunk(pos // self.chunk_frames)[pos % self.chunk_frames]
+        return image, {'frame_number': int(self.frame_numbers[i]), 'frame_time': float(self.frame_times[i])}
+
+    def get_frame(self, frame_number):
+        """
+        Returns (image, metadata) of the frame with the given frame_number
+        """
+        j = np.searchsorted(self.frame_numbers, frame_number, sorter=self._order)
+        if (j == len(self._order)) or (self.frame_numbers[self._order[j]] != frame_number):
+            raise KeyError(frame_number)
+        return self[self._order[j]]
+
+    def iter_metadata(self):
+        """
+        Yields the complete metadata of each frame (if it was saved)
+        """
+        with open(os.path.join(self.path, METADATA_FILENAME), 'r') as f:
+            for line in f:
+                yield json.loads(line)
@@ -0,0 +1,318 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+import collections
+
+from .api import MotifError
+
+LOG = logging.getLogger('motifapi.recordings')
+
+NEW = 'new'
+CHANGED = 'changed'
+FINISHED = 'finished'
+REMOVED = 'removed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    serial TEXT NOT NULL,
+    id TEXT NOT NULL,
+    time REAL NOT NULL,
+    finished INTEGER NOT NULL,
+    copied INTEGER NOT NULL,
+    marked_copied INTEGER NOT NULL DEFAULT 0,
+    first_seen REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (serial, id)
+);
+CREATE INDEX IF NOT EXISTS recordings_time ON recordings (serial, time);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    serial TEXT NOT NULL,
+    id TEXT NOT NULL,
+    kind TEXT NOT NULL
+);
+'''
+
+# the recording list entries are not versioned, these are the names known for each value
+_ID_KEYS = ('uuid', 'id', 'path', 'filename')
+_TIME_KEYS = ('start_time', 'time', 'timestamp', 'created')
+
+
+def _recording_id(r):
+    for k in _ID_KEYS:
+        v = r.get(k)
+        if v:
+            return str(v)
+    return None
+
+
+def _recording_time(r):
+    for k in _TIME_KEYS:
+        v = r.get(k)
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            return float(v)
+    return None
+
+
+def _recording_finished(r):
+    if r.get('is_recording'):
+        return False
+    return str(r.get('status', '')).lower() not in ('recording', 'pending')
+
+
+def _recording_copied(r):
+    if r.get('copied') or r.get('is_copied'):
+        return True
+    return 'copied' in str(r.get('status', '')).lower()
+
+
+class Recording(object):
+    """
+    A recording in the index. time is the start time of the recording if the server reports it,
+    otherwise the time it was first seen. data is the entry of the recordings list
+    """
+
+    __slots__ = ('serial', 'id', 'time', 'finished', 'copied', '_json', '_data')
+
+    def __init__(self, serial, id_, t, finished, copied, data_json):
+        self.serial = serial
+        self.id = id_
+        self.time = t
+        self.finished = bool(finished)
+        self.copied = bool(copied)
+        self._json = data_json
+        self._data = None
+
+    @property
+    def data(self):
+        # decoded when first needed, most queries only need the columns
+        if self._data is None:
+            self._data = json.loads(self._json)
+        return self._data
+
+    def __repr__(self):
+        return '<Recording %s %s%s%s>' % (self.serial, self.id, '' if self.finished else ' recording',
+                                          ' copied' if self.copied else '')
+
+
+class RecordingChange(object):
+    """
+    An entry of the change feed. kind is NEW, CHANGED, FINISHED or REMOVED
+    """
+
+    __slots__ = ('seq', 'time', 'serial', 'id', 'kind')
+
+    def __init__(self, seq, t, serial, id_, kind):
+        self.seq = seq
+        self.time = t
+        self.serial = serial
+        self.id = id_
+        self.kind = kind
+
+    def __repr__(self):
+        return '<RecordingChange %d %s %s %s>' % (self.seq, self.kind, self.serial, self.id)
+
+
+class RecordingsIndex(object):
+    """
+    A local index of the recordings of all (or the given) cameras, persisted in the SQLite
+    database path (default in memory), e.g. for an archival job
+
+        index = RecordingsIndex(api, 'recordings.db')
+        index.refresh()
+        for r in index.query(serial='FAKE0', since=t0, copied=False):
+            ...
+
+    refresh() fetches the recordings lists of the cameras concurrently, and writes only the
+    recordings which are new, changed or removed since the last refresh, adding them to a change
+    feed which is read with changes(since=seq). Queries are answered from the index without
+    contacting motif.
+
+    The index is safe to use from many threads.
+    """
+
+    def __init__(self, api, path=':memory:', serials=None):
+        self._api = api
+        self._serials = serials
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+        # serial -> {id: data json}, to find the changed recordings without reading the database
+        self._known = collections.defaultdict(dict)
+        for serial, id_, data in self._db.execute('SELECT serial, id, data FROM recordings'):
+            self._known[serial][id_] = data
+
+    @property
+    def serials(self):
+        if self._serials is None:
+            return [c['serial'] for c in self._api.call('cameras').get('cameras', [])]
+        return self._serials
+
+    @property
+    def last_seq(self):
+        # (the feed may have been trimmed)
+        with self._lock:
+            row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return 0 if row is None else row[0]
+
+    def _fetch(self, serial):
+        return self._api.call('camera/%s/recordings' % serial).get('recordings', [])
+
+    def refresh(self, serials=None):
+        """
+        Updates the index from motif, returns the list of RecordingChanges. Cameras whose
+        recordings could not be fetched are left unchanged
+        """
+        serials = list(self.serials if serials is None else serials)
+        executor = self._api._get_executor()
+        futs = [(sn, executor.submit(self._fetch, sn)) for sn in serials]
+
+        changes = []
+        for sn, f in futs:
+            try:
+                recordings = f.result()
+            except MotifError as e:
+                LOG.warning('could not fetch the recordings of %s: %s' % (sn, e))
+                continue
+            with self._refresh_lock:
+                changes.extend(self._update(sn, recordings))
+        return changes
+
+    def _update(self, serial, recordings):
+        now = time.time()
+        known = self._known[serial]
+        seen = set()
+        upserts = []
+        feed = []
+
+        for r in recordings:
+            id_ = _recording_id(r)
+            if id_ is None:
+                continue
+            seen.add(id_)
+            data = json.dumps(r, sort_keys=True)
+            old = known.get(id_)
+            if old == data:
+                continue
+
+            finished = _recording_finished(r)
+            if old is None:
+                kind = NEW
+            elif finished and not _recording_finished(json.loads(old)):
+                kind = FINISHED
+            else:
+                kind = CHANGED
+            upserts.append((serial, id_, _recording_time(r), int(finished), int(_recording_copied(r)),
+                            now, data))
+            feed.append((now, serial, id_, kind))
+
+        removed = [id_ for id_ in known if id_ not in seen]
+        feed.extend((now, serial, id_, REMOVED) for id_ in removed)
+
+        if not feed:
+            return []
+
+        with self._lock:
+            db = self._db
+            with db:
+                # (first_seen and marked_copied are kept for existing recordings, as is the
+                # time if the server does not report it)
+                db.executemany('INSERT OR IGNORE INTO recordings (serial, id, time, finished, copied, first_seen, data) '
+                               'VALUES (?1, ?2, COALESCE(?3, ?6), ?4, ?5, ?6, ?7)', upserts)
+                db.executemany('UPDATE recordings SET time=COALESCE(?, time), finished=?, copied=?, data=? '
+                               'WHERE serial=? AND id=?',
+                               [(t, f, c, d, sn, i) for sn, i, t, f, c, _, d in upserts])
+                db.executemany('DELETE FROM recordings WHERE serial=? AND id=?', [(serial, i) for i in removed])
+                db.executemany('INSERT INTO changes (time, serial, id, kind) VALUES (?, ?, ?, ?)', feed)
+                last = db.execute('SELECT MAX(seq) FROM changes').fetchone()[0]
+
+            for row in upserts:
+                known[row[1]] = row[6]
+            for id_ in removed:
+                del known[id_]
+
+        first = last - len(feed) + 1
+        return [RecordingChange(first + i, *c) for i, c in enumerate(feed)]
+
+    def changes(self, since=0, limit=None):
+        """
+        Returns the RecordingChanges after the sequence number since, oldest first
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT seq, time, serial, id, kind FROM changes WHERE seq > ? '
+                                    'ORDER BY seq LIMIT ?', (since, -1 if limit is None else limit)).fetchall()
+        return [RecordingChange(*row) for row in rows]
+
+    def trim_changes(self, before):
+        """
+        Removes the changes up to and including the sequence number before from the feed
+        """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM changes WHERE seq <= ?', (before,))
+
+    def query(self, serial=None, since=None, until=None, finished=None, copied=None):
+        """
+        Returns the Recordings matching all the given conditions, oldest first. since and until
+        are times (seconds since the epoch)
+        """
+        where = []
+        args = []
+        if serial is not None:
+            where.append('serial = ?')
+            args.append(serial)
+        if since is not None:
+            where.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('time < ?')
+            args.append(until)
+        if finished is not None:
+            where.append('finished = ?')
+            args.append(int(bool(finished)))
+        if copied is not None:
+            where.append('(copied OR marked_copied) = ?')
+            args.append(int(bool(copied)))
+
+        sql = 'SELECT serial, id, time, finished, copied OR marked_copied, data FROM recordings'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            rows = self._db.execute(sql + ' ORDER BY time', args).fetchall()
+        return [Recording(*row) for row in rows]
+
+    def get(self, serial, id_):
+        """
+        Returns the Recording, or None if it is not in the index
+        """
+        with self._lock:
+            row = self._db.execute('SELECT serial, id, time, finished, copied OR marked_copied, data '
+                                   'FROM recordings WHERE serial = ? AND id = ?', (serial, id_)).fetchone()
+        return None if row is None else Recording(*row)
+
+    def mark_copied(self, serial, id_, copied=True):
+        """
+        Records locally that the recording was (or was not) copied, e.g. by an archival job
+        """
+        with self._lock, self._db:
+            self._db.execute('UPDATE recordings SET marked_copied = ? WHERE serial = ? AND id = ?',
+                             (int(bool(copied)), serial, id_))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,2 +1,538 @@
+import time
+import bisect
+import logging
+import datetime
+import calendar
+import collections
+
+from .api import MotifApi, MotifError
+
+LOG = logging.getLogger('motifapi.schedule')
+
+
 def datetime_to_cron(dt):
     return '%d %d %d %d %d ?' % (dt.second, dt.minute, dt.hour, dt.day, dt.month)
+
+
+_MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_abbr) if m}
+_DAYS = {'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5, 'sat': 6}
+
+# (name, min, max, names) of each field
+_FIELDS = (('second', 0, 59, None),
+           ('minute', 0, 59, None),
+           ('hour', 0, 23, None),
+           ('day', 1, 31, None),
+           ('month', 1, 12, _MONTHS),
+           ('weekday', 0, 7, _DAYS),
+           ('year', 1970, 2199, None))
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_SECOND = datetime.timedelta(seconds=1)
+
+
+class _Field(object):
+    """
+    One field of a cron expression: the set of values, monotonic (offset, step) triggers, and
+    for the day fields the last day of the month (L), last weekday (nL) and nth weekday (n#k)
+    """
+
+    def __init__(self, expr, name, lo, hi, names):
+        self.expr = expr
+        self.wildcard = expr in ('*', '?')
+        self.values = set()
+        self.monotonic = []
+        self.last_day = False
+        self.last_weekdays = set()
+        self.nth_weekdays = set()  # (weekday, n)
+        if self.wildcard:
+            return
+
+        def value(s):
+            s = s.lower()
+            if names and (s in names):
+                return names[s]
+            try:
+                v = int(s)
+            except ValueError:
+                raise ValueError('invalid %s in cron expression: %s' % (name, expr))
+            if not (lo <= v <= hi):
+                raise ValueError('%s out of range (%d-%d) in cron expression: %s' % (name, lo, hi, expr))
+            return v
+
+        for item in expr.split(','):
+            if '%' in item:
+                if name == 'weekday':
+                    raise ValueError('monotonic triggers are not supported for the day of the week: %s' % expr)
+                offset, step = item.split('%', 1)
+                self.monotonic.append((int(offset or 0), int(step)))
+                if int(step) < 1:
+                    raise ValueError('invalid monotonic step in cron expression: %s' % expr)
+            elif (name == 'day') and (item.upper() == 'L'):
+                self.last_day = True
+            elif (name == 'weekday') and item.upper().endswith('L'):
+                self.last_weekdays.add(value(item[:-1]) % 7)
+            elif (name == 'weekday') and ('#' in item):
+                d, n = item.split('#', 1)
+                self.nth_weekdays.add((value(d) % 7, int(n)))
+            else:
+                step = 1
+                if '/' in item:
+                    item, step = item.split('/', 1)
+                    step = int(step)
+                    if step < 1:
+                        raise ValueError('invalid step in cron expression: %s' % expr)
+                if item in ('*', '?'):
+                    first, last = lo, hi
+                elif '-' in item:
+                    first, last = (value(v) for v in item.split('-', 1))
+                else:
+                    first = value(item)
+                    last = hi if step > 1 else first
+                self.values.update(range(first, last + 1, step))
+
+        if name == 'weekday' and 7 in self.values:
+            self.values.add(0)
+
+    def matches(self, v, elapsed=None):
+        if self.wildcard or (v in self.values):
+            return True
+        for offset, step in self.monotonic:
+            if (elapsed >= offset) and (((elapsed - offset) % step) == 0):
+                return True
+        return False
+
+
+class CronExpression(object):
+    """
+    Evaluates a motif (cronex) cron expression locally: six fields, second minute hour day month
+    weekday, and an optional seventh year field. Five fields are read as standard cron (minute
+    first, at second 0).
+
+    Supports *, ?, lists, ranges, steps, month and weekday names, L (last day of the month), nL
+    (last weekday n of the month), n#k (the kth weekday n of the month) and monotonic triggers
+    (offset%step), which count from epoch (default 1-Jan-1970, or the start of recording for
+    camera_relative tasks). Times are naive datetimes in the time of the motif system. If both
+    the day of the month and the day of the week are restricted, either may match.
+    """
+
+    def __init__(self, expression, epoch=None):
+        self.expression = expression
+        parts = expression.split()
+        if len(parts) == 5:
+            parts = ['0'] + parts
+        if len(parts) == 6:
+            parts.append('*')
+        if len(parts) != 7:
+            raise ValueError('cron expressions have six (or seven) fields: %s' % expression)
+        self.epoch = _EPOCH if epoch is None else epoch
+        (self.second, self.minute, self.hour, self.day,
+         self.month, self.weekday, self.year) = [_Field(p, *f) for p, f in zip(parts, _FIELDS)]
+
+    def __repr__(self):
+        return '<CronExpression %s>' % self.expression
+
+    def _day_matches(self, dt):
+        dom = self.day
+        dow = self.weekday
+        days_in_month = calendar.monthrange(dt.year, dt.month)[1]
+        if dom.wildcard and dow.wildcard:
+            return True
+
+        d = (dt - self.epoch).days if dom.monotonic else None
+        dom_ok = (not dom.wildcard) and (dom.matches(dt.day, d) or (dom.last_day and dt.day == days_in_month))
+
+        weekday = (dt.weekday() + 1) % 7
+        dow_ok = (not dow.wildcard) and ((weekday in dow.values) or
+                                         ((weekday in dow.last_weekdays) and (dt.day + 7 > days_in_month)) or
+                                         ((weekday, (dt.day + 6) // 7) in dow.nth_weekdays))
+        if dom.wildcard:
+            return dow_ok
+        if dow.wildcard:
+            return dom_ok
+        return dom_ok or dow_ok
+
+    def _elapsed(self, dt, seconds):
+        return int((dt - self.epoch).total_seconds()) // seconds
+
+    def _year_ok(self, dt):
+        return self.year.matches(dt.year, dt.year - self.epoch.year)
+
+    def _month_ok(self, dt):
+        return self.month.matches(dt.month, (dt.year - self.epoch.year) * 12 + dt.month - self.epoch.month)
+
+    def _hour_ok(self, dt):
+        return self.hour.matches(dt.hour, self._elapsed(dt, 3600) if self.hour.monotonic else None)
+
+    def _minute_ok(self, dt):
+        return self.minute.matches(dt.minute, self._elapsed(dt, 60) if self.minute.monotonic else None)
+
+    def _second_ok(self, dt):
+        return self.second.matches(dt.second, self._elapsed(dt, 1) if self.second.monotonic else None)
+
+    def matches(self, dt):
+        return self._year_ok(dt) and self._month_ok(dt) and self._day_matches(dt) and \
+            self._hour_ok(dt) and self._minute_ok(dt) and self._second_ok(dt)
+
+    def next(self, after=None):
+        """
+        Returns the first time (a naive datetime) after after (default now) at which the
+        expression fires, or None if it never does again
+        """
+        if after is None:
+            after = datetime.datetime.now()
+        t = after.replace(microsecond=0) + _ONE_SECOND
+        # (impossible expressions, e.g. the 30th of February, would search forever)
+        limit = t.year + (8 if self.year.wildcard else 200)
+
+        while t.year <= limit:
+            if not self._year_ok(t):
+                t = datetime.datetime(t.year + 1, 1, 1)
+            elif not self._month_ok(t):
+                t = datetime.datetime(t.year + (t.month == 12), (t.month % 12) + 1, 1)
+            elif not self._day_matches(t):
+                t = datetime.datetime(t.year, t.month, t.day) + datetime.timedelta(days=1)
+            elif not self._hour_ok(t):
+                t = t.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+            elif not self._minute_ok(t):
+                t = t.replace(second=0) + datetime.timedelta(minutes=1)
+            elif not self._second_ok(t):
+                t += _ONE_SECOND
+            else:
+                return t
+        return None
+
+    def next_times(self, n, after=None):
+        """
+        Returns the next n (or fewer, if it stops firing) times at which the expression fires
+        """
+        out = []
+        t = after
+        while len(out) < n:
+            t = self.next(t)
+            if t is None:
+                break
+            out.append(t)
+        return out
+
+    def times_between(self, start, end, max_times=None):
+        """
+        Returns the times in (start, end] at which the expression fires, at most max_times
+        """
+        out = []
+        t = start
+        while (max_times is None) or (len(out) < max_times):
+            t = self.next(t)
+            if (t is None) or (t > end):
+                break
+            out.append(t)
+        return out
+
+
+class ScheduledTask(object):
+    """
+    A task to be scheduled: the endpoint (e.g. 'recording/start' or
+    'camera/<serial>/recordings/copy_all', with or without the 'schedule/' prefix) called at the
+    times of cron_expression, with the given arguments (e.g. duration, or camera_relative)
+    """
+
+    __slots__ = ('task_name', 'endpoint', 'cron_expression', 'arguments', '_cron', '_route')
+
+    def __init__(self, task_name, endpoint, cron_expression, **arguments):
+        if endpoint.startswith('schedule/'):
+            endpoint = endpoint[len('schedule/'):]
+        route = MotifApi.get_router().resolve('schedule/' + endpoint)
+        if (route is None) or (endpoint.split('/')[-1] == 'clear'):
+            raise ValueError("endpoint '%s' can not be scheduled" % endpoint)
+
+        self.task_name = task_name
+        self.endpoint = endpoint
+        self.cron_expression = cron_expression
+        self.arguments = arguments
+        self._route = route
+        self._cron = CronExpression(cron_expression)
+
+    @property
+    def cron(self):
+        return self._cron
+
+    @property
+    def serials(self):
+        """
+        The cameras the task acts on, or None for all
+        """
+        sn = self._route.params.get('serial')
+        return None if sn is None else {sn}
+
+    @property
+    def camera_relative(self):
+        return bool(self.arguments.get('camera_relative', False))
+
+    @property
+    def action(self):
+        # 'recording/start', 'recordings/copy_all', 'io/<name>/set', ...
+        parts = self.endpoint.split('/')
+        if parts[0] == 'camera':
+            parts = parts[2:]
+        return '/'.join(parts)
+
+    @property
+    def duration(self):
+        d = self.arguments.get('duration')
+        return None if d is None else float(d)
+
+    def __eq__(self, other):
+        return isinstance(other, ScheduledTask) and \
+            (self.task_name, self.endpoint, self.cron_expression, self.arguments) == \
+            (other.task_name, other.endpoint, other.cron_expression, other.arguments)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.task_name, self.endpoint, self.cron_expression))
+
+    def __repr__(self):
+        return '<ScheduledTask %s %s "%s">' % (self.task_name, self.endpoint, self.cron_expression)
+
+
+def _same_task(task, existing):
+    # a task whose listing lacks what is needed to compare it is taken as changed (and
+    # scheduled again), rather than possibly leaving a changed task unchanged
+    missing = [k for k in ('cron_expression', 'endpoint', 'arguments') if existing.get(k) is None]
+    if missing:
+        LOG.warning('schedule does not report the %s of task %s, scheduling it again' %
+                    (', '.join(missing), task.task_name))
+        return False
+    return (existing['cron_expression'] == task.cron_expression) and \
+        (existing['endpoint'].replace('schedule/', '', 1) == task.endpoint) and \
+        (existing['arguments'] == task.arguments)
+
+
+class ScheduleConflict(object):
+    """
+    A recording which overlaps another (kind 'recording'), or a copy or export while a camera is
+    recording (kind 'copy' or 'export'). time is the first time the conflict occurs
+    """
+
+    __slots__ = ('kind', 'task', 'other', 'time')
+
+    def __init__(self, kind, task, other, t):
+        self.kind = kind
+        self.task = task
+        self.other = other
+        self.time = t
+
+    def __repr__(self):
+        return '<ScheduleConflict %s %s/%s at %s>' % (self.kind, self.task.task_name, self.other.task_name,
+                                                      self.time.isoformat())
+
+
+class ScheduleConflictError(ValueError):
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        ValueError.__init__(self, 'conflicting scheduled tasks: %s' % ', '.join(repr(c) for c in conflicts))
+
+
+def _overlaps(a, b):
+    return (a is None) or (b is None) or bool(a & b)
+
+
+def find_conflicts(tasks, now=None, horizon=7 * 86400, max_times=10000):
+    """
+    Returns the ScheduleConflicts of the tasks within the horizon (seconds) after now (a naive
+    datetime in motif time, default now): recordings (with a duration) which overlap on the same
+    camera, and copies or exports started while a camera is recording.
+
+    camera_relative tasks are not checked, as their times depend on when recording starts.
+    Recordings without a duration are only checked for starting at the same time.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    end = now + datetime.timedelta(seconds=horizon)
+
+    recordings = []  # (start, end, task)
+    transfers = []  # (time, task)
+    for task in tasks:
+        if task.camera_relative:
+            continue
+        action = task.action
+        if action == 'recording/start':
+            d = datetime.timedelta(seconds=task.duration or 0)
+            for t in task.cron.times_between(now, end, max_times):
+                recordings.append((t, t + d, task))
+        elif action in ('recordings/copy_all', 'recordings/export_all'):
+            for t in task.cron.times_between(now, end, max_times):
+                transfers.append((t, task))
+
+    conflicts = collections.OrderedDict()  # (kind, task, other) -> ScheduleConflict, the first of each
+
+    def add(kind, task, other, t):
+        key = (kind, task.task_name, other.task_name)
+        if key not in conflicts:
+            conflicts[key] = ScheduleConflict(kind, task, other, t)
+
+    recordings.sort(key=lambda r: r[0])
+    active = []
+    for start, stop, task in recordings:
+        active = [r for r in active if (r[1] > start) or (r[0] == start)]
+        for s, e, other in active:
+            if _overlaps(task.serials, other.serials):
+                add('recording', task, other, start)
+        active.append((start, stop, task))
+
+    starts = [r[0] for r in recordings]
+    longest = max([r[1] - r[0] for r in recordings] or [datetime.timedelta(0)])
+    for t, task in transfers:
+        kind = 'copy' if task.action == 'recordings/copy_all' else 'export'
+        # recordings which started before t, and may still be running
+        i = bisect.bisect_right(starts, t)
+        j = bisect.bisect_left(starts, t - longest)
+        for s, e, other in recordings[j:i]:
+            if (s <= t < e) and _overlaps(task.serials, other.serials):
+                add(kind, task, other, t)
+
+    return sorted(conflicts.values(), key=lambda c: c.time)
+
+
+class ScheduleDiff(object):
+    """
+    The changes needed to make the schedule match the desired tasks. add are the ScheduledTasks to
+    schedule, delete the names of the tasks to clear (including changed tasks, which are also in
+    add), and unchanged the names of tasks already as desired. After apply, errors is
+    {task_name: exception} of the changes which failed.
+    """
+
+    def __init__(self, add, delete, unchanged):
+        self.add = add
+        self.delete = delete
+        self.unchanged = unchanged
+        self.errors = {}
+
+    @property
+    def empty(self):
+        return not (self.add or self.delete)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return '<ScheduleDiff add=%d delete=%d unchanged=%d errors=%d>' % (
+            len(self.add), len(self.delete), len(self.unchanged), len(self.errors))
+
+
+class ScheduleManager(object):
+    """
+    Makes the schedule of a motif system match a desired set of ScheduledTasks, e.g.
+
+        tasks = [ScheduledTask('record', 'recording/start', '0 0 9-16 * * *', duration=30 * 60),
+                 ScheduledTask('copy', 'recordings/copy_all', '0 0 17 * * *')]
+        diff = ScheduleManager(api).apply(tasks)
+
+    The schedule is read once, then the desired tasks are (re)scheduled and the tasks no longer
+    desired are cleared, concurrently. Tasks are identified by task_name. The contents of the
+    schedule listing are not documented, so by default every desired task is cleared and
+    scheduled again. If compare is True tasks listed with the same cron_expression, endpoint and
+    arguments are left as they are, only use this with motif versions which list them.
+
+    If prune is True tasks not in the desired set are cleared, only those whose names start with
+    prefix. Without a prefix, prune clears every other task on the system, including those
+    scheduled by others sharing it.
+
+    Cron expressions are evaluated in the timezone of the motif system, tz (a datetime.tzinfo),
+    default the local timezone of this computer.
+    """
+
+    def __init__(self, api, prefix=None, prune=False, tz=None, compare=False):
+        self._api = api
+        self._prefix = prefix
+        self._prune = prune
+        self._tz = tz
+        self._compare = compare
+
+    def fetch(self):
+        """
+        Returns ({task_name: task}, now) of the scheduled tasks, and the time (a naive datetime
+        in the timezone tz) on the motif system
+        """
+        r = self._api.call('schedule')
+        tasks = r.get('tasks', []) if isinstance(r, dict) else r
+        now = r.get('now') if isinstance(r, dict) else None
+        now = datetime.datetime.fromtimestamp(time.time() if now is None else now, self._tz)
+        if self._tz is not None:
+            now = now.replace(tzinfo=None)
+        return collections.OrderedDict((t['task_name'], t) for t in tasks), now
+
+    def diff(self, desired, existing=None):
+        """
+        Returns the ScheduleDiff to change the existing (default fetched) schedule to the desired tasks
+        """
+        if existing is None:
+            existing, _ = self.fetch()
+        names = set()
+        add = []
+        delete = []
+        unchanged = []
+        for task in desired:
+            if task.task_name in names:
+                raise ValueError('duplicate task_name: %s' % task.task_name)
+            names.add(task.task_name)
+            current = existing.get(task.task_name)
+            if current is None:
+                add.append(task)
+            elif self._compare and _same_task(task, current):
+                unchanged.append(task.task_name)
+            else:
+                delete.append(task.task_name)
+                add.append(task)
+        if self._prune:
+            delete.extend(n for n in existing if (n not in names) and
+                          ((self._prefix is None) or n.startswith(self._prefix)))
+        return ScheduleDiff(add, delete, unchanged)
+
+    def check(self, desired, now=None, **kwargs):
+        """
+        Returns the ScheduleConflicts of the desired tasks (see find_conflicts)
+        """
+        return find_conflicts(desired, now=now, **kwargs)
+
+    def _run(self, diff, calls):
+        # [(task_name, endpoint, kwargs), ...] concurrently, recording failures in diff.errors
+        executor = self._api._get_executor()
+        futs = [(name, executor.submit(self._api.call, endpoint, **kwargs)) for name, endpoint, kwargs in calls]
+        for name, f in futs:
+            try:
+                f.result()
+            except Exception as e:
+                LOG.warning('could not update scheduled task %s: %s' % (name, e))
+                diff.errors[name] = e
+
+    def apply(self, desired, check=True, dry_run=False):
+        """
+        Changes the schedule to the desired tasks, and returns the ScheduleDiff. If check is True
+        the tasks are first checked for conflicts, raising ScheduleConflictError if there are any.
+        If dry_run is True nothing is changed
+        """
+        desired = list(desired)
+        existing, now = self.fetch()
+        if check:
+            conflicts = self.check(desired, now=now)
+            if conflicts:
+                raise ScheduleConflictError(conflicts)
+
+        diff = self.diff(desired, existing)
+        if dry_run or diff.empty:
+            return diff
+
+        def schedule(task):
+            kwargs = dict(task.arguments)
+            kwargs.update(task_name=task.task_name, cron_expression=task.cron_expression)
+            return task.task_name, 'schedule/' + task.endpoint, kwargs
+
+        # changed tasks are cleared before they are scheduled again, everything else at once
+        changed = set(diff.delete).intersection(t.task_name for t in diff.add)
+        self._run(diff, [(n, 'schedule/%s/clear' % n, {}) for n in diff.delete] +
+                  [schedule(t) for t in diff.add if t.task_name not in changed])
+        self._run(diff, [schedule(t) for t in diff.add if (t.task_name in changed) and (t.task_name not in diff.errors)])
+        return diff
@@ -0,0 +1,345 @@
+import mmap
+import time
+import logging
+import threading
+
+import zmq
+import numpy as np
+
+from .stream import ImageStreamer, _recv_into, _poll_timeout
+
+LOG = logging.getLogger('motifapi.sharedframes')
+
+# header of the shared memory segment, int64s
+_MAGIC = 0x6d6f74696672616d  # 'motifram'
+_H_MAGIC, _H_SLOTS, _H_SLOT_BYTES, _H_DATA_OFFSET, _H_PORT, _H_PUBLISHED = range(6)
+_HEADER_SIZE = 64
+
+_ATTACH_LOCK = threading.Lock()
+
+
+def _require_shared_memory(what):
+    try:
+        from multiprocessing import shared_memory  # noqa: F401
+    except ImportError:
+        raise RuntimeError('%s requires Python 3.8 or newer (multiprocessing.shared_memory)' % what)
+
+
+def _shared_memory(name, create=False, size=0):
+    from multiprocessing import shared_memory
+
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    # the resource tracker would unlink the broker's segment when the reader exits
+    try:
+        # python >= 3.13
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # (unregistering afterwards instead would also remove the broker's registration when
+    # the reader shares its resource tracker)
+    from multiprocessing import resource_tracker
+    with _ATTACH_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class _SharedFrameRing(object):
+    """
+    A FrameRing (see motifapi.stream) in a shared memory segment, with the same generation
+    semantics. The segment holds a header, the generation of the frame in each slot, then the
+    page aligned slots of slot_bytes each.
+    """
+
+    def __init__(self, shm, slots, slot_bytes, port):
+        self.shm = shm
+        self.size = slots
+        self.slot_bytes = slot_bytes
+        self.generation = 0
+
+        self._header = np.ndarray((_HEADER_SIZE // 8,), dtype='<i8', buffer=shm.buf)
+        self._generations = np.ndarray((slots,), dtype='<i8', buffer=shm.buf, offset=_HEADER_SIZE)
+        self._data_offset = _data_offset(slots)
+        self._generations[:] = -1
+
+        h = self._header
+        h[_H_SLOTS] = slots
+        h[_H_SLOT_BYTES] = slot_bytes
+        h[_H_DATA_OFFSET] = self._data_offset
+        h[_H_PORT] = port
+        h[_H_PUBLISHED] = -1
+        # last, readers wait for it
+        h[_H_MAGIC] = _MAGIC
+
+    @classmethod
+    def create(cls, name, slots, slot_bytes, port):
+        shm = _shared_memory(name, create=True, size=_data_offset(slots) + slots * slot_bytes)
+        return cls(shm, slots, slot_bytes, port)
+
+    def next_slot(self, shape, dtype):
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes > self.slot_bytes:
+            raise ValueError('frame of %d bytes does not fit in the shared memory slots (%d bytes)'
+                             % (nbytes, self.slot_bytes))
+
+        self.generation += 1
+        i = self.generation % self.size
+        # invalidate before writing, so readers checking afterwards see their frame is stale
+        self._generations[i] = self.generation
+        offset = self._data_offset + i * self.slot_bytes
+        buf = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+        return self.generation, buf
+
+    def publish(self, generation):
+        self._header[_H_PUBLISHED] = generation
+
+    def close(self):
+        self._header = self._generations = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _data_offset(slots):
+    n = _HEADER_SIZE + 8 * slots
+    return ((n + mmap.PAGESIZE - 1) // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+class SharedFrameBroker(object):
+    """
+    Receives the image stream once and shares the frames with any number of local processes,
+    which read them with SharedFrameReader(name).
+
+    Frames are received directly into a ring of slots (of max_frame_bytes, default the size of
+    the first frame) in the shared memory segment called name, and the descriptor of each frame
+    (its position in the ring, shape, dtype and metadata) is published to the readers over zmq.
+    Readers get zero-copy views of the shared memory, which are valid until the ring wraps around.
+    Frames larger than a slot are discarded and counted in dropped. Requires Python 3.8 or newer.
+    """
+
+    STOP_POLL_INTERVAL = 0.1
+
+    def __init__(self, streamer, name=None, slots=32, max_frame_bytes=None):
+        _require_shared_memory('SharedFrameBroker')
+        if not isinstance(streamer, ImageStreamer):
+            raise ValueError('streamer must be an ImageStreamer')
+        if streamer.ring is not None:
+            raise ValueError('the broker receives into its own ring, the stream must not have a ring_size')
+
+        self._streamer = streamer
+        self.name = name or ('motifapi_%d_%x' % (time.time(), id(self)))
+        self._slots = slots
+
+        self.frames = 0
+        self.dropped = 0
+
+        self._pub = zmq.Context.instance().socket(zmq.PUB)
+        self._pub.setsockopt(zmq.LINGER, 0)
+        self.port = self._pub.bind_to_random_port('tcp://127.0.0.1')
+
+        self._ring = None
+        if max_frame_bytes is not None:
+            self._ring = _SharedFrameRing.create(self.name, slots, max_frame_bytes, self.port)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_api(cls, api, serial=None, force_host=None, **kwargs):
+        """
+        Creates a SharedFrameBroker of the image stream of the given (default the first) camera
+        """
+        _require_shared_memory('SharedFrameBroker')  # before opening the stream
+        return cls(api.get_stream(serial, force_host=force_host), **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='SharedFrameBroker')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, close=True):
+        """
+        Stops the receiving thread and removes the shared memory, then closes the stream (unless
+        close is False). Readers can no longer attach, those attached keep their mapping.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pub.close()
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
+        if close:
+            self._streamer.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _receive(self, sock):
+        md = sock.recv_json()
+        shape = tuple(md.pop('shape'))
+        dtype = np.dtype(md.pop('dtype'))
+
+        if self._ring is None:
+            # sized by the first frame
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            self._ring = _SharedFrameRing.create(self.name, self._slots, nbytes, self.port)
+            LOG.info('sharing frames in %s (%d x %d bytes)' % (self.name, self._slots, nbytes))
+
+        try:
+            generation, buf = self._ring.next_slot(shape, dtype)
+            _recv_into(sock, buf)
+        except ValueError as e:
+            while sock.getsockopt(zmq.RCVMORE):
+                sock.recv()
+            LOG.warning('discarding frame: %s' % e)
+            self.dropped += 1
+            return None, None, None
+
+        return generation, buf, md
+
+    def _run(self):
+        sock = self._streamer.stream
+        timeout_ms = int(self.STOP_POLL_INTERVAL * 1000)
+        while not self._stop.is_set():
+            if not sock.poll(timeout_ms, zmq.POLLIN):
+                continue
+            generation, buf, md = self._receive(sock)
+            if generation is None:
+                continue
+
+            self._streamer._track(md)
+            self._ring.publish(generation)
+            self.frames += 1
+            self._pub.send_json({'generation': generation,
+                                 'shape': buf.shape,
+                                 'dtype': buf.dtype.str,
+                                 'md': md})
+
+
+class SharedFrameReader(object):
+    """
+    Reads the frames shared by the SharedFrameBroker called name, from any local process.
+
+    Each reader has its own cursor. Images are read-only zero-copy views of the shared memory,
+    which are overwritten once the broker has received slots more frames (check with
+    is_stale(md)). Frames overwritten before they were read are skipped and counted in dropped,
+    lag is the number of frames received by the broker but not yet read.
+
+    Waits up to timeout seconds (default forever) for the broker to receive its first frame.
+    """
+
+    def __init__(self, name, timeout=None):
+        _require_shared_memory('SharedFrameReader')
+        t0 = time.monotonic()
+        while True:
+            try:
+                self._shm = _shared_memory(name)
+                header = np.ndarray((_HEADER_SIZE // 8,), dtype='<i8', buffer=self._shm.buf)
+                if header[_H_MAGIC] == _MAGIC:
+                    break
+                del header
+                self._shm.close()
+            except FileNotFoundError:
+                pass
+            if (timeout is not None) and ((time.monotonic() - t0) > timeout):
+                raise ValueError('no SharedFrameBroker called %s' % name)
+            time.sleep(0.05)
+
+        self.name = name
+        self._header = header
+        self._slots = int(header[_H_SLOTS])
+        self._slot_bytes = int(header[_H_SLOT_BYTES])
+        self._data_offset = int(header[_H_DATA_OFFSET])
+        self._generations = np.ndarray((self._slots,), dtype='<i8', buffer=self._shm.buf, offset=_HEADER_SIZE)
+
+        self._sub = zmq.Context.instance().socket(zmq.SUB)
+        self._sub.setsockopt(zmq.LINGER, 0)
+        self._sub.setsockopt(zmq.SUBSCRIBE, b'')
+        self._sub.connect('tcp://127.0.0.1:%d' % int(header[_H_PORT]))
+
+        self.dropped = 0
+        self._cursor = None  # generation of the next frame expected
+
+    @property
+    def lag(self):
+        if self._cursor is None:
+            return 0
+        return max(0, int(self._header[_H_PUBLISHED]) - self._cursor + 1)
+
+    def is_stale(self, md):
+        generation = md['ring_generation']
+        return self._generations[generation % self._slots] != generation
+
+    def _frame(self, desc):
+        generation = desc['generation']
+        if (self._cursor is not None) and (generation > self._cursor):
+            # lost before reaching this reader (slow joiner or queue overflow)
+            self.dropped += generation - self._cursor
+        self._cursor = generation + 1
+
+        if self._generations[generation % self._slots] != generation:
+            self.dropped += 1
+            return None, None
+
+        offset = self._data_offset + (generation % self._slots) * self._slot_bytes
+        A = np.ndarray(tuple(desc['shape']), dtype=np.dtype(desc['dtype']), buffer=self._shm.buf, offset=offset)
+        A.flags.writeable = False
+        md = desc['md']
+        md['ring_generation'] = generation
+        return A, md
+
+    def get_next_image(self, block=True, timeout=None):
+        """
+        Returns (image, metadata) of the next frame not yet overwritten, or (None, None) if no
+        frame was received within timeout seconds
+        """
+        deadline = None if timeout is None else (time.monotonic() + timeout)
+        while True:
+            if not self._sub.poll(_poll_timeout(block, timeout), zmq.POLLIN):
+                return None, None
+            A, md = self._frame(self._sub.recv_json())
+            if A is not None:
+                return A, md
+            if deadline is not None:
+                timeout = max(0., deadline - time.monotonic())
+
+    def get_latest_image(self, block=True, timeout=None):
+        """
+        As get_next_image, but skips to the newest frame (skipped frames are not counted as dropped)
+        """
+        if not self._sub.poll(_poll_timeout(block, timeout), zmq.POLLIN):
+            return None, None
+        desc = self._sub.recv_json()
+        while self._sub.poll(0, zmq.POLLIN):
+            desc = self._sub.recv_json()
+        self._cursor = desc['generation']
+        return self._frame(desc)
+
+    def close(self):
+        """
+        Closes the reader. Views of frames must no longer be used
+        """
+        self._sub.close()
+        self._header = self._generations = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # views are still referenced, the mapping is released with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,239 @@
+import math
+import time
+import threading
+
+
+class LatencyHistogram(object):
+    """
+    A fixed memory histogram of durations (seconds). Like HDR histograms the buckets have constant
+    relative width, buckets_per_decade of them per factor of 10 between min_value and max_value,
+    so percentiles are accurate to about 100 / buckets_per_decade percent over the whole range.
+    """
+
+    def __init__(self, min_value=1e-6, max_value=100., buckets_per_decade=40):
+        self.min_value = min_value
+        self.max_value = max_value
+        self._log_min = math.log10(min_value)
+        self._scale = buckets_per_decade
+        # +2 for the underflow and overflow buckets
+        self._counts = [0] * (int(math.ceil((math.log10(max_value) - self._log_min) * buckets_per_decade)) + 2)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self._counts)):
+            self._counts[i] = 0
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def record(self, value):
+        if value <= self.min_value:
+            i = 0
+        else:
+            i = min(len(self._counts) - 1, 1 + int((math.log10(value) - self._log_min) * self._scale))
+        self._counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _bucket_value(self, i):
+        if i == 0:
+            return self.min_value
+        # the geometric centre of the bucket
+        return 10 ** (self._log_min + (i - 0.5) / self._scale)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.)))
+        n = 0
+        for i, c in enumerate(self._counts):
+            n += c
+            if n >= rank:
+                return min(max(self._bucket_value(i), self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        if len(other._counts) != len(self._counts):
+            raise ValueError('histograms have different ranges')
+        for i, c in enumerate(other._counts):
+            self._counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def snapshot(self):
+        """
+        Returns a dict of the count, mean, min, max and 50/90/99/99.9th percentiles
+        """
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count,
+                'mean': self.total / self.count,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+
+class StreamStats(object):
+    """
+    Statistics of a stream, recorded by ImageStreamer, StateStreamer or StateMirror when created
+    with stats=True.
+
+    Tracks the number of frames (or state messages) and bytes received, their rates over the last
+    rate_interval seconds, frames lost (gaps in frame_number), a LatencyHistogram of the age of
+    each frame when received (receive time minus frame_time, this requires the clocks of both
+    computers to be synchronized if not streaming from localhost), and the time spent inside the
+    get_next_* call (receiving and waiting for frames) versus the time spent between calls (in user
+    code).
+    """
+
+    def __init__(self, rate_interval=1.0):
+        self.latency = LatencyHistogram()
+        self._rate_interval = rate_interval
+        self.reset()
+
+    def reset(self):
+        self.latency.reset()
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.recv_time = 0.
+        self.user_time = 0.
+        self.fps = 0.
+        self.bytes_per_second = 0.
+        self._last_frame_number = None
+        self._last_end = None
+        self._window_start = time.perf_counter()
+        self._window_frames = 0
+        self._window_bytes = 0
+
+    def begin(self):
+        t = time.perf_counter()
+        if self._last_end is not None:
+            self.user_time += t - self._last_end
+        return t
+
+    def end(self, t0, nbytes=0, md=None):
+        """
+        Call after the receive started at t0 (from begin()) finished. md is None if nothing was received
+        """
+        now = time.perf_counter()
+        self.recv_time += now - t0
+        self._last_end = now
+
+        if md is None:
+            return
+
+        self.frames += 1
+        self.bytes += nbytes
+        self._window_frames += 1
+        self._window_bytes += nbytes
+
+        elapsed = now - self._window_start
+        if elapsed >= self._rate_interval:
+            self.fps = self._window_frames / elapsed
+            self.bytes_per_second = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_frames = self._window_bytes = 0
+
+        fn = md.get('frame_number')
+        if fn is not None:
+            last = self._last_frame_number
+            if (last is not None) and (fn > (last + 1)):
+                self.dropped += fn - last - 1
+            self._last_frame_number = fn
+
+        ft = md.get('frame_time')
+        if ft is not None:
+            age = time.time() - ft
+            if age >= 0:
+                self.latency.record(age)
+
+    def _rates(self):
+        # fps and bytes_per_second are only updated when a frame closes the window, if the window
+        # has run past the interval without one the stream has slowed or stalled, so report the
+        # rate over the open window instead, which falls to 0
+        elapsed = time.perf_counter() - self._window_start
+        if elapsed >= self._rate_interval:
+            return self._window_frames / elapsed, self._window_bytes / elapsed
+        return self.fps, self.bytes_per_second
+
+    def snapshot(self):
+        busy = self.recv_time + self.user_time
+        fps, bytes_per_second = self._rates()
+        return {'frames': self.frames,
+                'bytes': self.bytes,
+                'fps': fps,
+                'bytes_per_second': bytes_per_second,
+                'dropped': self.dropped,
+                'latency': self.latency.snapshot(),
+                'recv_time': self.recv_time,
+                'user_time': self.user_time,
+                'user_fraction': (self.user_time / busy) if busy else 0.}
+
+
+def prometheus_text(sources):
+    """
+    Renders the StreamStats in sources {name: StreamStats} in the Prometheus text format
+    """
+    metrics = (('frames_total', 'counter', lambda s: s['frames']),
+               ('bytes_total', 'counter', lambda s: s['bytes']),
+               ('dropped_frames_total', 'counter', lambda s: s['dropped']),
+               ('fps', 'gauge', lambda s: s['fps']),
+               ('bytes_per_second', 'gauge', lambda s: s['bytes_per_second']),
+               ('recv_seconds_total', 'counter', lambda s: s['recv_time']),
+               ('user_seconds_total', 'counter', lambda s: s['user_time']))
+
+    snaps = [(name, s.snapshot()) for name, s in sorted(sources.items())]
+    lines = []
+    for metric, kind, get in metrics:
+        lines.append('# TYPE motifapi_stream_%s %s' % (metric, kind))
+        for name, snap in snaps:
+            lines.append('motifapi_stream_%s{stream="%s"} %s' % (metric, name, get(snap)))
+
+    lines.append('# TYPE motifapi_stream_latency_seconds summary')
+    for name, snap in snaps:
+        lat = snap['latency']
+        for q, k in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'), ('0.999', 'p999')):
+            if k in lat:
+                lines.append('motifapi_stream_latency_seconds{stream="%s",quantile="%s"} %s' % (name, q, lat[k]))
+        lines.append('motifapi_stream_latency_seconds_count{stream="%s"} %d' % (name, lat['count']))
+        lines.append('motifapi_stream_latency_seconds_sum{stream="%s"} %s' % (name, lat.get('mean', 0) * lat['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(sources, port=9108, host='127.0.0.1'):
+    """
+    Serves prometheus_text(sources) over HTTP from a background thread. Returns the server
+    (call shutdown() to stop it)
+    """
+    import http.server
+
+    class _Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = prometheus_text(sources).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer((host, port), _Handler)
+    t = threading.Thread(target=server.serve_forever, name='prometheus')
+    t.daemon = True
+    t.start()
+    return server
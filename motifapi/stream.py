@@ -1,19 +1,50 @@
 import sys
 import json
+import mmap
 import threading
 import logging
 
 import zmq
 import numpy as np
 
+try:
+    from orjson import loads as _fast_json_loads
+except ImportError:
+    try:
+        from ujson import loads as _fast_json_loads
+    except ImportError:
+        _fast_json_loads = None
+
+
+if _fast_json_loads is None:
+    _json_loads = json.loads
+else:
+    def _json_loads(s):
+        # the fast decoders reject what json accepts, e.g. NaN and Infinity
+        try:
+            return _fast_json_loads(s)
+        except ValueError:
+            return json.loads(s)
+
 
 if sys.version_info > (3,):
     buffer = memoryview
 
 
+from .stats import StreamStats
+
 LOG = logging.getLogger('motifapi.stream')
 
 
+def _poll_timeout(block, timeout):
+    # to the milliseconds (or None for forever) as expected by zmq poll
+    if not block:
+        return 0
+    if timeout is None:
+        return None
+    return max(0, int(timeout * 1000))
+
+
 def recv_array(socket, flags=0, copy=True, track=False):
     md = socket.recv_json(flags=flags)
     msg = socket.recv(flags=flags, copy=copy, track=track)
@@ -24,30 +55,282 @@ def recv_array(socket, flags=0, copy=True, track=False):
     return A.reshape(md.pop('shape')), md
 
 
-class ImageStreamer(object):
+class FrameRing(object):
+    """
+    A fixed ring of preallocated, page aligned, frame buffers.
+
+    Every frame received into the ring is given an increasing generation number. Frames are
+    handed out as read-only views which remain valid until the ring wraps around and that slot
+    is reused, which can be checked with is_stale(generation).
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('ring size must be at least 1')
+        self.size = size
+        self.generation = 0
+
+        self._shape = self._dtype = None
+        self._arrays = self._views = ()
+        self._generations = [0] * size
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays)
+
+    def _allocate(self, shape, dtype):
+        count = int(np.prod(shape))
+        arrays = []
+        views = []
+        for _ in range(self.size):
+            # anonymous maps are page aligned
+            buf = mmap.mmap(-1, max(1, count * dtype.itemsize))
+            a = np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+            v = a.view()
+            v.flags.writeable = False
+            arrays.append(a)
+            views.append(v)
+
+        LOG.debug('allocated %d x %r %s frame buffers' % (self.size, shape, dtype))
+
+        self._shape = shape
+        self._dtype = dtype
+        self._arrays = arrays
+        self._views = views
+
+    def next_slot(self, shape, dtype):
+        """
+        Returns (generation, array) for the writable buffer into which the next frame should be placed
+        """
+        if (shape != self._shape) or (dtype != self._dtype):
+            # buffers of the previous layout are freed once no more views of them exist
+            self._allocate(shape, dtype)
+
+        self.generation += 1
+        i = self.generation % self.size
+        # invalidate before writing, so readers checking afterwards see their frame is stale
+        self._generations[i] = self.generation
+        return self.generation, self._arrays[i]
+
+    def view(self, generation):
+        return self._views[generation % self.size]
+
+    def is_stale(self, generation):
+        return self._generations[generation % self.size] != generation
+
+
+def recv_array_into(socket, ring, flags=0):
+    """
+    Receives the next frame into a FrameRing. Returns a read-only view of the frame, and its metadata
+    with the added key 'ring_generation'
+    """
+    md = socket.recv_json(flags=flags)
+    generation, buf = ring.next_slot(tuple(md.pop('shape')), np.dtype(md.pop('dtype')))
+    _recv_into(socket, buf, flags)
+    md['ring_generation'] = generation
+    return ring.view(generation), md
+
+
+def _recv_into(socket, buf, flags=0):
+    if hasattr(socket, 'recv_into'):
+        # pyzmq >= 26.4, receive directly into the buffer
+        n = socket.recv_into(buf, flags=flags)
+        if n != buf.nbytes:
+            raise ValueError('frame size (%d bytes) does not match its metadata (%d bytes)' % (n, buf.nbytes))
+    else:
+        _copy_into(buf, socket.recv(flags=flags, copy=False).buffer)
+
+
+def _copy_into(buf, src):
+    if len(src) != buf.nbytes:
+        raise ValueError('frame size (%d bytes) does not match its metadata (%d bytes)' % (len(src), buf.nbytes))
+    buf.reshape(-1).view(np.uint8)[:] = np.frombuffer(src, dtype=np.uint8)
+
+
+def recv_latest_array(socket, copy=True, ring=None):
+    """
+    Receives all queued frames but only decodes the newest one. Returns (image, metadata, n_discarded)
+
+    (ZMQ_CONFLATE does not support the multipart messages of the image stream, so the queue is
+    drained here instead. Discarded frames are received without copying)
+    """
+    parts = socket.recv_multipart(copy=False)
+    discarded = 0
+    while socket.poll(0, zmq.POLLIN):
+        parts = socket.recv_multipart(copy=False)
+        discarded += 1
+
+    md = json.loads(parts[0].bytes)
+    shape = tuple(md.pop('shape'))
+    dtype = np.dtype(md.pop('dtype'))
+
+    if ring is not None:
+        generation, buf = ring.next_slot(shape, dtype)
+        _copy_into(buf, parts[1].buffer)
+        md['ring_generation'] = generation
+        return ring.view(generation), md, discarded
+
+    A = np.frombuffer(parts[1].bytes if copy else parts[1].buffer, dtype=dtype)
+    return A.reshape(shape), md, discarded
+
+
+class _Streamer(object):
 
     stream = None
 
-    def __init__(self, host, port):
-        ctx = zmq.Context()
+    @staticmethod
+    def _context():
+        # all streams share the process wide context (and its IO thread). it is never
+        # terminated, closing a stream closes only its socket
+        return zmq.Context.instance()
+
+    @property
+    def closed(self):
+        return (self.stream is None) or self.stream.closed
+
+    def close(self):
+        if not self.closed:
+            self.stream.close(linger=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ImageStreamer(_Streamer):
+    """
+    Receives images from the motif realtime image stream.
+
+    If ring_size is given, frames are received into a FrameRing of that many preallocated buffers
+    instead of newly allocated arrays. The returned images are then read-only and are only valid
+    until ring_size more frames have been received (see FrameRing.is_stale).
+
+    If conflate is True, get_next_image behaves like get_latest_image, returning only the newest
+    queued frame. rcvhwm limits the number of frames queued for this client.
+
+    dropped_frames counts the frames missing between consecutively returned frames (by
+    frame_number), whether discarded here by conflation or lost before reaching this client.
+
+    If stats is True, stats is a StreamStats of the received frames.
+    """
+
+    ring = None
+    stats = None
+
+    def __init__(self, host, port, ring_size=None, conflate=False, rcvhwm=None, stats=False):
+        ctx = self._context()
         address = "tcp://%s:%d" % (host, port)
         LOG.debug('image stream connecting to: %s' % address)
         sock = ctx.socket(zmq.PULL)
+        if rcvhwm is not None:
+            sock.setsockopt(zmq.RCVHWM, rcvhwm)
         sock.connect(address)
         self.stream = sock
 
-    def get_next_image(self, block=True, copy=True):
+        if ring_size:
+            self.ring = FrameRing(ring_size)
+
+        self.conflate = conflate
+        self.dropped_frames = 0
+        self.conflated_frames = 0
+        self._last_frame_number = None
+
+        if stats:
+            self.stats = StreamStats()
+
+    def _track(self, md):
+        fn = md.get('frame_number')
+        if fn is not None:
+            last = self._last_frame_number
+            if (last is not None) and (fn > (last + 1)):
+                self.dropped_frames += fn - last - 1
+            self._last_frame_number = fn
+
+    def _recv(self, copy):
+        if self.ring is not None:
+            return recv_array_into(self.stream, self.ring)
+        return recv_array(self.stream, copy=copy)
+
+    def get_next_image(self, block=True, copy=True, timeout=None):
+        """
+        Returns the next (image, metadata). If block is False, or no image arrives within
+        timeout seconds, returns (None, None)
+        """
+        if self.conflate:
+            return self.get_latest_image(block=block, copy=copy, timeout=timeout)
+
+        stats = self.stats
+        if stats is not None:
+            t0 = stats.begin()
+
+        A = md = None
+        if self.stream.poll(_poll_timeout(block, timeout), zmq.POLLIN):
+            A, md = self._recv(copy)
+            self._track(md)
+
+        if stats is not None:
+            stats.end(t0, 0 if A is None else A.nbytes, md)
+        return A, md
+
+    def get_latest_image(self, block=True, copy=True, timeout=None):
+        """
+        As get_next_image, but discards all queued frames except the newest
+        """
+        stats = self.stats
+        if stats is not None:
+            t0 = stats.begin()
+
+        A = md = None
+        if self.stream.poll(_poll_timeout(block, timeout), zmq.POLLIN):
+            A, md, n = recv_latest_array(self.stream, copy=copy, ring=self.ring)
+            self.conflated_frames += n
+            self._track(md)
+
+        if stats is not None:
+            stats.end(t0, 0 if A is None else A.nbytes, md)
+        return A, md
+
+
+class StreamPoller(object):
+    """
+    Waits for data on many image and/or state streams from a single thread, e.g.
+
+        poller = StreamPoller(stream0, stream1)
         while True:
-            while self.stream.poll(0, zmq.POLLIN):
-                return recv_array(self.stream, copy=copy)
-            if not block:
-                return None, None
+            for stream in poller.poll(timeout=1.0):
+                I, md = stream.get_next_image(block=False)
+    """
+
+    def __init__(self, *streamers):
+        self._poller = zmq.Poller()
+        self._streamers = {}
+        for s in streamers:
+            self.register(s)
+
+    def register(self, streamer):
+        self._poller.register(streamer.stream, zmq.POLLIN)
+        self._streamers[streamer.stream] = streamer
+
+    def unregister(self, streamer):
+        self._poller.unregister(streamer.stream)
+        del self._streamers[streamer.stream]
+
+    def poll(self, timeout=None):
+        """
+        Returns the streamers which have data ready, waiting at most timeout seconds (default forever)
+        """
+        events = self._poller.poll(_poll_timeout(True, timeout))
+        return [self._streamers[sock] for sock, ev in events if ev & zmq.POLLIN]
 
 
-class StateStreamer(object):
+class StateStreamer(_Streamer):
 
-    def __init__(self, host, port, channel='j'):
-        ctx = zmq.Context()
+    stats = None
+
+    def __init__(self, host, port, channel='j', stats=False):
+        ctx = self._context()
         address = "tcp://%s:%d" % (host, port)
         LOG.debug('state stream connecting to: %s' % address)
         sock = ctx.socket(zmq.SUB)
@@ -59,22 +342,51 @@ class StateStreamer(object):
             sock.setsockopt(zmq.SUBSCRIBE, channel)
         self.stream = sock
 
-    def get_next_state(self, block=True):
-        while True:
+        if stats:
+            self.stats = StreamStats()
+
+    def get_next_state(self, block=True, timeout=None):
+        """
+        Returns the next state. If block is False, or no state arrives within timeout
+        seconds, returns None
+        """
+        stats = self.stats
+        if stats is not None:
+            t0 = stats.begin()
+
+        state = None
+        if self.stream.poll(_poll_timeout(block, timeout), zmq.POLLIN):
             _, msg = self.stream.recv_multipart()
-            return json.loads(msg)
+            state = _json_loads(msg)
+            if stats is not None:
+                stats.end(t0, len(msg), state)
+        elif stats is not None:
+            stats.end(t0)
+
+        return state
 
 
 class StateMirror(threading.Thread):
 
     daemon = True
 
-    def __init__(self, streamer):
+    # how often (seconds) the thread checks whether it should stop
+    STOP_POLL_INTERVAL = 0.1
+
+    stats = None
+
+    def __init__(self, streamer, stats=False):
         assert isinstance(streamer, StateStreamer)
         threading.Thread.__init__(self)
         self._lock = threading.Lock()
         self._state = {}
         self._streamer = streamer
+        self._stopped = threading.Event()
+
+        if stats:
+            # here recv_time is the time spent updating the state, user_time the time
+            # spent waiting for state messages
+            self.stats = StreamStats()
 
     @property
     def is_recording(self):
@@ -93,8 +405,121 @@ class StateMirror(threading.Thread):
             extra.update(self._state)
             return extra
 
+    def _update(self, state):
+        with self._lock:
+            self._state.update(state)
+
     def run(self):
-        while True:
-            _, msg = self._streamer.stream.recv_multipart()
-            with self._lock:
-                self._state.update(json.loads(msg))
+        sock = self._streamer.stream
+        stats = self.stats
+        timeout_ms = int(self.STOP_POLL_INTERVAL * 1000)
+        while not self._stopped.is_set():
+            if sock.poll(timeout_ms, zmq.POLLIN):
+                if stats is not None:
+                    t0 = stats.begin()
+                _, msg = sock.recv_multipart()
+                state = _json_loads(msg)
+                self._update(state)
+                if stats is not None:
+                    stats.end(t0, len(msg), state)
+
+    def stop(self, close=True):
+        """
+        Stops the mirror thread and waits for it to finish, then closes the stream (unless close is False)
+        """
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        if close:
+            self._streamer.close()
+
+
+class StateSnapshot(object):
+    """
+    An immutable snapshot of the mirrored state. The frequently read fields are attributes,
+    the complete state dict is only assembled when first asked for.
+    """
+
+    __slots__ = ('frame_number', 'frame_time', 'is_recording', '_msg', '_base', '_depth', '_state')
+
+    # longest chain of partial updates kept before they are merged
+    MAX_DEPTH = 32
+
+    def __init__(self, msg, base=None):
+        if (base is not None) and (base._depth >= StateSnapshot.MAX_DEPTH):
+            base.state  # merges, and releases, the chain
+
+        self._msg = msg
+        self._state = None
+        if base is None:
+            self._base = None
+            self._depth = 0
+            self.frame_number = msg.get('frame_number', None)
+            self.frame_time = msg.get('frame_time', None)
+            self.is_recording = msg.get('is_recording', False)
+        else:
+            self._base = base
+            self._depth = 1 if base._state is not None else base._depth + 1
+            self.frame_number = msg.get('frame_number', base.frame_number)
+            self.frame_time = msg.get('frame_time', base.frame_time)
+            self.is_recording = msg.get('is_recording', base.is_recording)
+
+    @property
+    def state(self):
+        """
+        The complete state. This dict is shared, do not modify it
+        """
+        # merged by any reader (and the writer) at once. _base is read before _state, and only
+        # released after _state is set, so a reader never sees neither and takes the partial
+        # message for the whole state
+        base = self._base
+        s = self._state
+        if s is None:
+            if base is None:
+                s = self._msg
+            else:
+                s = dict(base.state)
+                s.update(self._msg)
+            self._state = s
+            self._base = None
+        return s
+
+
+class FastStateMirror(StateMirror):
+    """
+    A StateMirror for readers polling at high rates. Instead of updating one dict under a lock,
+    each state message is published as a new immutable StateSnapshot (replacing the reference
+    is atomic) so reads never wait for the writer and is_recording, frame_number and frame_time
+    do not allocate.
+    """
+
+    def __init__(self, streamer, stats=False):
+        StateMirror.__init__(self, streamer, stats=stats)
+        self._snapshot = StateSnapshot({})
+        self._keys = set()
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def is_recording(self):
+        return self._snapshot.is_recording
+
+    @property
+    def frame_number(self):
+        return self._snapshot.frame_number
+
+    @property
+    def frame_time(self):
+        return self._snapshot.frame_time
+
+    def get_state(self, **extra):
+        extra.update(self._snapshot.state)
+        return extra
+
+    def _update(self, msg):
+        keys = self._keys
+        keys.update(msg)
+        # a message containing every key ever seen replaces the state entirely
+        self._snapshot = StateSnapshot(msg, None if len(msg) == len(keys) else self._snapshot)
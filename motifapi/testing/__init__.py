@@ -0,0 +1,2 @@
+# the fake publishers (motifapi.testing.publishers) require zmq and numpy, and are not imported here
+from .server import FakeMotifServer, TEST_CERT, TEST_KEY, TEST_API_KEY
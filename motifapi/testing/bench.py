@@ -0,0 +1,299 @@
+"""
+Benchmarks of the client against a local FakeMotifServer and fake zmq publishers, no motif
+required. The server and publishers run in other processes, so the CPU times are of the client
+only. Run with
+
+    python -m motifapi.testing.bench [--quick] [--save HISTORY.json] [--compare HISTORY.json]
+
+--save appends the results (tagged with the motifapi version) to a JSON history file, and
+--compare reports metrics which got worse by more than --threshold relative to the last run in
+the history (or the last run of --baseline-version), exiting with status 1 if any did.
+"""
+from __future__ import print_function
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import multiprocessing
+
+from .. import __version__
+from ..api import MotifApi
+from ..stats import LatencyHistogram
+from .server import FakeMotifServer, TEST_CERT
+
+# metric -> +1 if higher is better, -1 if lower is better. other metrics are informational
+METRICS = {'calls_per_second': 1,
+           'p50_ms': -1,
+           'p99_ms': -1,
+           'cpu_us_per_call': -1,
+           'frames_per_second': 1,
+           'messages_per_second': 1,
+           'cpu_us_per_frame': -1,
+           'cpu_us_per_message': -1,
+           'alloc_peak_bytes_per_frame': -1,
+           'alloc_blocks_per_frame': -1,
+           'alloc_peak_bytes_per_message': -1,
+           'alloc_blocks_per_message': -1}
+
+
+def _allocations(fn, n):
+    # python has no cumulative allocation counter, so this reports the peak traced memory
+    # allocated during each call, and the blocks still allocated after (leaks)
+    if not hasattr(tracemalloc, 'reset_peak'):
+        return {}
+    fn()
+    tracemalloc.start()
+    try:
+        blocks = sys.getallocatedblocks()
+        peak = 0
+        for _ in range(n):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            fn()
+            peak += tracemalloc.get_traced_memory()[1] - current
+        blocks = sys.getallocatedblocks() - blocks
+    finally:
+        tracemalloc.stop()
+    return {'alloc_peak_bytes_per_frame': float(peak) / n,
+            'alloc_blocks_per_frame': float(blocks) / n}
+
+
+def _timed(fn, n):
+    hist = LatencyHistogram()
+    c0 = time.process_time()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        fn()
+        hist.record(time.perf_counter() - t)
+    wall = time.perf_counter() - t0
+    cpu = time.process_time() - c0
+    return hist, wall, cpu
+
+
+def _serve(kwargs, addresses, stop):
+    # runs in a separate process so its CPU time is not counted
+    with FakeMotifServer(**kwargs) as server:
+        addresses.put((server.host, server.port, server.api_key))
+        stop.wait()
+
+
+def _start_server(**kwargs):
+    # returns (process, MotifApi, stop event) of a FakeMotifServer in another process
+    ctx = multiprocessing.get_context('spawn')
+    addresses = ctx.Queue()
+    stop = ctx.Event()
+    proc = ctx.Process(target=_serve, args=(kwargs, addresses, stop))
+    proc.daemon = True
+    proc.start()
+    host, port, api_key = addresses.get(timeout=30)
+    return proc, stop, lambda **kw: MotifApi(host, api_key, port, ca_cert=TEST_CERT, **kw)
+
+
+def _stop_server(proc, stop):
+    stop.set()
+    proc.join(10)
+    if proc.is_alive():
+        proc.terminate()
+
+
+def bench_call(n):
+    proc, stop, make_api = _start_server(cameras=['FAKE%d' % i for i in range(8)])
+    try:
+        api = make_api()
+        api.call('version')  # connect
+        hist, wall, cpu = _timed(lambda: api.call('camera/FAKE0'), n)
+        api.close()
+    finally:
+        _stop_server(proc, stop)
+    return {'calls_per_second': n / wall,
+            'p50_ms': hist.percentile(50) * 1e3,
+            'p99_ms': hist.percentile(99) * 1e3,
+            'cpu_us_per_call': cpu / n * 1e6}
+
+
+def bench_snapshot(n):
+    # 8 camera status requests each, made concurrently
+    proc, stop, make_api = _start_server(cameras=['FAKE%d' % i for i in range(8)])
+    try:
+        api = make_api(pool_size=8)
+        api.snapshot(max_age=0)
+        hist, wall, cpu = _timed(lambda: api.snapshot(max_age=0), n)
+        api.close()
+    finally:
+        _stop_server(proc, stop)
+    return {'calls_per_second': n * 8 / wall,
+            'p50_ms': hist.percentile(50) * 1e3,
+            'p99_ms': hist.percentile(99) * 1e3}
+
+
+def _publish(kind, kwargs, ports):
+    # runs in a separate process so its CPU time is not counted
+    import zmq
+    from .publishers import ImagePublisher, StatePublisher
+    pub = (ImagePublisher if kind == 'image' else StatePublisher)(**kwargs)
+    ports.put(pub.port)
+    pub.run()
+    # wait for the frames, which are sent without copying, to be sent before exiting
+    zmq.Context.instance().term()
+
+
+def _start_publisher(kind, **kwargs):
+    ctx = multiprocessing.get_context('spawn')
+    ports = ctx.Queue()
+    proc = ctx.Process(target=_publish, args=(kind, kwargs, ports))
+    proc.daemon = True
+    proc.start()
+    return proc, ports.get(timeout=30)
+
+
+def bench_image_stream(n, shape=(1024, 1280), **stream_kwargs):
+    from ..stream import ImageStreamer
+
+    n_alloc = max(10, n // 10)
+    proc, port = _start_publisher('image', n=n + n_alloc + 1, shape=shape)
+    try:
+        with ImageStreamer('127.0.0.1', port, **stream_kwargs) as stream:
+            stream.get_next_image(timeout=30)  # connected
+            _, wall, cpu = _timed(lambda: stream.get_next_image(timeout=10), n)
+            out = {'frames_per_second': n / wall,
+                   'mb_per_second': n * shape[0] * shape[1] / wall / 1e6,
+                   'cpu_us_per_frame': cpu / n * 1e6}
+            out.update(_allocations(lambda: stream.get_next_image(timeout=10), n_alloc - 1))
+    finally:
+        proc.join(10)
+        if proc.is_alive():
+            proc.terminate()
+    return out
+
+
+def bench_state_stream(n):
+    from ..stream import StateStreamer
+
+    n_alloc = max(10, n // 10)
+    proc, port = _start_publisher('state', n=None, rate=None)
+    try:
+        with StateStreamer('127.0.0.1', port) as stream:
+            stream.get_next_state(timeout=30)
+            _, wall, cpu = _timed(lambda: stream.get_next_state(timeout=10), n)
+            out = {'messages_per_second': n / wall,
+                   'cpu_us_per_message': cpu / n * 1e6}
+            alloc = _allocations(lambda: stream.get_next_state(timeout=10), n_alloc)
+            out.update({k.replace('frame', 'message'): v for k, v in alloc.items()})
+    finally:
+        proc.terminate()
+        proc.join(10)
+    return out
+
+
+BENCHMARKS = [('call', bench_call, {'n': 2000}),
+              ('snapshot_8_cameras', bench_snapshot, {'n': 200}),
+              ('image_stream', bench_image_stream, {'n': 1000}),
+              ('image_stream_ring', bench_image_stream, {'n': 1000, 'ring_size': 4}),
+              ('image_stream_small', bench_image_stream, {'n': 5000, 'shape': (64, 64)}),
+              ('state_stream', bench_state_stream, {'n': 20000})]
+
+
+def run(names=None, quick=False):
+    results = {}
+    for name, fn, kwargs in BENCHMARKS:
+        if names and (name not in names):
+            continue
+        kwargs = dict(kwargs)
+        if quick:
+            kwargs['n'] = max(10, kwargs['n'] // 10)
+        try:
+            results[name] = fn(**kwargs)
+        except ImportError as e:
+            print('skipping %s: %s' % (name, e), file=sys.stderr)
+    return {'version': __version__,
+            'python': platform.python_version(),
+            'machine': platform.node(),
+            'time': time.time(),
+            'quick': quick,
+            'results': results}
+
+
+def compare(run_, baseline, threshold=0.1):
+    """
+    Returns [(benchmark, metric, baseline, value, relative change)] of the metrics which got worse
+    by more than threshold (a fraction)
+    """
+    worse = []
+    for name, metrics in sorted(run_['results'].items()):
+        base = baseline['results'].get(name, {})
+        for metric, value in sorted(metrics.items()):
+            sign = METRICS.get(metric)
+            b = base.get(metric)
+            if (sign is None) or (b is None) or (value is None) or (b == 0):
+                continue
+            change = (value - b) / abs(b)
+            if sign * change < -threshold:
+                worse.append((name, metric, b, value, change))
+    return worse
+
+
+def _load_history(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return []
+
+
+def _format(results):
+    lines = []
+    for name, metrics in sorted(results.items()):
+        lines.append(name)
+        for metric, value in sorted(metrics.items()):
+            lines.append('    %-30s %12.2f' % (metric, value))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='motifapi client benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default all): %s' %
+                        ', '.join(b[0] for b in BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help='10x fewer iterations')
+    parser.add_argument('--save', metavar='HISTORY', help='append the results to this JSON file')
+    parser.add_argument('--compare', metavar='HISTORY', help='compare to the last run in this JSON file')
+    parser.add_argument('--baseline-version', help='compare to the last run of this motifapi version')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported as a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    r = run(args.benchmarks, quick=args.quick)
+    print('motifapi %s, python %s' % (r['version'], r['python']))
+    print(_format(r['results']))
+
+    status = 0
+    if args.compare:
+        history = [h for h in _load_history(args.compare)
+                   if (args.baseline_version is None) or (h['version'] == args.baseline_version)]
+        if not history:
+            print('no baseline to compare to in %s' % args.compare, file=sys.stderr)
+        else:
+            baseline = history[-1]
+            worse = compare(r, baseline, args.threshold)
+            print('\ncompared to motifapi %s (%s)' % (baseline['version'],
+                                                      time.strftime('%Y-%m-%d %H:%M', time.localtime(baseline['time']))))
+            for name, metric, b, value, change in worse:
+                print('REGRESSION %s %s: %.2f -> %.2f (%+.0f%%)' % (name, metric, b, value, change * 100))
+            if not worse:
+                print('no regressions')
+            status = 1 if worse else 0
+
+    if args.save:
+        history = _load_history(args.save)
+        history.append(r)
+        with open(args.save, 'w') as f:
+            json.dump(history, f, indent=1)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
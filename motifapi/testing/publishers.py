@@ -0,0 +1,131 @@
+import json
+import time
+import logging
+import threading
+
+import zmq
+import numpy as np
+
+LOG = logging.getLogger('motifapi.testing')
+
+
+class _Publisher(threading.Thread):
+    """
+    Sends n messages (default forever) at rate per second (default as fast as possible) from a
+    background thread. The socket is bound to port (default a random free port) on host.
+    """
+
+    SOCKET_TYPE = None
+    STOP_POLL_INTERVAL = 0.1
+    LINGER_MS = 1000
+
+    def __init__(self, port=0, host='127.0.0.1', rate=None, n=None, start_frame=0):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+
+        self.rate = rate
+        self.n = n
+        self.sent = 0
+        self.frame_number = start_frame
+
+        self._stopped = threading.Event()
+        self._socket = zmq.Context.instance().socket(self.SOCKET_TYPE)
+        address = 'tcp://%s' % host
+        if port:
+            self._socket.bind('%s:%d' % (address, port))
+            self.port = port
+        else:
+            self.port = self._socket.bind_to_random_port(address)
+        self.host = host
+
+    def _send(self, frame_time):
+        raise NotImplementedError
+
+    def run(self):
+        sock = self._socket
+        timeout_ms = int(self.STOP_POLL_INTERVAL * 1000)
+        period = (1.0 / self.rate) if self.rate else 0.
+        t_next = time.monotonic()
+        try:
+            while not self._stopped.is_set() and ((self.n is None) or (self.sent < self.n)):
+                if period:
+                    # absolute deadlines so the rate does not drift
+                    delay = t_next - time.monotonic()
+                    if delay > 0:
+                        if self._stopped.wait(delay):
+                            break
+                    t_next += period
+                # (PUSH sockets block without a connected peer)
+                if not sock.poll(timeout_ms, zmq.POLLOUT):
+                    continue
+                self._send(time.time())
+                self.sent += 1
+                self.frame_number += 1
+        finally:
+            # when finished give the peer time to receive the last messages
+            sock.close(linger=0 if self._stopped.is_set() else self.LINGER_MS)
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def __enter__(self):
+        if not self.is_alive():
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class ImagePublisher(_Publisher):
+    """
+    Publishes synthetic frames of the given shape and dtype on a PUSH socket, in the format of the
+    motif realtime image stream (for ImageStreamer).
+
+    A few frames are generated up front and cycled, so sending costs no more than in motif.
+    """
+
+    SOCKET_TYPE = zmq.PUSH
+
+    def __init__(self, port=0, host='127.0.0.1', rate=None, n=None, shape=(1024, 1280), dtype='uint8',
+                 start_frame=0, n_images=4):
+        _Publisher.__init__(self, port=port, host=host, rate=rate, n=n, start_frame=start_frame)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        info = np.iinfo(self.dtype) if self.dtype.kind in 'iu' else None
+        self._images = []
+        for i in range(n_images):
+            a = np.empty(self.shape, dtype=self.dtype)
+            a[...] = (i * 64) % (256 if info is None else (int(info.max) + 1))
+            self._images.append(a)
+
+    def _send(self, frame_time):
+        a = self._images[self.frame_number % len(self._images)]
+        self._socket.send_json({'dtype': self.dtype.str,
+                                'shape': self.shape,
+                                'frame_number': self.frame_number,
+                                'frame_time': frame_time}, zmq.SNDMORE)
+        self._socket.send(a, copy=False)
+
+
+class StatePublisher(_Publisher):
+    """
+    Publishes synthetic state messages (frame_number, frame_time, is_recording plus any extra
+    values) on a PUB socket, in the format of the motif realtime state stream (for StateStreamer).
+    """
+
+    SOCKET_TYPE = zmq.PUB
+
+    def __init__(self, port=0, host='127.0.0.1', rate=100, n=None, start_frame=0, channel=b'j',
+                 is_recording=False, extra=None):
+        _Publisher.__init__(self, port=port, host=host, rate=rate, n=n, start_frame=start_frame)
+        self.channel = channel if isinstance(channel, bytes) else channel.encode('ascii')
+        self.is_recording = is_recording
+        self.extra = dict(extra or {})
+
+    def _send(self, frame_time):
+        state = dict(self.extra)
+        state.update(frame_number=self.frame_number, frame_time=frame_time, is_recording=self.is_recording)
+        self._socket.send_multipart([self.channel, json.dumps(state).encode('utf-8')])
@@ -0,0 +1,378 @@
+import os.path
+import ssl
+import json
+import time
+import random
+import socket
+import functools
+import logging
+import threading
+import collections
+import socketserver
+import http.server
+
+from ..api import MotifApi
+from ..tracing import _route_name
+
+LOG = logging.getLogger('motifapi.testing')
+
+TEST_CERT = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'test.crt')
+TEST_KEY = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'test.key')
+
+TEST_API_KEY = 'motifapi-testing'
+
+
+class _FakeCamera(object):
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.filename = ''
+        self.playback_status = 'idle'
+        self.config = {}
+        self.recordings = []
+        self.image_port = None
+        self.state_port = None
+
+    def status(self, stream_host):
+        info = {'serial': self.serial,
+                'filename': self.filename,
+                'status': 'recording' if self.filename else 'idle'}
+        stream = {}
+        if self.image_port is not None:
+            stream['image'] = {'host': stream_host, 'port': self.image_port}
+        if self.state_port is not None:
+            stream['state'] = {'host': stream_host, 'port': self.state_port}
+        if stream:
+            info['stream'] = stream
+        return {'camera_info': info,
+                'playback_info': {'status': self.playback_status}}
+
+
+class _HTTPError(Exception):
+
+    def __init__(self, message, code):
+        self.code = code
+        Exception.__init__(self, message)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1  # headers and body in one write
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, code, obj):
+        out = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _handle(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(n) if n else b''
+        fake = self.server.fake
+        try:
+            code, obj = 200, fake.handle(self.command, self.path, self.headers.get('X-Api-Key'), body)
+        except _HTTPError as e:
+            code, obj = e.code, {'error': str(e), 'status_code': e.code}
+        self._respond(code, obj)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        http.server.HTTPServer.__init__(self, *args, **kwargs)
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self._connections.discard(request)
+        http.server.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        # keep-alive connections are otherwise served by their threads after shutdown()
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            request.close()
+
+
+class FakeMotifServer(object):
+    """
+    A local stand-in for motif, serving the MotifApi.API routes over HTTPS (with the bundled
+    self-signed TEST_CERT) for testing and benchmarking clients.
+
+    Cameras, recording, copying and configuration are simulated in memory. Each request is
+    delayed by latency seconds (plus up to jitter seconds), and a fraction error_rate of requests
+    fail with a 500 error. Copies and exports take transfer_time seconds (default they finish
+    immediately). image and state streams are only advertised for cameras given ports with
+    set_stream(), e.g. those of an ImagePublisher or StatePublisher.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, api_key=TEST_API_KEY, cameras=('FAKE0',),
+                 latency=0., jitter=0., error_rate=0., transfer_time=0.):
+        self.api_key = api_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.transfer_time = transfer_time
+
+        self.cameras = collections.OrderedDict((sn, _FakeCamera(sn)) for sn in cameras)
+        self.requests = collections.Counter()  # 'METHOD route' -> count
+        self.io = {}  # (serial or None, name) -> value
+        self.io_log = []
+        self.messages = []
+        self.schedule = {}
+
+        self._lock = threading.Lock()
+        self._router = MotifApi.get_router()
+        self._random = random.Random()
+        self._routes = {
+            'version': self._version,
+            'cameras': self._cameras,
+            'cameras/configure': self._configure_all,
+            'cameras/read/<name>': self._read_all,
+            'camera/<serial>': self._camera,
+            'camera/<serial>/configure': self._configure,
+            'camera/<serial>/read/<name>': self._read,
+            'camera/<serial>/recording/start': self._recording_start,
+            'camera/<serial>/recording/stop': self._recording_stop,
+            'camera/<serial>/recordings': self._recordings,
+            'camera/<serial>/recordings/copy_all': self._copy_all,
+            'camera/<serial>/recordings/export_all': self._export_all,
+            'camera/<serial>/io/<name>/set': self._camera_io_set,
+            'camera/<serial>/io/log': self._io_log,
+            'recording/start': self._recording_start,
+            'recording/stop': self._recording_stop,
+            'recordings': self._recordings,
+            'recordings/copy_all': self._copy_all,
+            'recordings/export_all': self._export_all,
+            'io/<name>/set': self._io_set,
+            'io/log': self._io_log,
+            'camera/<serial>/experiment/message': self._message,
+            'experiment/message': self._message,
+            'schedule': self._schedule,
+            'schedule/clear': self._schedule_clear,
+            'schedule/<identifier>/clear': self._schedule_clear,
+        }
+
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(TEST_CERT, TEST_KEY)
+        # (the handshake is made by the connection's thread, not when accepting)
+        self._server.socket = ctx.wrap_socket(self._server.socket, server_side=True,
+                                              do_handshake_on_connect=False)
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='FakeMotifServer')
+        self._thread.daemon = True
+        self._thread.start()
+        LOG.debug('serving on %s:%s' % (self.host, self.port))
+        return self
+
+    def stop(self):
+        """
+        Stops the server and closes all connections, as if motif went away
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        self._server.close_connections()
+
+    def __enter__(self):
+        if self._thread is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def api(self, **kwargs):
+        """
+        Returns a MotifApi connected to this server
+        """
+        return MotifApi(self.host, self.api_key, self.port, ca_cert=TEST_CERT, **kwargs)
+
+    def set_stream(self, serial, image_port=None, state_port=None):
+        """
+        Advertises the given image and state stream ports for the camera
+        """
+        cam = self.cameras[serial]
+        cam.image_port = image_port
+        cam.state_port = state_port
+
+    def handle(self, method, path, api_key, body):
+        """
+        Returns the response object of the request, or raises _HTTPError
+        """
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+        if api_key != self.api_key:
+            raise _HTTPError('invalid api key', 401)
+
+        endpoint = path.lstrip('/')
+        if endpoint.startswith('api/'):
+            endpoint = endpoint.split('/', 2)[-1]
+
+        route = self._router.resolve(endpoint)
+        if route is None:
+            raise _HTTPError('not found', 404)
+        if route.method != method:
+            raise _HTTPError('method not allowed', 405)
+
+        name = _route_name(route.pattern)
+        with self._lock:
+            self.requests['%s %s' % (method, name)] += 1
+
+        if self.error_rate and (self._random.random() < self.error_rate):
+            raise _HTTPError('simulated error', 500)
+
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            raise _HTTPError('invalid JSON', 400)
+
+        handler = self._routes.get(name)
+        if (handler is None) and name.startswith('schedule/'):
+            handler = functools.partial(self._schedule_task, endpoint)
+        if handler is None:
+            # accepted but not simulated
+            return {}
+
+        params = dict(route.params)
+        serial = params.pop('serial', None)
+        with self._lock:
+            return handler(self._selected(serial), data, **params)
+
+    def _selected(self, serial):
+        if serial is None:
+            return list(self.cameras.values())
+        try:
+            return [self.cameras[serial]]
+        except KeyError:
+            raise _HTTPError('camera %s not found' % serial, 404)
+
+    def _version(self, cams, data):
+        from .. import __version__
+        return {'software': 'motif (motifapi.testing)', 'version': __version__}
+
+    def _cameras(self, cams, data):
+        return {'cameras': [{'serial': c.serial, 'status': 'recording' if c.filename else 'idle'}
+                            for c in cams]}
+
+    def _camera(self, cams, data):
+        return cams[0].status(self.host)
+
+    def _configure(self, cams, data):
+        for c in cams:
+            c.config.update(data)
+        return {}
+
+    _configure_all = _configure
+
+    def _read(self, cams, data, name):
+        return {'value': cams[0].config.get(name)}
+
+    def _read_all(self, cams, data, name):
+        return {c.serial: {'value': c.config.get(name)} for c in cams}
+
+    def _recording_start(self, cams, data):
+        for c in cams:
+            c.filename = '%s.%s' % (c.serial, time.strftime('%Y%m%d_%H%M%S'))
+        return {'filename': cams[0].filename if len(cams) == 1 else ''}
+
+    def _recording_stop(self, cams, data):
+        for c in cams:
+            if c.filename:
+                c.recordings.append({'path': c.filename, 'uuid': '%s-%d' % (c.serial, len(c.recordings))})
+                c.filename = ''
+        return {}
+
+    def _recordings(self, cams, data):
+        return {'recordings': [r for c in cams for r in c.recordings]}
+
+    def _transfer(self, cams, busy, finished):
+        if not self.transfer_time:
+            # finishes immediately, the request is only counted
+            return {}
+        for c in cams:
+            c.playback_status = busy
+            t = threading.Timer(self.transfer_time, self._transfer_finished, (c, busy, finished))
+            t.daemon = True
+            t.start()
+        return {}
+
+    def _transfer_finished(self, cam, busy, finished):
+        with self._lock:
+            if cam.playback_status == busy:
+                cam.playback_status = finished
+
+    def _copy_all(self, cams, data):
+        return self._transfer(cams, 'copying', 'idle')
+
+    def _export_all(self, cams, data):
+        return self._transfer(cams, 'exporting', 'export finished')
+
+    def _io_set(self, cams, data, name):
+        self.io[(None, name)] = data.get('value')
+        return {}
+
+    def _camera_io_set(self, cams, data, name):
+        self.io[(cams[0].serial, name)] = data.get('value')
+        return {}
+
+    def _io_log(self, cams, data):
+        self.io_log.append(data)
+        return {}
+
+    def _message(self, cams, data):
+        self.messages.append(data)
+        return {}
+
+    def _schedule(self, cams, data):
+        return {'tasks': list(self.schedule.values()), 'now': time.time()}
+
+    def _schedule_task(self, endpoint, cams, data, **params):
+        try:
+            task_name = data.pop('task_name')
+            cron_expression = data.pop('cron_expression')
+        except KeyError as e:
+            raise _HTTPError('missing argument %s' % e, 400)
+        self.schedule[task_name] = {'task_name': task_name,
+                                    'endpoint': endpoint,
+                                    'cron_expression': cron_expression,
+                                    'serials': [c.serial for c in cams],
+                                    'params': params,
+                                    'arguments': data}
+        return {}
+
+    def _schedule_clear(self, cams, data, identifier=None):
+        if identifier is None:
+            self.schedule.clear()
+        else:
+            self.schedule.pop(identifier, None)
+        return {}
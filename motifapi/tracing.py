@@ -0,0 +1,143 @@
+import re
+import sys
+import atexit
+import logging
+import threading
+
+from .stats import LatencyHistogram
+
+LOG = logging.getLogger('motifapi.tracing')
+
+
+def _route_name(pattern):
+    # camera/(?P<serial>[^\s /]+)/read/(?P<name>[^\s /]+)$ -> camera/<serial>/read/<name>
+    return re.sub(r'\(\?P<(\w+)>[^)]*\)', r'<\1>', pattern).rstrip('$')
+
+
+class CallTracer(object):
+    """
+    Base class of MotifApi call tracers (see MotifApi.add_tracer). The hooks are called from the
+    thread making the call, with the CallInfo of the call, and must not raise.
+    """
+
+    def before_request(self, info):
+        pass
+
+    def after_response(self, info):
+        pass
+
+    def on_error(self, info, exc):
+        pass
+
+
+class LogTracer(CallTracer):
+    """
+    Logs every call, and its phase durations, at the given level
+    """
+
+    def __init__(self, logger=LOG, level=logging.DEBUG):
+        self._logger = logger
+        self._level = level
+
+    def after_response(self, info):
+        self._logger.log(self._level, '%s %s %s in %.1fms (connect=%s tls=%s server=%.1fms decode=%.1fms)',
+                         info.method, info.endpoint, info.status, info.total * 1000.,
+                         'reused' if info.reused else '%.1fms' % (info.connect * 1000.),
+                         'reused' if info.reused else '%.1fms' % (info.tls * 1000.),
+                         info.server * 1000., info.decode * 1000.)
+
+    def on_error(self, info, exc):
+        self._logger.log(self._level, '%s %s failed in %.1fms: %s',
+                         info.method, info.endpoint, info.total * 1000., exc)
+
+
+class _RouteStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.phases = {p: LatencyHistogram() for p in CallStats.PHASES}
+
+
+class CallStats(CallTracer):
+    """
+    Collects the number of calls, errors and LatencyHistograms of the total, connect, tls, server
+    and decode times of the calls to each endpoint pattern (e.g. camera/<serial>/recording/start).
+
+    connect and tls are only recorded for calls which made a new connection.
+    """
+
+    PHASES = ('total', 'connect', 'tls', 'server', 'decode')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}  # (method, pattern) -> _RouteStats
+
+    def _record(self, info, error):
+        key = (info.method, info.route)
+        with self._lock:
+            rs = self._routes.get(key)
+            if rs is None:
+                rs = self._routes[key] = _RouteStats()
+            rs.count += 1
+            if error:
+                rs.errors += 1
+            for p in CallStats.PHASES:
+                v = getattr(info, p)
+                if v is not None:
+                    rs.phases[p].record(v)
+
+    def after_response(self, info):
+        self._record(info, False)
+
+    def on_error(self, info, exc):
+        self._record(info, True)
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+    def snapshot(self):
+        """
+        Returns {'METHOD route': {'count', 'errors', 'error_rate', 'total': {..}, 'connect': {..}, ...}}
+        where each phase is a LatencyHistogram snapshot
+        """
+        out = {}
+        with self._lock:
+            for (method, pattern), rs in sorted(self._routes.items(), key=lambda kv: _route_name(kv[0][1])):
+                d = {'count': rs.count,
+                     'errors': rs.errors,
+                     'error_rate': float(rs.errors) / rs.count}
+                for p in CallStats.PHASES:
+                    d[p] = rs.phases[p].snapshot()
+                out['%s %s' % (method, _route_name(pattern))] = d
+        return out
+
+    def summary(self):
+        """
+        Returns a table of the number of calls, errors and median/99th percentile latencies (ms)
+        """
+        def _ms(h, k):
+            v = h.get(k)
+            return '-' if v is None else '%.1f' % (v * 1000.)
+
+        rows = [('route', 'count', 'errors', 'total p50/p99', 'connect', 'tls', 'server', 'decode')]
+        for name, d in self.snapshot().items():
+            row = [name, str(d['count']), str(d['errors'])]
+            for p in CallStats.PHASES:
+                row.append('%s/%s' % (_ms(d[p], 'p50'), _ms(d[p], 'p99')))
+            rows.append(row)
+
+        widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+        return '\n'.join('  '.join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(r, widths)))
+                         for r in rows)
+
+    def dump_at_exit(self, stream=None):
+        """
+        Writes the summary to stream (default stderr) when the interpreter exits
+        """
+        def _dump():
+            if self._routes:
+                (stream or sys.stderr).write(self.summary() + '\n')
+        atexit.register(_dump)
+        return self
@@ -0,0 +1,426 @@
+import time
+import logging
+import threading
+import collections
+
+from .api import MotifError
+
+LOG = logging.getLogger('motifapi.transfer')
+
+COPY = 'copy'
+EXPORT = 'export'
+
+PENDING = 'pending'
+STARTING = 'starting'  # requested, not yet seen copying/exporting
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+UNKNOWN = 'unknown'  # started, but never seen copying/exporting or finished
+
+_FINISHED_STATES = (DONE, FAILED, UNKNOWN)
+
+_ENDPOINTS = {COPY: 'camera/%s/recordings/copy_all',
+              EXPORT: 'camera/%s/recordings/export_all'}
+
+_SIZE_KEYS = ('size', 'filesize', 'bytes')
+
+
+def _busy(kind, cs):
+    return cs.is_copying if kind == COPY else cs.is_exporting
+
+
+def _playback_status(cs):
+    return str(cs.status['playback_info'].get('status', '')).lower()
+
+
+def _failed_status(status):
+    return ('fail' in status) or ('error' in status)
+
+
+def _finished_status(status):
+    # e.g. 'export finished'
+    return ('finished' in status) or ('complete' in status)
+
+
+def _recordings_size(recordings):
+    # the total size of the recordings, if the server reports their sizes
+    total = None
+    for r in recordings:
+        for k in _SIZE_KEYS:
+            v = r.get(k)
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                total = (total or 0) + v
+                break
+    return total
+
+
+class TransferJob(object):
+    """
+    A copy or export of the recordings of one camera. destination is the location (or path) it
+    is transferred to, None for the configured default. nbytes is the size of the recordings when
+    the job was started, if known
+    """
+
+    __slots__ = ('serial', 'kind', 'arguments', 'destination', 'state', 'attempts', 'error',
+                 'nbytes', 'started', 'finished', 'not_before', 'status_before')
+
+    def __init__(self, serial, kind, arguments):
+        self.serial = serial
+        self.kind = kind
+        self.arguments = arguments
+        self.destination = arguments.get('location', arguments.get('path'))
+        self.state = PENDING
+        self.attempts = 0
+        self.error = None
+        self.nbytes = None
+        self.started = None
+        self.finished = None
+        self.not_before = 0.
+        self.status_before = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+    def __repr__(self):
+        return '<TransferJob %s %s %s%s>' % (self.kind, self.serial, self.state,
+                                             '' if self.error is None else (' error=%r' % (self.error,)))
+
+
+class TransferProgress(object):
+    """
+    The progress of all jobs (unknown counts those never seen running). bytes_per_second is the throughput of the finished jobs (if the
+    sizes of the recordings are known), eta the estimated seconds until all jobs are finished
+    (None until a job has finished)
+    """
+
+    __slots__ = ('total', 'pending', 'running', 'done', 'failed', 'unknown', 'bytes_done',
+                 'bytes_per_second', 'eta')
+
+    def __init__(self, total, pending, running, done, failed, unknown, bytes_done, bytes_per_second, eta):
+        self.total = total
+        self.pending = pending
+        self.running = running
+        self.done = done
+        self.failed = failed
+        self.unknown = unknown
+        self.bytes_done = bytes_done
+        self.bytes_per_second = bytes_per_second
+        self.eta = eta
+
+    def __repr__(self):
+        return '<TransferProgress %d/%d done, %d running, %d failed, %d unknown%s>' % (
+            self.done, self.total, self.running, self.failed, self.unknown,
+            '' if self.eta is None else (', eta %.0fs' % self.eta))
+
+
+class TransferOrchestrator(object):
+    """
+    Copies or exports the recordings of many cameras one camera/<serial>/recordings/copy_all
+    (or export_all) job at a time per camera, with at most max_concurrent jobs running at once,
+    and at most max_per_destination to each destination, e.g.
+
+        orch = TransferOrchestrator(api, max_concurrent=2)
+        orch.copy(location='/mnt/nas', delete_after=True)
+        jobs = orch.run()
+
+    Jobs are followed by polling the camera status (which starts every poll_interval seconds,
+    backing off to max_poll_interval while nothing changes). A job is DONE once it was seen
+    copying (or exporting) and then idle, or if the status changes to a finished one (e.g.
+    'export finished'). A job seen neither within start_timeout seconds ends as UNKNOWN, its
+    transfer may still be running. Jobs whose request fails, or whose status reports an error,
+    are retried up to retries times after retry_delay seconds, doubling each time.
+
+    If avoid_recording is True no job is started while any camera is recording. Motif can not
+    limit the bandwidth of transfers, so limit the jobs per destination instead.
+    """
+
+    def __init__(self, api, max_concurrent=1, max_per_destination=None, avoid_recording=True,
+                 retries=3, retry_delay=5., poll_interval=0.5, max_poll_interval=5., start_timeout=30.,
+                 callback=None):
+        self._api = api
+        self._max_concurrent = max_concurrent
+        self._max_per_destination = max_per_destination
+        self._avoid_recording = avoid_recording
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._start_timeout = start_timeout
+        self._callback = callback
+
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._stop = threading.Event()
+        self._added = threading.Event()
+        self._finished = threading.Condition()
+        self._thread = None
+
+    @property
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def _serials(self, serials):
+        if serials is None:
+            return [c['serial'] for c in self._api.call('cameras').get('cameras', [])]
+        return list(serials)
+
+    def add(self, kind, serial, **arguments):
+        """
+        Queues a COPY or EXPORT job of the camera, with the arguments of copy_all or export_all
+        """
+        if kind not in _ENDPOINTS:
+            raise ValueError('unknown transfer kind: %s' % kind)
+        job = TransferJob(serial, kind, arguments)
+        with self._lock:
+            self._jobs.append(job)
+        self._added.set()
+        return job
+
+    def copy(self, serials=None, **arguments):
+        """
+        Queues copying the recordings of the given (default all) cameras, returns the TransferJobs
+        """
+        return [self.add(COPY, sn, **arguments) for sn in self._serials(serials)]
+
+    def export(self, serials=None, **arguments):
+        """
+        Queues exporting the recordings of the given (default all) cameras, returns the TransferJobs
+        """
+        return [self.add(EXPORT, sn, **arguments) for sn in self._serials(serials)]
+
+    def progress(self):
+        with self._lock:
+            jobs = list(self._jobs)
+        counts = collections.Counter(j.state for j in jobs)
+        finished = [j for j in jobs if j.state == DONE]
+
+        sized = [j for j in finished if j.nbytes is not None]
+        bytes_done = sum(j.nbytes for j in sized)
+        busy = sum(j.duration for j in sized)
+        bytes_per_second = (bytes_done / busy) if (sized and busy > 0) else None
+
+        eta = None
+        remaining = counts[PENDING] + counts[STARTING] + counts[RUNNING]
+        if finished:
+            mean = sum(j.duration for j in finished) / len(finished)
+            eta = mean * remaining / max(1, min(self._max_concurrent, remaining or 1))
+
+        return TransferProgress(len(jobs), counts[PENDING], counts[STARTING] + counts[RUNNING],
+                                counts[DONE], counts[FAILED], counts[UNKNOWN], bytes_done,
+                                bytes_per_second, eta)
+
+    def _set_state(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        LOG.debug('%r' % job)
+        if (state in _FINISHED_STATES) and (self._callback is not None):
+            try:
+                self._callback(job)
+            except Exception:
+                LOG.exception('error in transfer callback')
+
+    def _retry(self, job, error, now):
+        if job.attempts > self._retries:
+            LOG.warning('%s of %s failed: %s' % (job.kind, job.serial, error))
+            job.finished = now
+            self._set_state(job, FAILED, error)
+        else:
+            job.not_before = now + self._retry_delay * (2 ** (job.attempts - 1))
+            LOG.info('%s of %s failed (%s), retrying in %.0fs' % (job.kind, job.serial, error,
+                                                                  job.not_before - now))
+            job.started = None
+            self._set_state(job, PENDING, error)
+
+    def _start(self, job, now, cs):
+        job.attempts += 1
+        # (a status already finished or failed before the job says nothing about the job)
+        job.status_before = None if cs is None else _playback_status(cs)
+        try:
+            if job.nbytes is None:
+                job.nbytes = _recordings_size(
+                    self._api.call('camera/%s/recordings' % job.serial).get('recordings', []))
+            self._api.call(_ENDPOINTS[job.kind] % job.serial, **job.arguments)
+        except MotifError as e:
+            self._retry(job, e, now)
+            return
+        except Exception as e:
+            LOG.exception('error starting %s of %s' % (job.kind, job.serial))
+            job.finished = now
+            self._set_state(job, FAILED, e)
+            return
+        job.started = time.monotonic()
+        self._set_state(job, STARTING)
+
+    def _update(self, job, cs, now):
+        # returns True if the job changed state
+        if _busy(job.kind, cs):
+            if job.state == STARTING:
+                self._set_state(job, RUNNING)
+                return True
+            return False
+
+        status = _playback_status(cs)
+        changed = status != job.status_before
+        if job.state == STARTING:
+            if changed and _finished_status(status):
+                # finished before it was seen running
+                job.finished = now
+                self._set_state(job, DONE)
+                return True
+            if (now - job.started) < self._start_timeout:
+                return False
+            if not (changed and _failed_status(status)):
+                # the slot is freed, but the transfer may still be running
+                LOG.warning('%s of %s not seen running within %gs' % (job.kind, job.serial, self._start_timeout))
+                job.finished = now
+                self._set_state(job, UNKNOWN, MotifError('not seen running within %gs' % self._start_timeout))
+                return True
+
+        # seen running and now idle
+        if _failed_status(status):
+            self._retry(job, MotifError('%s failed: %s' % (job.kind, cs.status['playback_info'].get('status'))), now)
+            return True
+        job.finished = now
+        self._set_state(job, DONE)
+        return True
+
+    def _startable(self, pending, active, recording, now):
+        if recording:
+            return []
+        per_dest = collections.Counter(j.destination for j in active)
+        busy_serials = set(j.serial for j in active)
+        n = self._max_concurrent - len(active)
+        out = []
+        for job in pending:
+            if len(out) >= n:
+                break
+            if (job.not_before > now) or (job.serial in busy_serials):
+                continue
+            if (self._max_per_destination is not None) and (per_dest[job.destination] >= self._max_per_destination):
+                continue
+            per_dest[job.destination] += 1
+            busy_serials.add(job.serial)
+            out.append(job)
+        return out
+
+    def _unfinished(self):
+        with self._lock:
+            return any(j.state in (PENDING, STARTING, RUNNING) for j in self._jobs)
+
+    def run(self, timeout=None):
+        """
+        Runs the queued jobs until all are finished (or failed), or timeout seconds have passed.
+        Returns the jobs
+        """
+        return self._run(timeout, False)
+
+    def _run(self, timeout, forever):
+        try:
+            return self._loop(timeout, forever)
+        except Exception as e:
+            # fails the unfinished jobs, rather than leaving wait() waiting for them
+            LOG.exception('error running transfers')
+            now = time.monotonic()
+            for job in self.jobs:
+                if job.state not in _FINISHED_STATES:
+                    job.finished = now
+                    self._set_state(job, FAILED, e)
+            raise
+        finally:
+            with self._finished:
+                self._finished.notify_all()
+
+    def _loop(self, timeout, forever):
+        t0 = time.monotonic()
+        interval = self._poll_interval
+        while not self._stop.is_set():
+            with self._lock:
+                jobs = list(self._jobs)
+            active = [j for j in jobs if j.state in (STARTING, RUNNING)]
+            pending = [j for j in jobs if j.state == PENDING]
+            if not (active or pending):
+                with self._finished:
+                    self._finished.notify_all()
+                if not forever:
+                    break
+                # (added jobs wake the thread)
+                self._added.wait(self._max_poll_interval)
+                self._added.clear()
+                interval = self._poll_interval
+                continue
+            if (timeout is not None) and ((time.monotonic() - t0) >= timeout):
+                break
+
+            changed = False
+            try:
+                # (the status of pending jobs is needed to tell the status they start from)
+                snap = self._api.snapshot(None if self._avoid_recording else
+                                          sorted(set(j.serial for j in active + pending)), max_age=0)
+            except Exception as e:
+                LOG.warning('error polling camera status: %s' % e)
+                snap = None
+
+            now = time.monotonic()
+            if snap is not None:
+                for job in active:
+                    cs = snap.get(job.serial)
+                    if cs is not None:
+                        changed |= self._update(job, cs, now)
+
+                active = [j for j in active if j.state in (STARTING, RUNNING)]
+                recording = self._avoid_recording and any(cs.is_recording for cs in snap.values())
+                for job in self._startable(pending, active, recording, now):
+                    self._start(job, now, snap.get(job.serial))
+                    changed = True
+
+            # poll quickly while jobs change state, and to see started jobs begin
+            if changed:
+                interval = self._poll_interval
+            else:
+                interval = min(interval * 1.5, self._max_poll_interval)
+            delay = interval
+            retry_at = [j.not_before for j in pending if j.state == PENDING and j.not_before > now]
+            if retry_at:
+                delay = min(delay, max(0., min(retry_at) - now))
+            if any(j.state == STARTING for j in jobs):
+                delay = min(delay, self._poll_interval)
+            if timeout is not None:
+                delay = max(0., min(delay, timeout - (time.monotonic() - t0)))
+            self._stop.wait(delay)
+
+        return self.jobs
+
+    def start(self):
+        """
+        Runs the jobs (see run) in a background thread, and any added later, until stopped
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(None, True), name='TransferOrchestrator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        """
+        Waits for the background thread to finish (or fail) all jobs, returns True if it did
+        """
+        with self._finished:
+            self._finished.wait_for(lambda: (not self._unfinished()) or (self._thread is None) or
+                                    (not self._thread.is_alive()), timeout)
+        return not self._unfinished()
+
+    def stop(self):
+        """
+        Stops starting and following jobs, transfers already started continue in motif
+        """
+        self._stop.set()
+        self._added.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._finished:
+            self._finished.notify_all()
@@ -0,0 +1,412 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from .api import MotifError
+from .tracing import CallTracer
+
+LOG = logging.getLogger('motifapi.watch')
+
+RECORDING_STARTED = 'recording_started'
+RECORDING_STOPPED = 'recording_stopped'
+COPY_STARTED = 'copy_started'
+COPY_FINISHED = 'copy_finished'
+EXPORT_STARTED = 'export_started'
+EXPORT_FINISHED = 'export_finished'
+FRAMES_STALLED = 'frames_stalled'
+FRAMES_RESUMED = 'frames_resumed'
+
+EVENTS = (RECORDING_STARTED, RECORDING_STOPPED, COPY_STARTED, COPY_FINISHED,
+          EXPORT_STARTED, EXPORT_FINISHED, FRAMES_STALLED, FRAMES_RESUMED)
+
+# events which can only be detected from camera/<serial>
+_HTTP_EVENTS = (COPY_STARTED, COPY_FINISHED, EXPORT_STARTED, EXPORT_FINISHED)
+
+# the camera state of the events detected by polling (recording only without a state stream)
+_EVENT_ATTRS = {RECORDING_STARTED: 'is_recording', RECORDING_STOPPED: 'is_recording',
+                COPY_STARTED: 'is_copying', COPY_FINISHED: 'is_copying',
+                EXPORT_STARTED: 'is_exporting', EXPORT_FINISHED: 'is_exporting'}
+
+# route -> (camera attribute, finished event) of the calls which start a transfer
+_TRANSFER_ROUTES = {r'recordings/copy_all$': ('is_copying', COPY_FINISHED),
+                    r'camera/(?P<serial>[^\s /]+)/recordings/copy_all$': ('is_copying', COPY_FINISHED),
+                    r'recordings/export_all$': ('is_exporting', EXPORT_FINISHED),
+                    r'camera/(?P<serial>[^\s /]+)/recordings/export_all$': ('is_exporting', EXPORT_FINISHED)}
+
+
+class StateEvent(object):
+    """
+    A state transition of a camera. state is the state message or CameraStatus in which it was seen
+    """
+
+    __slots__ = ('name', 'serial', 'time', 'state')
+
+    def __init__(self, name, serial, t, state):
+        self.name = name
+        self.serial = serial
+        self.time = t
+        self.state = state
+
+    def __repr__(self):
+        return '<StateEvent %s %s>' % (self.name, self.serial)
+
+
+class _Camera(object):
+
+    __slots__ = ('serial', 'streamer', 'is_recording', 'is_copying', 'is_exporting',
+                 'frame_number', 'frame_seen', 'stalled', 'requested')
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.streamer = None
+        self.is_recording = self.is_copying = self.is_exporting = None
+        self.frame_number = None
+        self.frame_seen = None
+        self.stalled = False
+        self.requested = {}  # attribute -> time a transfer was requested, until it is seen
+
+
+class _ChangeHint(CallTracer):
+    # any successful non-GET call may change the camera state, poll again soon
+
+    def __init__(self, watcher):
+        self._watcher = watcher
+
+    def after_response(self, info):
+        if info.method != 'GET':
+            transfer = _TRANSFER_ROUTES.get(info.route)
+            if transfer is not None:
+                self._watcher._transfer_requested(info.endpoint, transfer[0])
+            self._watcher.poll_soon()
+
+
+class StateWatcher(object):
+    """
+    Detects state transitions of cameras (see EVENTS) and calls callbacks, or resolves futures,
+    when they happen.
+
+    Recording state and frames are taken from the realtime state stream of each camera (when
+    use_state_stream is True and the stream is enabled), so those transitions are seen within
+    milliseconds. Everything else (copying, exporting, and recording on cameras without a state
+    stream) is polled from camera/<serial>, only while somebody is interested in those events.
+    Polling starts every poll_interval seconds, backing off to max_poll_interval while nothing
+    changes, and returns to poll_interval after any API call made with the api which could change
+    the state.
+
+    A copy or export can start and finish between two polls (or have nothing to transfer and never
+    start), so if one is requested with the api and the camera is not seen copying (or exporting)
+    within start_timeout seconds, COPY_FINISHED (or EXPORT_FINISHED) is emitted when it is seen
+    idle. Transfers started elsewhere are only seen if a poll happens during them.
+
+    FRAMES_STALLED is emitted when a camera has not published a new frame for stall_timeout
+    seconds, FRAMES_RESUMED when it does again. Callbacks are called from the watcher thread,
+    and must not block.
+
+    on() and wait_for() wait for the first poll of the cameras whose state is not yet known, so
+    they can block for up to max_poll_interval plus the api timeout. Called from a callback they
+    return at once, and the transitions are only seen from the next poll.
+
+    The first state seen of a camera is not a transition, so register for an event before
+    triggering it, e.g.
+
+        f = watcher.wait_for(COPY_FINISHED, serial)
+        api.call('camera/%s/recordings/copy_all' % serial)
+        f.result(timeout=60)
+    """
+
+    def __init__(self, api, serials=None, use_state_stream=True, stall_timeout=1.0,
+                 poll_interval=0.1, max_poll_interval=2.0, start_timeout=2.0):
+        self._api = api
+        if serials is None:
+            serials = [c['serial'] for c in api.call('cameras').get('cameras', [])]
+        self._cameras = collections.OrderedDict((sn, _Camera(sn)) for sn in serials)
+        self._use_state_stream = use_state_stream
+        self._stall_timeout = stall_timeout
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._start_timeout = start_timeout
+
+        self._lock = threading.Lock()
+        self._polled = threading.Condition(threading.Lock())
+        self._polls = 0
+        self._api_timeout = api._pool.timeout
+        self._subscriptions = []  # [(event, serial or None, callback, once), ...]
+        self._interval = poll_interval
+        self._next_poll = 0.
+        self._stop = threading.Event()
+        self._thread = None
+        self._poller = None
+        self._hint = _ChangeHint(self)
+
+    @property
+    def serials(self):
+        return list(self._cameras)
+
+    def start(self):
+        if self._use_state_stream:
+            from .stream import StreamPoller
+            self._poller = StreamPoller()
+            for cam in self._cameras.values():
+                try:
+                    cam.streamer = self._api.get_stream(cam.serial, stream_type=self._api.STREAM_TYPE_STATE)
+                except MotifError as e:
+                    LOG.info('polling the state of %s: %s' % (cam.serial, e))
+                    continue
+                self._poller.register(cam.streamer)
+
+        self._api.add_tracer(self._hint)
+        self._thread = threading.Thread(target=self._run, name='StateWatcher')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops watching and closes the state streams. Unresolved futures are cancelled
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._api.remove_tracer(self._hint)
+        for cam in self._cameras.values():
+            if cam.streamer is not None:
+                cam.streamer.close()
+                cam.streamer = None
+
+        with self._lock:
+            subs, self._subscriptions = self._subscriptions, []
+        for _, _, cb, once in subs:
+            if once:
+                getattr(cb, 'future').cancel()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def on(self, event, callback, serial=None):
+        """
+        Calls callback(StateEvent) on every event of the given camera (default any camera).
+        Returns a handle for off()
+        """
+        return self._subscribe(event, serial, callback, False)
+
+    def off(self, handle):
+        with self._lock:
+            self._subscriptions = [s for s in self._subscriptions if s is not handle]
+
+    def wait_for(self, event, serial=None, timeout=None):
+        """
+        Returns a concurrent.futures.Future resolved with the next StateEvent of the given camera
+        (default any camera). If timeout is given and the event is not seen within timeout
+        seconds the future fails with concurrent.futures.TimeoutError
+        """
+        f = concurrent.futures.Future()
+        lock = threading.Lock()
+
+        def _resolve(ev):
+            with lock:
+                if not f.done():
+                    f.set_result(ev)
+        _resolve.future = f
+
+        sub = self._subscribe(event, serial, _resolve, True)
+        if timeout is not None:
+            def _expire():
+                self.off(sub)
+                with lock:
+                    if not f.done():
+                        f.set_exception(concurrent.futures.TimeoutError(
+                            'no %s of %s within %.1fs' % (event, serial or 'any camera', timeout)))
+
+            timer = threading.Timer(timeout, _expire)
+            timer.daemon = True
+            timer.start()
+            f.add_done_callback(lambda _: timer.cancel())
+        return f
+
+    def wait_for_async(self, event, serial=None, timeout=None):
+        """
+        As wait_for, returning an asyncio future of the running event loop
+        """
+        import asyncio
+        return asyncio.wrap_future(self.wait_for(event, serial, timeout))
+
+    def _subscribe(self, event, serial, callback, once):
+        if event not in EVENTS:
+            raise ValueError('unknown event: %s' % event)
+        if (serial is not None) and (serial not in self._cameras):
+            raise ValueError('camera %s is not watched' % serial)
+        sub = (event, serial, callback, once)
+        with self._lock:
+            self._subscriptions = self._subscriptions + [sub]
+
+        attr = _EVENT_ATTRS.get(event)
+        if (attr is not None) and (self._thread is not None):
+            # the transition can only be seen if the state before it is known, so wait for
+            # the first poll (e.g. before the caller starts a copy and waits for it to finish)
+            cams = self._cameras.values() if serial is None else [self._cameras[serial]]
+            if attr == 'is_recording':
+                cams = [c for c in cams if c.streamer is None]
+            if any(getattr(c, attr) is None for c in cams):
+                if threading.current_thread() is self._thread:
+                    # from a callback, the watcher thread cannot wait for its own poll
+                    self.poll_soon()
+                    return sub
+                with self._polled:
+                    n = self._polls
+                    self.poll_soon()
+                    self._polled.wait_for(lambda: (self._polls > n) or self._stop.is_set(),
+                                          self._max_poll_interval + self._api_timeout)
+        return sub
+
+    def poll_soon(self):
+        """
+        Polls the camera status at the fastest rate again
+        """
+        self._interval = self._poll_interval
+        self._next_poll = 0.
+
+    def _transfer_requested(self, endpoint, attr):
+        # camera/<serial>/recordings/copy_all, or recordings/copy_all of all cameras
+        parts = endpoint.strip('/').split('/')
+        cams = [self._cameras.get(parts[1])] if parts[0] == 'camera' else self._cameras.values()
+        now = time.monotonic()
+        for cam in cams:
+            if cam is not None:
+                cam.requested[attr] = now
+
+    def _emit(self, name, serial, state):
+        ev = StateEvent(name, serial, time.time(), state)
+        LOG.debug('%s %s' % (name, serial))
+
+        fired = []
+        with self._lock:
+            for sub in self._subscriptions:
+                event, sn, cb, once = sub
+                if (event == name) and ((sn is None) or (sn == serial)):
+                    fired.append(sub)
+            if any(sub[3] for sub in fired):
+                self._subscriptions = [s for s in self._subscriptions
+                                       if not (s[3] and any(s is f for f in fired))]
+
+        for _, _, cb, _ in fired:
+            try:
+                cb(ev)
+            except Exception:
+                LOG.exception('error in %s callback' % name)
+
+    def _edge(self, cam, attr, value, started, finished, state):
+        old = getattr(cam, attr)
+        setattr(cam, attr, value)
+        if (old is not None) and (old != value):
+            self._emit(started if value else finished, cam.serial, state)
+            return True
+        return False
+
+    def _on_state(self, cam, state):
+        if 'is_recording' in state:
+            self._edge(cam, 'is_recording', bool(state['is_recording']),
+                       RECORDING_STARTED, RECORDING_STOPPED, state)
+        fn = state.get('frame_number')
+        if (fn is not None) and (fn != cam.frame_number):
+            cam.frame_number = fn
+            cam.frame_seen = time.monotonic()
+            if cam.stalled:
+                cam.stalled = False
+                self._emit(FRAMES_RESUMED, cam.serial, state)
+
+    def _http_wanted(self):
+        with self._lock:
+            subs = self._subscriptions
+        for event, sn, _, _ in subs:
+            if event in _HTTP_EVENTS:
+                return True
+            if event in (RECORDING_STARTED, RECORDING_STOPPED):
+                cams = self._cameras.values() if sn is None else [self._cameras[sn]]
+                if any(c.streamer is None for c in cams):
+                    return True
+        return False
+
+    def _transfer_finished(self, cam, attr, finished, edge, polled, state):
+        requested = cam.requested.get(attr)
+        if requested is None:
+            return False
+        if edge or getattr(cam, attr):
+            # seen, the transition tells when it finishes
+            del cam.requested[attr]
+            return False
+        if (polled - requested) < self._start_timeout:
+            # keep polling quickly to see it start
+            return True
+        del cam.requested[attr]
+        self._emit(finished, cam.serial, state)
+        return True
+
+    def _poll_http(self):
+        polled = time.monotonic()
+        try:
+            statuses = self._api.snapshot(list(self._cameras), max_age=0)
+        except MotifError as e:
+            LOG.warning('error polling camera status: %s' % e)
+            return False
+        finally:
+            with self._polled:
+                self._polls += 1
+                self._polled.notify_all()
+
+        changed = False
+        for sn, st in statuses.items():
+            cam = self._cameras[sn]
+            if cam.streamer is None:
+                changed |= self._edge(cam, 'is_recording', st.is_recording,
+                                      RECORDING_STARTED, RECORDING_STOPPED, st)
+            for attr, started, finished in (('is_copying', COPY_STARTED, COPY_FINISHED),
+                                            ('is_exporting', EXPORT_STARTED, EXPORT_FINISHED)):
+                edge = self._edge(cam, attr, getattr(st, attr), started, finished, st)
+                changed |= self._transfer_finished(cam, attr, finished, edge, polled, st) or edge
+        return changed
+
+    def _check_stalls(self, now):
+        for cam in self._cameras.values():
+            if (cam.frame_seen is not None) and (not cam.stalled) and \
+                    ((now - cam.frame_seen) > self._stall_timeout):
+                cam.stalled = True
+                self._emit(FRAMES_STALLED, cam.serial, {'frame_number': cam.frame_number})
+
+    def _run(self):
+        streams = {cam.streamer: cam for cam in self._cameras.values() if cam.streamer is not None}
+        if streams:
+            from .stream import _json_loads
+        while not self._stop.is_set():
+            now = time.monotonic()
+
+            if self._http_wanted():
+                if now >= self._next_poll:
+                    if self._poll_http():
+                        self._interval = self._poll_interval
+                    else:
+                        self._interval = min(self._interval * 1.5, self._max_poll_interval)
+                    now = time.monotonic()
+                    self._next_poll = now + self._interval
+                timeout = self._next_poll - now
+            else:
+                timeout = 0.1
+
+            self._check_stalls(now)
+            timeout = min(timeout, 0.1, self._stall_timeout / 4.)
+
+            if self._poller is None or not streams:
+                self._stop.wait(max(0., timeout))
+                continue
+
+            for streamer in self._poller.poll(max(0., timeout)):
+                sock = streamer.stream
+                # all queued messages, only transitions matter not each one
+                while sock.poll(0):
+                    _, msg = sock.recv_multipart()
+                    self._on_state(streams[streamer], _json_loads(msg))
@@ -10,7 +10,9 @@ setup(
     version='0.2.0',
     author='John Stowers',
     author_email='john@loopbio.com',
-    packages=['motifapi'],
+    packages=['motifapi', 'motifapi.testing'],
+    package_data={'motifapi': ['server.crt'],
+                  'motifapi.testing': ['test.crt', 'test.key']},
     python_requires='>=3.6',
     classifiers=[
         'Programming Language :: Python :: 3',
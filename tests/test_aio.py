@@ -0,0 +1,121 @@
+import time
+import asyncio
+import unittest
+
+from motifapi import MotifError, MotifApiError
+from motifapi.aio import AsyncMotifApi
+from motifapi.testing import FakeMotifServer, TEST_CERT
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncMotifApiTest(unittest.TestCase):
+
+    SERIALS = ['FAKE%d' % i for i in range(6)]
+
+    def setUp(self):
+        self.server = FakeMotifServer(cameras=self.SERIALS).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _api(self, **kwargs):
+        kwargs.setdefault('api_key', self.server.api_key)
+        kwargs.setdefault('port', self.server.port)
+        return AsyncMotifApi(self.server.host, ca_cert=TEST_CERT, **kwargs)
+
+    def test_gather_cameras(self):
+        self.server.cameras['FAKE1'].filename = 'rec'
+
+        async def main():
+            async with self._api() as api:
+                cameras = await api.call('cameras')
+                serials = [c['serial'] for c in cameras['cameras']]
+                recording = await asyncio.gather(*(api.is_recording(sn) for sn in serials))
+                return serials, recording
+
+        serials, recording = _run(main())
+        self.assertEqual(serials, self.SERIALS)
+        self.assertEqual(recording, [sn == 'FAKE1' for sn in self.SERIALS])
+        self.assertEqual(self.server.requests['GET camera/<serial>'], len(self.SERIALS))
+
+    def test_connections_reused(self):
+        async def main():
+            async with self._api(max_concurrency=1) as api:
+                for _ in range(5):
+                    await api.call('version')
+                return len(api._idle)
+
+        self.assertEqual(_run(main()), 1)
+
+    def test_max_concurrency(self):
+        self.server.latency = 0.05
+        in_flight = [0, 0]  # current, peak
+
+        async def main(max_concurrency):
+            api = self._api(max_concurrency=max_concurrency)
+            request = api._request
+
+            async def counted(*args):
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight[1], in_flight[0])
+                try:
+                    return await request(*args)
+                finally:
+                    in_flight[0] -= 1
+
+            api._request = counted
+            async with api:
+                await asyncio.gather(*(api.is_recording(sn) for sn in self.SERIALS * 3))
+
+        _run(main(2))
+        self.assertEqual(in_flight, [0, 2])
+
+        in_flight[1] = 0
+        t0 = time.monotonic()
+        _run(main(len(self.SERIALS)))
+        self.assertEqual(in_flight, [0, len(self.SERIALS)])
+        self.assertLess(time.monotonic() - t0, 3 * 3 * 0.05)
+
+    def test_api_errors(self):
+        async def call(endpoint, **kwargs):
+            async with self._api(**kwargs) as api:
+                return await api.call(endpoint)
+
+        with self.assertRaises(MotifApiError) as ctx:
+            _run(call('camera/NOPE'))
+        self.assertEqual(ctx.exception.code, 404)
+
+        with self.assertRaises(MotifApiError) as ctx:
+            _run(call('cameras', api_key='wrong'))
+        self.assertEqual(ctx.exception.code, 401)
+
+        self.server.error_rate = 1.
+        with self.assertRaises(MotifApiError) as ctx:
+            _run(call('cameras'))
+        self.assertEqual(ctx.exception.code, 500)
+
+        with self.assertRaises(ValueError):
+            _run(call('no/such/endpoint'))
+
+    def test_unreachable(self):
+        port = self.server.port
+        self.server.stop()
+
+        async def main():
+            async with self._api(port=port, timeout=2.) as api:
+                return await api.call('cameras')
+
+        with self.assertRaises(MotifError) as ctx:
+            _run(main())
+        self.assertNotIsInstance(ctx.exception, MotifApiError)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import unittest
+
+from motifapi import MotifError
+from motifapi.aio import AsyncMotifApi
+from motifapi.testing import FakeMotifServer, TEST_CERT
+from motifapi.testing.server import _Handler
+
+
+class _DroppingHandler(_Handler):
+    # runs the request, then closes the connection without answering, as if it dropped after
+    # the request was sent
+
+    def _handle(self):
+        n = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(n) if n else b''
+        fake = self.server.fake
+        fake.handle(self.command, self.path, self.headers.get('X-Api-Key'), body)
+        if fake.drop:
+            fake.drop -= 1
+            self.close_connection = True
+            return
+        self._respond(200, {})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeMotifServer()
+        self.server._server.RequestHandlerClass = _DroppingHandler
+        self.server.drop = 0
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_post_not_retried(self):
+        api = self.server.api()
+        api.call('version')  # a keep-alive connection to reuse
+        self.server.drop = 1
+        with self.assertRaises(MotifError):
+            api.call('recording/start')
+        self.assertEqual(self.server.requests['POST recording/start'], 1)
+        api.close()
+
+    def test_get_retried(self):
+        api = self.server.api()
+        api.call('version')
+        self.server.drop = 1
+        api.call('cameras')
+        self.assertEqual(self.server.requests['GET cameras'], 2)
+        api.close()
+
+    def test_async_post_not_retried(self):
+        async def main():
+            async with AsyncMotifApi(self.server.host, self.server.api_key, self.server.port,
+                                     ca_cert=TEST_CERT) as api:
+                await api.call('version')
+                self.server.drop = 1
+                with self.assertRaises(MotifError):
+                    await api.call('recording/start')
+                await api.call('version')
+                self.server.drop = 1
+                await api.call('cameras')
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+        self.assertEqual(self.server.requests['POST recording/start'], 1)
+        self.assertEqual(self.server.requests['GET cameras'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import sys
+import time
+import threading
+import unittest
+
+from motifapi.stream import StateSnapshot
+
+
+class _SlowSnapshot(StateSnapshot):
+    # yields to other threads on every read of the merge state, widening any race between them
+
+    __slots__ = ()
+
+    def __getattribute__(self, name):
+        if name in ('_state', '_base'):
+            time.sleep(0)
+        return StateSnapshot.__getattribute__(self, name)
+
+
+class StateSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self._switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self._switch)
+
+    def test_partial_updates(self):
+        snap = StateSnapshot({'frame_number': 0, 'is_recording': False, 'other': 1})
+        for i in range(1, 100):
+            snap = StateSnapshot({'frame_number': i}, snap)
+        self.assertEqual(snap.frame_number, 99)
+        self.assertEqual(snap.state, {'frame_number': 99, 'is_recording': False, 'other': 1})
+
+    def test_concurrent_merge(self):
+        # readers merge the state of published snapshots while the writer chains (and merges)
+        # new ones, every reader must always see the complete state
+        full = {'frame_number': 0, 'is_recording': False, 'other': 1}
+        latest = [_SlowSnapshot(full)]
+        errors = []
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                s = latest[0].state
+                if set(s) != set(full):
+                    errors.append(s)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for t in readers:
+            t.start()
+        try:
+            snap = latest[0]
+            for i in range(1, 5000):
+                snap = _SlowSnapshot({'frame_number': i}, snap)
+                latest[0] = snap
+        finally:
+            stop.set()
+            for t in readers:
+                t.join()
+
+        self.assertEqual(errors[:1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()